@@ -0,0 +1,111 @@
+"""
+Per-row cost of turning ORM rows into API models.
+
+Compares building each model through full validation against the bulk
+conversion layer in ``vending_machine.models.conversion``.
+
+Run with ``python -m benchmarks.conversion [rows]``.
+"""
+
+import sys
+import timeit
+from types import SimpleNamespace
+
+from vending_machine.data_objects.role import Role
+from vending_machine.models.conversion import (
+    PRODUCT_FIELD_MAP,
+    USER_FIELD_MAP,
+    products_from_orm,
+    users_from_orm,
+)
+from vending_machine.models.product import Product
+from vending_machine.models.user import UserWithoutPassword
+
+
+def _product_rows(count: int) -> list[SimpleNamespace]:
+    return [
+        SimpleNamespace(
+            id=i,
+            amount_available=i % 20,
+            cost=5 * (i % 30 + 1),
+            product_name=f"Product {i}",
+            seller_id=i % 7,
+        )
+        for i in range(count)
+    ]
+
+
+def _user_rows(count: int) -> list[SimpleNamespace]:
+    return [
+        SimpleNamespace(
+            id=str(i),
+            username=f"user{i}",
+            role=Role.BUYER if i % 2 else Role.SELLER,
+            deposit=i % 100,
+        )
+        for i in range(count)
+    ]
+
+
+def _per_row_validation(model, field_map, rows):
+    return [
+        model(
+            **{
+                field: (
+                    str(getattr(row, column))
+                    if column in ("id", "seller_id")
+                    else getattr(row, column)
+                )
+                for column, field in field_map.items()
+            }
+        )
+        for row in rows
+    ]
+
+
+def _report(label: str, func, rows: int, repeat: int = 5) -> None:
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    print(f"{label:<45} {best / rows * 1e9:>10.0f} ns/row")
+
+
+def run(rows: int = 10_000) -> None:
+    products = _product_rows(rows)
+    users = _user_rows(rows)
+
+    print(f"{rows} rows, best of 5\n")
+
+    _report(
+        "products: per-row validation",
+        lambda: _per_row_validation(Product, PRODUCT_FIELD_MAP, products),
+        rows,
+    )
+    _report(
+        "products: bulk TypeAdapter validation",
+        lambda: products_from_orm(products, trusted=False),
+        rows,
+    )
+    _report(
+        "products: trusted construction",
+        lambda: products_from_orm(products),
+        rows,
+    )
+
+    _report(
+        "users: per-row validation",
+        lambda: _per_row_validation(UserWithoutPassword, USER_FIELD_MAP, users),
+        rows,
+    )
+    _report(
+        "users: bulk TypeAdapter validation",
+        lambda: users_from_orm(users, trusted=False),
+        rows,
+    )
+    _report(
+        "users: trusted construction",
+        lambda: users_from_orm(users),
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
@@ -0,0 +1,156 @@
+"""
+Write throughput of balance changes: updating a balance column in place
+against appending to the ledger.
+
+Each strategy applies the same deposits, spread round-robin over a set of
+users.  The in-place path and the unbatched ledger commit every change; the
+batched ledger appends ``batch`` changes per INSERT and commit, which is how
+the ledger is meant to absorb bursts.  Balances are checked to agree at the
+end, and the time to read them all back is reported too.
+
+Run with ``python -m benchmarks.ledger [database_url] [changes] [users] [batch]``.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, delete, insert, select, update
+from sqlalchemy.orm import sessionmaker
+
+from vending_machine import ledger
+from vending_machine.data_objects.balance_snapshot import BalanceSnapshot
+from vending_machine.data_objects.ledger_entry import LedgerEntry
+from vending_machine.data_objects.ledger_kind import LedgerKind
+from vending_machine.data_objects.product import Product
+from vending_machine.data_objects.role import Role
+from vending_machine.data_objects.user import User
+from vending_machine.database import Base
+
+TABLES = [
+    User.__table__,
+    Product.__table__,
+    LedgerEntry.__table__,
+    BalanceSnapshot.__table__,
+]
+
+
+def _in_place(db, changes: list[tuple[str, int]]) -> None:
+    for user_id, amount in changes:
+        db.execute(
+            update(User).where(User.id == user_id).values(deposit=User.deposit + amount)
+        )
+        db.commit()
+
+
+def _ledger(db, changes: list[tuple[str, int]]) -> None:
+    for user_id, amount in changes:
+        ledger.deposit(db, user_id, amount)
+        db.commit()
+
+
+def _ledger_batched(batch: int):
+    def run(db, changes: list[tuple[str, int]]) -> None:
+        for start in range(0, len(changes), batch):
+            ledger.append(
+                db,
+                [
+                    ledger.entry(user_id, LedgerKind.DEPOSIT, amount)
+                    for user_id, amount in changes[start : start + batch]
+                ],
+            )
+            db.commit()
+
+    return run
+
+
+def _reset(db) -> None:
+    db.execute(delete(BalanceSnapshot))
+    db.execute(delete(LedgerEntry))
+    db.execute(update(User).values(deposit=0))
+    db.commit()
+
+
+def run(database_url: str, changes: int = 5000, users: int = 50, batch: int = 100):
+    engine = create_engine(database_url)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    Base.metadata.create_all(bind=engine, tables=TABLES)
+
+    user_ids = [f"user-{i}" for i in range(users)]
+    work = [(user_ids[i % users], 5) for i in range(changes)]
+
+    with Session() as db:
+        db.execute(delete(User))
+        db.execute(
+            insert(User),
+            [
+                {
+                    "id": user_id,
+                    "username": user_id,
+                    "deposit": 0,
+                    "role": Role.BUYER,
+                    "hashed_password": "",
+                }
+                for user_id in user_ids
+            ],
+        )
+        db.commit()
+
+    print(f"{changes} deposits over {users} users\n")
+
+    for label, apply, read in (
+        (
+            "update in place",
+            _in_place,
+            lambda db: [
+                db.execute(select(User.deposit).where(User.id == u)).scalar_one()
+                for u in user_ids
+            ],
+        ),
+        (
+            "ledger",
+            _ledger,
+            lambda db: [ledger.balance(db, u) for u in user_ids],
+        ),
+        (
+            f"ledger, {batch} per batch",
+            _ledger_batched(batch),
+            lambda db: [ledger.balance(db, u) for u in user_ids],
+        ),
+    ):
+        with Session() as db:
+            _reset(db)
+
+            start = time.perf_counter()
+            apply(db, work)
+            elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            balances = read(db)
+            read_elapsed = time.perf_counter() - start
+
+        expected = [
+            5 * (changes // users + (i < changes % users)) for i in range(users)
+        ]
+        assert balances == expected, f"{label} balances are off"
+        print(
+            f"{label:<24} {changes / elapsed:>10.0f} changes/s"
+            f"  {read_elapsed / users * 1e6:>8.1f} us/balance read"
+        )
+
+    Base.metadata.drop_all(bind=engine, tables=TABLES)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        url = sys.argv[1]
+    else:
+        url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'ledger.sqlite')}"
+
+    run(
+        url,
+        changes=int(sys.argv[2]) if len(sys.argv) > 2 else 5000,
+        users=int(sys.argv[3]) if len(sys.argv) > 3 else 50,
+        batch=int(sys.argv[4]) if len(sys.argv) > 4 else 100,
+    )
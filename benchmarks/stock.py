@@ -0,0 +1,121 @@
+"""
+Contention on a hot product's stock: one counter row against sharded rows.
+
+Each thread buys one unit at a time of the same product, committing every
+purchase, until the stock runs out.  Both strategies are checked to sell
+exactly the stock they started with.
+
+SQLite serializes writers on the whole database, so on it sharding can't
+remove the queueing, only show its overhead; the row-level gain needs a
+database with row locks, e.g. ``python -m benchmarks.stock postgresql://...``.
+
+Run with ``python -m benchmarks.stock [database_url] [threads] [stock]``.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, select, update
+from sqlalchemy.orm import sessionmaker
+
+from vending_machine import stock
+from vending_machine.data_objects.product import Product
+from vending_machine.data_objects.stock_shard import StockShard
+from vending_machine.data_objects.user import User
+from vending_machine.database import Base
+
+metadata = MetaData()
+
+counters = Table(
+    "benchmark_stock_counters",
+    metadata,
+    Column("product_id", Integer, primary_key=True),
+    Column("amount", Integer, nullable=False),
+)
+
+
+def _reserve_single_row(db, product_id: int, quantity: int) -> bool:
+    return bool(
+        db.execute(
+            update(counters)
+            .where(counters.c.product_id == product_id, counters.c.amount >= quantity)
+            .values(amount=counters.c.amount - quantity)
+        ).rowcount
+    )
+
+
+def _run(Session, reserve, threads: int) -> tuple[float, int]:
+    sold = [0] * threads
+
+    def buyer(index: int) -> None:
+        db = Session()
+        try:
+            while True:
+                reserved = reserve(db, 1, 1)
+                db.commit()
+                if not reserved:
+                    return
+                sold[index] += 1
+        finally:
+            db.close()
+
+    workers = [threading.Thread(target=buyer, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start, sum(sold)
+
+
+def run(database_url: str, threads: int = 8, initial_stock: int = 4000) -> None:
+    connect_args = {"timeout": 60} if database_url.startswith("sqlite") else {}
+    engine = create_engine(
+        database_url, connect_args=connect_args, pool_size=threads + 1
+    )
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    metadata.create_all(bind=engine)
+    shard_tables = [User.__table__, Product.__table__, StockShard.__table__]
+    Base.metadata.create_all(bind=engine, tables=shard_tables)
+
+    with Session() as db:
+        db.execute(counters.delete())
+        db.execute(counters.insert().values(product_id=1, amount=initial_stock))
+        stock.set_stock(db, 1, initial_stock)
+        db.commit()
+
+    print(f"{threads} threads buying {initial_stock} units of one product\n")
+
+    for label, reserve in (
+        ("single-row counter", _reserve_single_row),
+        ("sharded counter", stock.reserve),
+    ):
+        elapsed, sold = _run(Session, reserve, threads)
+        assert sold == initial_stock, f"{label} sold {sold} of {initial_stock}"
+        print(f"{label:<20} {sold / elapsed:>10.0f} purchases/s")
+
+    with Session() as db:
+        remaining = db.execute(
+            select(counters.c.amount).where(counters.c.product_id == 1)
+        ).scalar_one()
+        assert remaining == 0 and stock.total_stock(db, 1) == 0
+
+    metadata.drop_all(bind=engine)
+    Base.metadata.drop_all(bind=engine, tables=shard_tables)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        url = sys.argv[1]
+    else:
+        url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'stock.sqlite')}"
+
+    run(
+        url,
+        threads=int(sys.argv[2]) if len(sys.argv) > 2 else 8,
+        initial_stock=int(sys.argv[3]) if len(sys.argv) > 3 else 4000,
+    )
@@ -2,7 +2,7 @@
 
 # This script formats the codebase using black and isort.
 
-dirs="migrations vending_machine ./*.py"
+dirs="migrations vending_machine benchmarks ./*.py"
 
 for dir in $dirs; do
     echo "Formatting $dir"
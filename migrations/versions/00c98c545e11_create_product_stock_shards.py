@@ -0,0 +1,47 @@
+"""create product stock shards
+
+Revision ID: 00c98c545e11
+Revises: 749fdada4ce1
+Create Date: 2026-10-19 10:02:47.518233
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+from vending_machine.config import settings
+
+# revision identifiers, used by Alembic.
+revision: str = "00c98c545e11"
+down_revision: Union[str, None] = "749fdada4ce1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "product_stock_shards",
+        sa.Column(
+            "product_id", sa.Integer, sa.ForeignKey("products.id"), primary_key=True
+        ),
+        sa.Column("shard", sa.Integer, primary_key=True),
+        sa.Column("amount", sa.Integer, nullable=False),
+    )
+
+    # Spread each product's current stock across the shards
+    shards = settings.stock_shards
+    for shard in range(shards):
+        op.execute(
+            sa.text(
+                "INSERT INTO product_stock_shards (product_id, shard, amount) "
+                "SELECT id, :shard, amount_available / :shards "
+                "+ (CASE WHEN :shard < amount_available % :shards THEN 1 ELSE 0 END) "
+                "FROM products"
+            ).bindparams(shard=shard, shards=shards)
+        )
+
+
+def downgrade() -> None:
+    op.drop_table("product_stock_shards")
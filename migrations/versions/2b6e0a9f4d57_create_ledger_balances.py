@@ -0,0 +1,42 @@
+"""create ledger balances
+
+Revision ID: 2b6e0a9f4d57
+Revises: 9d3b5f7a1c24
+Create Date: 2026-10-19 18:40:12.873045
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "2b6e0a9f4d57"
+down_revision: Union[str, None] = "9d3b5f7a1c24"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "ledger_balances",
+        sa.Column("user_id", sa.String, sa.ForeignKey("users.id"), primary_key=True),
+        sa.Column("balance", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("entry_id", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("unsnapshotted", sa.Integer, nullable=False, server_default="0"),
+    )
+    # Each user's running balance, and the entries after their latest snapshot
+    op.execute(
+        "INSERT INTO ledger_balances (user_id, balance, entry_id, unsnapshotted) "
+        "SELECT e.user_id, SUM(e.amount), MAX(e.id), "
+        "SUM(e.id > COALESCE(s.entry_id, 0)) "
+        "FROM ledger_entries e LEFT JOIN ("
+        "SELECT user_id, MAX(entry_id) AS entry_id FROM balance_snapshots "
+        "GROUP BY user_id) s ON s.user_id = e.user_id "
+        "GROUP BY e.user_id"
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("ledger_balances")
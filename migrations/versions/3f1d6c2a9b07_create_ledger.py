@@ -0,0 +1,52 @@
+"""create ledger
+
+Revision ID: 3f1d6c2a9b07
+Revises: 81b2b671522c
+Create Date: 2026-10-19 11:02:44.381276
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "3f1d6c2a9b07"
+down_revision: Union[str, None] = "81b2b671522c"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "ledger_entries",
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("user_id", sa.String, sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("session_id", sa.String, nullable=True),
+        sa.Column(
+            "kind",
+            sa.Enum("DEPOSIT", "PURCHASE", "REFUND", name="ledgerkind"),
+            nullable=False,
+        ),
+        sa.Column("amount", sa.Integer, nullable=False),
+        sa.Column(
+            "product_id", sa.Integer, sa.ForeignKey("products.id"), nullable=True
+        ),
+        sa.Column("quantity", sa.Integer, nullable=True),
+        sa.Column("created_at", sa.DateTime, nullable=False),
+    )
+    op.create_index("ix_ledger_entries_user_id_id", "ledger_entries", ["user_id", "id"])
+
+    op.create_table(
+        "balance_snapshots",
+        sa.Column("user_id", sa.String, sa.ForeignKey("users.id"), primary_key=True),
+        sa.Column("entry_id", sa.Integer, primary_key=True),
+        sa.Column("balance", sa.Integer, nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("balance_snapshots")
+    op.drop_index("ix_ledger_entries_user_id_id", "ledger_entries")
+    op.drop_table("ledger_entries")
@@ -0,0 +1,35 @@
+"""add row versions
+
+Revision ID: 5a9c7e31d4f8
+Revises: b84e0f5d2c13
+Create Date: 2026-10-19 13:05:27.614409
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5a9c7e31d4f8"
+down_revision: Union[str, None] = "b84e0f5d2c13"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "products",
+        sa.Column("version", sa.Integer, nullable=False, server_default="1"),
+    )
+    op.add_column(
+        "users",
+        sa.Column("version", sa.Integer, nullable=False, server_default="1"),
+    )
+
+
+def downgrade() -> None:
+    # Dropped in place, as recreating products would drop its search triggers
+    op.drop_column("users", "version")
+    op.drop_column("products", "version")
@@ -0,0 +1,34 @@
+"""create idempotency keys
+
+Revision ID: 749fdada4ce1
+Revises: 968e2513bee9
+Create Date: 2026-10-19 09:40:12.204817
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "749fdada4ce1"
+down_revision: Union[str, None] = "968e2513bee9"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "idempotency_keys",
+        sa.Column("user_id", sa.String, primary_key=True),
+        sa.Column("key", sa.String, primary_key=True),
+        sa.Column("fingerprint", sa.String, nullable=False),
+        sa.Column("status_code", sa.Integer, nullable=True),
+        sa.Column("response_body", sa.LargeBinary, nullable=True),
+        sa.Column("expires_at", sa.DateTime, nullable=False, index=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("idempotency_keys")
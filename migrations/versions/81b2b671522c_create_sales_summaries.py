@@ -0,0 +1,34 @@
+"""create sales summaries
+
+Revision ID: 81b2b671522c
+Revises: 00c98c545e11
+Create Date: 2026-10-19 10:31:05.117942
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "81b2b671522c"
+down_revision: Union[str, None] = "00c98c545e11"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "sales_summaries",
+        sa.Column("seller_id", sa.String, primary_key=True),
+        sa.Column(
+            "product_id", sa.Integer, sa.ForeignKey("products.id"), primary_key=True
+        ),
+        sa.Column("units_sold", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("revenue", sa.Integer, nullable=False, server_default="0"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("sales_summaries")
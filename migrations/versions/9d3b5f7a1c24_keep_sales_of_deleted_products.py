@@ -0,0 +1,102 @@
+"""keep sales of deleted products
+
+Revision ID: 9d3b5f7a1c24
+Revises: e4a8c2d6f913
+Create Date: 2026-10-19 18:12:37.504119
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "9d3b5f7a1c24"
+down_revision: Union[str, None] = "e4a8c2d6f913"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+LEDGER_COLUMNS = (
+    "id, user_id, session_id, kind, amount, product_id, quantity, created_at"
+)
+
+
+def _ledger_table(name: str, product_fk: bool) -> None:
+    op.create_table(
+        name,
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("user_id", sa.String, sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("session_id", sa.String, nullable=True),
+        sa.Column(
+            "kind",
+            sa.Enum("DEPOSIT", "PURCHASE", "REFUND", name="ledgerkind"),
+            nullable=False,
+        ),
+        sa.Column("amount", sa.Integer, nullable=False),
+        sa.Column(
+            "product_id",
+            sa.Integer,
+            *([sa.ForeignKey("products.id")] if product_fk else []),
+            nullable=True,
+        ),
+        sa.Column("quantity", sa.Integer, nullable=True),
+        sa.Column("created_at", sa.DateTime, nullable=False),
+    )
+
+
+def _rebuild_ledger(product_fk: bool) -> None:
+    # SQLite can't drop a foreign key in place, so the table is rebuilt
+    _ledger_table("ledger_entries_rebuilt", product_fk)
+    op.execute(
+        f"INSERT INTO ledger_entries_rebuilt ({LEDGER_COLUMNS}) "
+        f"SELECT {LEDGER_COLUMNS} FROM ledger_entries"
+    )
+    op.drop_index("ix_ledger_entries_user_id_id", "ledger_entries")
+    op.drop_table("ledger_entries")
+    op.rename_table("ledger_entries_rebuilt", "ledger_entries")
+    op.create_index("ix_ledger_entries_user_id_id", "ledger_entries", ["user_id", "id"])
+
+
+def upgrade() -> None:
+    # Summary rows and ledger entries outlive the product they are for, so
+    # product_id stops being a foreign key and the summary keeps the name
+    op.create_table(
+        "sales_summaries_rebuilt",
+        sa.Column("seller_id", sa.String, primary_key=True),
+        sa.Column("product_id", sa.Integer, primary_key=True),
+        sa.Column("product_name", sa.String, nullable=True),
+        sa.Column("units_sold", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("revenue", sa.Integer, nullable=False, server_default="0"),
+    )
+    op.execute(
+        "INSERT INTO sales_summaries_rebuilt "
+        "(seller_id, product_id, product_name, units_sold, revenue) "
+        "SELECT s.seller_id, s.product_id, p.product_name, s.units_sold, s.revenue "
+        "FROM sales_summaries s LEFT JOIN products p ON p.id = s.product_id"
+    )
+    op.drop_table("sales_summaries")
+    op.rename_table("sales_summaries_rebuilt", "sales_summaries")
+
+    _rebuild_ledger(product_fk=False)
+
+
+def downgrade() -> None:
+    _rebuild_ledger(product_fk=True)
+
+    op.create_table(
+        "sales_summaries_rebuilt",
+        sa.Column("seller_id", sa.String, primary_key=True),
+        sa.Column(
+            "product_id", sa.Integer, sa.ForeignKey("products.id"), primary_key=True
+        ),
+        sa.Column("units_sold", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("revenue", sa.Integer, nullable=False, server_default="0"),
+    )
+    op.execute(
+        "INSERT INTO sales_summaries_rebuilt "
+        "(seller_id, product_id, units_sold, revenue) "
+        "SELECT seller_id, product_id, units_sold, revenue FROM sales_summaries"
+    )
+    op.drop_table("sales_summaries")
+    op.rename_table("sales_summaries_rebuilt", "sales_summaries")
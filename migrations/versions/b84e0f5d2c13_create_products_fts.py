@@ -0,0 +1,59 @@
+"""create products fts
+
+Revision ID: b84e0f5d2c13
+Revises: 3f1d6c2a9b07
+Create Date: 2026-10-19 12:14:51.902733
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b84e0f5d2c13"
+down_revision: Union[str, None] = "3f1d6c2a9b07"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index("ix_products_cost", "products", ["cost"])
+    op.create_index("ix_products_seller_id_cost", "products", ["seller_id", "cost"])
+
+    op.execute(
+        "CREATE VIRTUAL TABLE products_fts USING fts5("
+        "product_name, content='products', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    op.execute(
+        "CREATE TRIGGER products_fts_insert AFTER INSERT ON products BEGIN "
+        "INSERT INTO products_fts (rowid, product_name) "
+        "VALUES (new.id, new.product_name); END"
+    )
+    op.execute(
+        "CREATE TRIGGER products_fts_delete AFTER DELETE ON products BEGIN "
+        "INSERT INTO products_fts (products_fts, rowid, product_name) "
+        "VALUES ('delete', old.id, old.product_name); END"
+    )
+    op.execute(
+        "CREATE TRIGGER products_fts_update AFTER UPDATE OF product_name ON products "
+        "BEGIN "
+        "INSERT INTO products_fts (products_fts, rowid, product_name) "
+        "VALUES ('delete', old.id, old.product_name); "
+        "INSERT INTO products_fts (rowid, product_name) "
+        "VALUES (new.id, new.product_name); END"
+    )
+    # Index the products that already exist
+    op.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER products_fts_update")
+    op.execute("DROP TRIGGER products_fts_delete")
+    op.execute("DROP TRIGGER products_fts_insert")
+    op.execute("DROP TABLE products_fts")
+
+    op.drop_index("ix_products_seller_id_cost", "products")
+    op.drop_index("ix_products_cost", "products")
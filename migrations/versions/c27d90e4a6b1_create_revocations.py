@@ -0,0 +1,32 @@
+"""create revocations
+
+Revision ID: c27d90e4a6b1
+Revises: 5a9c7e31d4f8
+Create Date: 2026-10-19 14:22:08.517390
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c27d90e4a6b1"
+down_revision: Union[str, None] = "5a9c7e31d4f8"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "revocations",
+        sa.Column("kind", sa.String, primary_key=True),
+        sa.Column("key", sa.String, primary_key=True),
+        sa.Column("revoked_at", sa.DateTime, nullable=False),
+        sa.Column("expires_at", sa.DateTime, nullable=False, index=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("revocations")
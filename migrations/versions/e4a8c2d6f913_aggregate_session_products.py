@@ -0,0 +1,67 @@
+"""aggregate session products
+
+Revision ID: e4a8c2d6f913
+Revises: c27d90e4a6b1
+Create Date: 2026-10-19 16:05:41.228317
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e4a8c2d6f913"
+down_revision: Union[str, None] = "c27d90e4a6b1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # SQLite can't change a primary key in place, so the table is rebuilt with
+    # one row per product in each session
+    op.create_table(
+        "session_products_aggregated",
+        sa.Column(
+            "session_id", sa.String, sa.ForeignKey("user_sessions.id"), primary_key=True
+        ),
+        sa.Column(
+            "product_id", sa.Integer, sa.ForeignKey("products.id"), primary_key=True
+        ),
+        sa.Column("quantity", sa.Integer, nullable=False, server_default="0"),
+    )
+    op.execute(
+        "INSERT INTO session_products_aggregated (session_id, product_id, quantity) "
+        "SELECT session_id, product_id, COUNT(*) FROM session_products "
+        "GROUP BY session_id, product_id"
+    )
+    op.drop_table("session_products")
+    op.rename_table("session_products_aggregated", "session_products")
+
+
+def downgrade() -> None:
+    op.create_table(
+        "session_products_units",
+        sa.Column("id", sa.String, primary_key=True),
+        sa.Column(
+            "session_id", sa.String, sa.ForeignKey("sessions.id"), nullable=False
+        ),
+        sa.Column(
+            "product_id", sa.String, sa.ForeignKey("products.id"), nullable=False
+        ),
+    )
+    # Back to one row per unit
+    op.execute(
+        "WITH RECURSIVE units (session_id, product_id, unit) AS ("
+        "SELECT session_id, product_id, 1 FROM session_products WHERE quantity > 0 "
+        "UNION ALL "
+        "SELECT units.session_id, units.product_id, unit + 1 FROM units "
+        "JOIN session_products USING (session_id, product_id) "
+        "WHERE unit < quantity) "
+        "INSERT INTO session_products_units (id, session_id, product_id) "
+        "SELECT session_id || ':' || product_id || ':' || unit, session_id, product_id "
+        "FROM units"
+    )
+    op.drop_table("session_products")
+    op.rename_table("session_products_units", "session_products")
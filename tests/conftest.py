@@ -0,0 +1,10 @@
+# The database and client fixtures, for every test module
+from tests.fixtures import (  # noqa: F401
+    app_settings,
+    db,
+    engine,
+    session_local,
+    template_db,
+    test_app,
+    test_client,
+)
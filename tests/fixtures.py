@@ -1,44 +1,94 @@
 import pytest
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Engine, create_engine
+from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.pool import StaticPool
 
-from vending_machine.database import Base, SessionLocal, get_db
+from vending_machine import database, revocation
+from vending_machine.config import settings
+from vending_machine.database import Base, SessionLocal, clone, get_db, snapshot
+from vending_machine.live import live_hub
+from vending_machine.login_guard import login_guard
 from vending_machine.main import main
+from vending_machine.revocation import revocation_list
 
 from datetime import datetime, timedelta
 from vending_machine.models.product import Product
 from vending_machine.models.session import UserSession
 
 
-@pytest.fixture
-def test_client() -> TestClient:
-    app = main(testing=True)
-
-    SQLALCHEMY_DATABASE_URL = "sqlite://"  # in-memory database for testing
-
+@pytest.fixture(scope="session")
+def template_db():
+    # The schema is created once, and each test gets a copy of it
     engine = create_engine(
-        SQLALCHEMY_DATABASE_URL,
+        "sqlite://",  # in-memory database for testing
         connect_args={"check_same_thread": False},
         poolclass=StaticPool,
     )
+    Base.metadata.create_all(bind=engine)
+
+    template = snapshot(engine)
+    engine.dispose()
+    yield template
+    template.close()
+
+
+@pytest.fixture
+def engine(template_db) -> Engine:
+    # A fresh copy of the schema for each test
+    engine = clone(template_db)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db(engine: Engine) -> Session:
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def session_local(engine: Engine, monkeypatch) -> sessionmaker:
+    # Also used by the code that opens sessions of its own, outside a request
     TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    monkeypatch.setattr(database, "SessionLocal", TestingSessionLocal)
+    monkeypatch.setattr(revocation, "SessionLocal", TestingSessionLocal)
+    monkeypatch.setattr(live_hub, "session_factory", TestingSessionLocal)
+    return TestingSessionLocal
+
+
+@pytest.fixture
+def app_settings() -> dict:
+    # Settings the app is built with; modules override this to change them
+    return {}
 
-    Base.metadata.create_all(bind=engine)
+
+@pytest.fixture
+def test_app(session_local: sessionmaker, app_settings: dict, monkeypatch) -> FastAPI:
+    for name, value in app_settings.items():
+        monkeypatch.setattr(settings, name, value)
+    login_guard.clear()
+    revocation_list.clear()
+
+    app = main()
 
     def override_get_db():
         try:
-            db = TestingSessionLocal()
+            db = session_local()
             yield db
         finally:
             db.close()
 
     app.dependency_overrides[get_db] = override_get_db
 
-    client = TestClient(app)
+    return app
 
-    return client
+
+@pytest.fixture
+def test_client(test_app: FastAPI) -> TestClient:
+    return TestClient(test_app)
 
 
 @pytest.fixture
@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+import pytest
+from pydantic import ValidationError
+
+from vending_machine.data_objects.role import Role
+from vending_machine.models.conversion import (
+    list_adapter,
+    product_from_orm,
+    products_from_orm,
+    user_from_orm,
+)
+from vending_machine.models.product import Product
+
+
+def _product_row(**overrides) -> SimpleNamespace:
+    row = {
+        "id": 1,
+        "amount_available": 3,
+        "cost": 50,
+        "product_name": "Cola",
+        "seller_id": 2,
+    }
+    row.update(overrides)
+    return SimpleNamespace(**row)
+
+
+@pytest.mark.parametrize("trusted", [True, False])
+def test_products_are_mapped_to_api_aliases(trusted: bool) -> None:
+    product = product_from_orm(_product_row(), trusted=trusted)
+
+    assert isinstance(product, Product)
+    assert product.model_dump() == {
+        "id": "1",
+        "amountAvailable": 3,
+        "cost": 50,
+        "productName": "Cola",
+        "sellerId": "2",
+    }
+
+
+def test_trusted_and_validated_conversions_agree() -> None:
+    rows = [_product_row(id=i, product_name=f"Product {i}") for i in range(5)]
+
+    trusted = products_from_orm(rows)
+    validated = products_from_orm(rows, trusted=False)
+
+    assert [p.model_dump() for p in trusted] == [p.model_dump() for p in validated]
+
+
+def test_untrusted_rows_are_validated() -> None:
+    with pytest.raises(ValidationError):
+        products_from_orm([_product_row(cost=7)], trusted=False)
+
+
+def test_user_roles_are_stored_as_values() -> None:
+    row = SimpleNamespace(
+        id="abc", username="buyer", role=Role.BUYER, deposit=0, hashed_password="x"
+    )
+
+    user = user_from_orm(row)
+
+    assert user.role == "BUYER"
+    assert user.model_dump() == user_from_orm(row, trusted=False).model_dump()
+
+
+def test_adapters_are_cached() -> None:
+    assert list_adapter(Product) is list_adapter(Product)
@@ -0,0 +1,164 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import sessionmaker
+
+from vending_machine import database, ledger
+from vending_machine.authentication import get_password_hash
+from vending_machine.config import settings
+from vending_machine.data_objects.role import Role
+from vending_machine.data_objects.user import User
+from vending_machine.database import get_db
+
+
+@pytest.fixture
+def engine(engine):
+    session = sessionmaker(bind=engine)()
+    session.add(
+        User(
+            id="u1",
+            username="buyer",
+            deposit=0,
+            role=Role.BUYER,
+            hashed_password=get_password_hash("password"),
+        )
+    )
+    session.commit()
+    session.close()
+    return engine
+
+
+@pytest.fixture
+def session_local(session_local, monkeypatch):
+    opened = []
+
+    def counting_session_local():
+        opened.append(1)
+        return session_local()
+
+    monkeypatch.setattr(database, "SessionLocal", counting_session_local)
+    session_local.opened = opened
+    return session_local
+
+
+@pytest.fixture
+def app_settings() -> dict:
+    return {"stateless_sessions": True}
+
+
+@pytest.fixture
+def test_app(test_app):
+    # get_db itself is used, so the sub-requests can share the batch's session
+    del test_app.dependency_overrides[get_db]
+    return test_app
+
+
+@pytest.fixture
+def headers(test_client: TestClient) -> dict:
+    response = test_client.post(
+        "/auth/token", data={"username": "buyer", "password": "password"}
+    )
+    assert response.status_code == 200
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def _balance(session_local) -> int:
+    session = session_local()
+    try:
+        return ledger.balance(session, "u1")
+    finally:
+        session.close()
+
+
+def test_sub_requests_share_the_user_and_session(
+    test_client: TestClient, session_local, headers: dict
+) -> None:
+    session_local.opened.clear()
+
+    response = test_client.post(
+        "/batch",
+        json={
+            "requests": [
+                {"method": "POST", "path": "/auth/whoami"},
+                {"method": "POST", "path": "/machine/deposit?amount=5"},
+                {"method": "POST", "path": "/machine/deposit?amount=10"},
+            ]
+        },
+        headers=headers,
+    )
+
+    assert response.status_code == 200
+    body = response.json()
+    assert [r["status"] for r in body["responses"]] == [200, 200, 200]
+    assert body["responses"][0]["body"]["username"] == "buyer"
+    assert body["rolledBack"] is False
+    assert session_local.opened == [1]
+    assert _balance(session_local) == 15
+
+
+def test_failures_dont_stop_a_batch(
+    test_client: TestClient, session_local, headers: dict
+) -> None:
+    response = test_client.post(
+        "/batch",
+        json={
+            "requests": [
+                {"path": "/nowhere"},
+                {"method": "POST", "path": "/batch", "body": {"requests": []}},
+                {"method": "POST", "path": "/machine/deposit?amount=5"},
+            ]
+        },
+        headers=headers,
+    )
+
+    statuses = [r["status"] for r in response.json()["responses"]]
+    assert statuses == [404, 400, 200]
+    assert _balance(session_local) == 5
+
+
+def test_atomic_batch_rolls_back_at_the_first_failure(
+    test_client: TestClient, session_local, headers: dict
+) -> None:
+    response = test_client.post(
+        "/batch",
+        json={
+            "atomic": True,
+            "requests": [
+                {"method": "POST", "path": "/machine/deposit?amount=5"},
+                {"method": "POST", "path": "/machine/deposit?amount=3"},
+                {"method": "POST", "path": "/machine/deposit?amount=10"},
+            ],
+        },
+        headers=headers,
+    )
+
+    body = response.json()
+    assert [r["status"] for r in body["responses"]] == [200, 500, 424]
+    assert body["rolledBack"] is True
+    assert _balance(session_local) == 0
+
+    response = test_client.post(
+        "/batch",
+        json={
+            "atomic": True,
+            "requests": [
+                {"method": "POST", "path": "/machine/deposit?amount=5"},
+                {"method": "POST", "path": "/machine/deposit?amount=10"},
+            ],
+        },
+        headers=headers,
+    )
+    assert response.json()["rolledBack"] is False
+    assert _balance(session_local) == 15
+
+
+def test_batch_size_is_limited(
+    test_client: TestClient, headers: dict, monkeypatch
+) -> None:
+    monkeypatch.setattr(settings, "batch_max_requests", 2)
+
+    response = test_client.post(
+        "/batch",
+        json={"requests": [{"method": "POST", "path": "/auth/whoami"}] * 3},
+        headers=headers,
+    )
+    assert response.status_code == 413
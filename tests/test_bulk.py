@@ -0,0 +1,100 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import select
+
+from vending_machine import bulk, stock
+from vending_machine.config import settings
+from vending_machine.data_objects.product import Product
+from vending_machine.invalidation import PRODUCTS
+
+
+async def _stream(body: bytes, size: int = 7):
+    # Small chunks, so rows and characters are split across them
+    for start in range(0, len(body), size):
+        yield body[start : start + size]
+
+
+def _import(db, content_type: str, body: bytes):
+    return asyncio.run(
+        bulk.import_products(db, "seller", bulk.records(content_type, _stream(body)))
+    )
+
+
+def test_csv_import_reports_bad_rows_and_keeps_the_rest(db, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "bulk_chunk_size", 2)
+    body = (
+        "productName,cost,amountAvailable\r\n"
+        'Cola,5,10\r\n"Crisps, salted",20,3\r\n'
+        "Gum,7,1\r\n"
+        '"Two\nlines",10,2\r\n'
+        "Short,5\r\n"
+        "Café,50,0"
+    ).encode()
+
+    published = []
+    monkeypatch.setattr(
+        bulk.invalidation_bus, "publish", lambda *event: published.append(event)
+    )
+    result = _import(db, "text/csv; charset=utf-8", body)
+
+    assert (result.created, result.failed) == (4, 2)
+    # One event for each chunk stored
+    assert published == [(PRODUCTS,)] * 3
+    assert [error.row for error in result.errors] == [4, 7]
+    assert result.errors[0].errors[0]["loc"] == ("cost",)
+    assert result.errors[1].errors == ["Expected 3 fields, got 2"]
+
+    products = db.execute(select(Product).order_by(Product.id)).scalars().all()
+    assert [p.product_name for p in products] == [
+        "Cola",
+        "Crisps, salted",
+        "Two\nlines",
+        "Café",
+    ]
+    assert {p.seller_id for p in products} == {"seller"}
+    assert stock.stock_totals(db) == {p.id: p.amount_available for p in products}
+
+
+def test_ndjson_import(db) -> None:
+    body = "\n".join(
+        [
+            json.dumps({"productName": "Cola", "cost": 5, "amountAvailable": 10}),
+            "{not json",
+            "[1, 2]",
+            "",
+            json.dumps({"productName": "", "cost": 5, "amountAvailable": 1}),
+            json.dumps({"productName": "Gum", "cost": 10, "amountAvailable": 4}),
+        ]
+    ).encode()
+
+    result = _import(db, "application/x-ndjson", body)
+
+    assert (result.created, result.failed) == (2, 3)
+    assert [error.row for error in result.errors] == [2, 3, 5]
+    assert stock.stock_totals(db) == {1: 10, 2: 4}
+
+
+def test_errors_reported_are_capped(db, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "bulk_max_errors", 2)
+
+    result = _import(
+        db, "text/csv", b"productName,cost,amountAvailable\n" + b"x,1,1\n" * 5
+    )
+
+    assert result.failed == 5
+    assert len(result.errors) == 2
+    assert result.errorsTruncated
+
+
+def test_rejects_other_types_and_overlong_rows(db, monkeypatch) -> None:
+    with pytest.raises(HTTPException) as e:
+        _import(db, "application/json", b"[]")
+    assert e.value.status_code == 415
+
+    monkeypatch.setattr(settings, "bulk_max_line_length", 20)
+    with pytest.raises(HTTPException) as e:
+        _import(db, "text/csv", b"productName,cost\n" + b"x" * 50)
+    assert e.value.status_code == 413
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event, select
+from sqlalchemy.orm import sessionmaker
+
+from vending_machine import cart, stock
+from vending_machine.authentication import get_buyer_or_seller_user, get_buyer_user
+from vending_machine.data_objects.product import Product
+from vending_machine.data_objects.role import Role
+from vending_machine.data_objects.session import UserSession
+from vending_machine.data_objects.session_product import SessionProduct
+from vending_machine.data_objects.user import User
+from vending_machine.models.user import UserWithoutPassword
+
+
+@pytest.fixture
+def engine(engine):
+    session = sessionmaker(bind=engine)()
+    session.add(
+        User(id="u1", username="buyer", deposit=0, role=Role.BUYER, hashed_password="")
+    )
+    session.add_all(
+        [
+            Product(
+                id=1, amount_available=500, cost=5, product_name="Cola", seller_id="s1"
+            ),
+            Product(
+                id=2, amount_available=500, cost=10, product_name="Gum", seller_id="s1"
+            ),
+        ]
+    )
+    stock.set_stocks(session, {1: 500, 2: 500})
+    session.add(
+        UserSession(
+            id="s1",
+            user_id="u1",
+            expiry_time=datetime.now() + timedelta(hours=1),
+            deposited_amount=0,
+        )
+    )
+    session.commit()
+    session.close()
+    return engine
+
+
+def test_units_are_aggregated_per_product(db) -> None:
+    for _ in range(200):
+        cart.add(db, "s1", 1, 1)
+    cart.add(db, "s1", 2, 3)
+    db.commit()
+
+    rows = db.execute(
+        select(SessionProduct.product_id, SessionProduct.quantity).order_by(
+            SessionProduct.product_id
+        )
+    ).all()
+    assert rows == [(1, 200), (2, 3)]
+
+
+def test_cart_is_loaded_in_one_query(engine, db) -> None:
+    cart.add(db, "s1", 1, 200)
+    cart.add(db, "s1", 2, 1)
+    db.commit()
+    db.expunge_all()
+
+    statements = []
+    event.listen(
+        engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    user_session = db.get(UserSession, "s1", options=[cart.CART])
+    items = cart.items(user_session)
+
+    # The session, then its cart with the products joined in
+    assert len(statements) == 2
+    assert [(item.productName, item.quantity) for item in items] == [
+        ("Cola", 200),
+        ("Gum", 1),
+    ]
+
+
+def test_purchases_fill_the_cart_and_reset_empties_it(test_client: TestClient) -> None:
+    def override_user():
+        return UserWithoutPassword(id="u1", username="buyer", role="BUYER")
+
+    test_client.app.dependency_overrides[get_buyer_user] = override_user
+    test_client.app.dependency_overrides[get_buyer_or_seller_user] = override_user
+
+    assert test_client.post("/machine/deposit?amount=100").status_code == 200
+    response = test_client.get("/machine/buy/1/2")
+    assert response.status_code == 200
+    assert response.json()["amountAvailable"] == 498
+    assert test_client.get("/products/1").json()["amountAvailable"] == 498
+    assert test_client.get("/machine/buy/1/3").status_code == 200
+    assert test_client.get("/machine/buy/2/1").status_code == 200
+
+    response = test_client.get("/machine/products")
+    assert response.status_code == 200
+    assert response.json() == [
+        {"productId": "1", "productName": "Cola", "cost": 5, "quantity": 5},
+        {"productId": "2", "productName": "Gum", "cost": 10, "quantity": 1},
+    ]
+
+    assert test_client.get("/machine/reset").status_code == 200
+    assert test_client.get("/machine/products").json() == []
@@ -0,0 +1,110 @@
+import gzip
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+from vending_machine import compression
+from vending_machine.compression import CompressionMiddleware, negotiate
+
+CATALOGUE = [{"productName": f"Product {i}", "cost": 5} for i in range(100)]
+
+
+def _app(versions: dict[str, int]) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/products")
+    async def products():
+        return CATALOGUE
+
+    @app.get("/small")
+    async def small():
+        return {"ok": True}
+
+    @app.get("/stream")
+    async def stream():
+        return StreamingResponse(iter([b"x" * 2000, b"y" * 2000]))
+
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=500,
+        level=6,
+        cacheable={"/products": "products"},
+        version=lambda topic: versions[topic],
+    )
+    return app
+
+
+def test_negotiate() -> None:
+    assert negotiate("gzip, deflate, br") == "gzip"
+    assert negotiate("deflate;q=1, gzip;q=0.5") == "deflate"
+    assert negotiate("gzip;q=0, *") == "deflate"
+    assert negotiate("br") is None
+    assert negotiate("identity") is None
+    assert negotiate(None) is None
+
+
+def test_compresses_large_responses_only() -> None:
+    client = TestClient(_app({"products": 1}))
+
+    response = client.get("/products", headers={"Accept-Encoding": "deflate"})
+    assert response.headers["Content-Encoding"] == "deflate"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert response.json() == CATALOGUE
+
+    small = client.get("/small", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers
+
+    plain = client.get("/products", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in plain.headers
+    assert plain.json() == CATALOGUE
+
+    streamed = client.get("/stream", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in streamed.headers
+    assert streamed.content == b"x" * 2000 + b"y" * 2000
+
+
+def test_catalogue_is_compressed_once_per_version(monkeypatch) -> None:
+    versions = {"products": 1}
+    client = TestClient(_app(versions))
+
+    calls = []
+
+    def counting_compress(body, encoding, level):
+        calls.append(encoding)
+        return gzip.compress(body, level, mtime=0)
+
+    monkeypatch.setattr(compression, "compress", counting_compress)
+
+    for _ in range(3):
+        client.get("/products", headers={"Accept-Encoding": "gzip"})
+    assert calls == ["gzip"]
+
+    versions["products"] = 2
+    client.get("/products", headers={"Accept-Encoding": "gzip"})
+    assert calls == ["gzip", "gzip"]
+
+    # A different body under the same version is compressed afresh
+    CATALOGUE.append({"productName": "New", "cost": 10})
+    try:
+        response = client.get("/products", headers={"Accept-Encoding": "gzip"})
+    finally:
+        CATALOGUE.pop()
+    assert calls == ["gzip", "gzip", "gzip"]
+    assert response.json()[-1]["productName"] == "New"
+
+
+def test_content_encoding_survives_default_content_type() -> None:
+    from vending_machine.main import main
+
+    app = main()
+
+    @app.get("/large")
+    async def large():
+        return CATALOGUE
+
+    response = TestClient(app).get("/large", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.json() == CATALOGUE
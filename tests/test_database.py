@@ -0,0 +1,158 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from vending_machine import cli, database, revocation, search
+from vending_machine.authentication import get_password_hash
+from vending_machine.config import settings
+from vending_machine.data_objects.product import Product
+from vending_machine.data_objects.role import Role
+from vending_machine.data_objects.user import User
+from vending_machine.database import clone, restore, snapshot
+from vending_machine.login_guard import login_guard
+from vending_machine.main import main
+
+
+@pytest.fixture
+def template(engine):
+    session = sessionmaker(bind=engine)()
+    session.add_all(
+        [
+            Product(
+                id=1, amount_available=10, cost=5, product_name="Cola", seller_id="s1"
+            ),
+            Product(
+                id=2, amount_available=10, cost=20, product_name="Gum", seller_id="s1"
+            ),
+        ]
+    )
+    session.commit()
+    session.close()
+
+    template = snapshot(engine)
+    yield template
+    template.close()
+
+
+def _names(engine) -> list[str]:
+    session = sessionmaker(bind=engine)()
+    try:
+        return list(session.scalars(select(Product.product_name).order_by(Product.id)))
+    finally:
+        session.close()
+
+
+def test_clones_are_independent(template) -> None:
+    first = clone(template)
+    second = clone(template)
+
+    session = sessionmaker(bind=first)()
+    session.query(Product).delete()
+    session.commit()
+    session.close()
+
+    assert _names(first) == []
+    assert _names(second) == ["Cola", "Gum"]
+
+
+def test_clone_keeps_the_search_index(template) -> None:
+    session = sessionmaker(bind=clone(template))()
+    result = search.search_products(session, "col")
+    session.close()
+
+    assert [product.productName for product in result.products] == ["Cola"]
+
+
+def test_restore_replaces_the_contents(template) -> None:
+    engine = clone(template)
+    session = sessionmaker(bind=engine)()
+    session.add(
+        Product(id=3, amount_available=1, cost=5, product_name="Tea", seller_id="s1")
+    )
+    session.commit()
+    session.close()
+
+    restore(template, engine)
+    assert _names(engine) == ["Cola", "Gum"]
+
+
+def test_reset_to_snapshot_command(template, tmp_path, monkeypatch) -> None:
+    engine = create_engine(f"sqlite:///{tmp_path / 'db.sqlite'}")
+    restore(template, engine)
+    monkeypatch.setattr(cli, "engine", engine)
+    # This process's revocations are reloaded from the reset database too
+    monkeypatch.setattr(revocation, "SessionLocal", sessionmaker(bind=engine))
+
+    path = str(tmp_path / "seeded.sqlite")
+    assert cli.main(["snapshot", path]) == 0
+
+    session = sessionmaker(bind=engine)()
+    session.query(Product).filter(Product.id == 1).delete()
+    session.commit()
+    assert session.scalar(select(func.count(Product.id))) == 1
+    session.close()
+
+    assert cli.main(["reset-to-snapshot", path]) == 0
+    assert _names(engine) == ["Cola", "Gum"]
+
+    # A path that isn't there leaves the database as it is
+    typo = tmp_path / "seedde.sqlite"
+    assert cli.main(["reset-to-snapshot", str(typo)]) == 1
+    assert not typo.exists()
+    assert _names(engine) == ["Cola", "Gum"]
+
+
+@pytest.fixture
+def opened(template, monkeypatch) -> list:
+    TestingSessionLocal = sessionmaker(
+        autocommit=False, autoflush=False, bind=clone(template)
+    )
+    session = TestingSessionLocal()
+    session.add(
+        User(
+            id="u1",
+            username="buyer",
+            deposit=0,
+            role=Role.BUYER,
+            hashed_password=get_password_hash("password"),
+        )
+    )
+    session.commit()
+    session.close()
+
+    opened = []
+
+    def counting_session_local():
+        opened.append(1)
+        return TestingSessionLocal()
+
+    monkeypatch.setattr(database, "SessionLocal", counting_session_local)
+    monkeypatch.setattr(settings, "stateless_sessions", False)
+    login_guard.clear()
+    return opened
+
+
+def test_rejected_requests_open_no_session(opened: list) -> None:
+    client = TestClient(main())
+
+    assert client.get("/products").status_code == 401
+    response = client.get("/products", headers={"Authorization": "Bearer nonsense"})
+    assert response.status_code == 401
+    assert opened == []
+
+
+def test_auth_chain_shares_the_request_session(opened: list) -> None:
+    client = TestClient(main())
+    response = client.post(
+        "/auth/token", data={"username": "buyer", "password": "password"}
+    )
+    assert response.status_code == 200
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    opened.clear()
+
+    response = client.get("/products", headers=headers)
+    assert response.status_code == 200
+    assert [p["productName"] for p in response.json()] == ["Cola", "Gum"]
+    # The user lookup and the handler ran on the same session
+    assert opened == [1]
@@ -0,0 +1,76 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from vending_machine import authentication, etag
+from vending_machine.models.user import UserWithoutPassword
+
+
+@pytest.fixture
+def test_app(test_app):
+    seller = UserWithoutPassword(id="s1", username="seller", role="SELLER")
+    test_app.dependency_overrides[authentication.get_seller_user] = lambda: seller
+    test_app.dependency_overrides[authentication.get_buyer_or_seller_user] = (
+        lambda: seller
+    )
+    return test_app
+
+
+def test_matches() -> None:
+    assert etag.matches('"1-5"', '"1-5"')
+    assert etag.matches('"0-1", W/"1-5"', '"1-5"')
+    assert etag.matches("*", '"1-5"')
+    assert not etag.matches('"1-4"', '"1-5"')
+    assert not etag.matches(None, '"1-5"')
+
+    # If-Match compares strongly
+    assert etag.matches('"0-1", "1-5"', '"1-5"', strong=True)
+    assert not etag.matches('W/"1-5"', '"1-5"', strong=True)
+    assert etag.matches("*", '"1-5"', strong=True)
+
+
+def test_product_reads_are_conditional(test_client: TestClient) -> None:
+    test_client.post(
+        "/products/create",
+        json={"amountAvailable": 5, "cost": 10, "productName": "Cola"},
+    )
+
+    first = test_client.get("/products/1")
+    tag = first.headers["ETag"]
+    assert first.status_code == 200
+
+    unchanged = test_client.get("/products/1", headers={"If-None-Match": tag})
+    assert unchanged.status_code == 304
+    assert unchanged.content == b""
+    assert unchanged.headers["ETag"] == tag
+
+    test_client.put(
+        "/products/1", json={"amountAvailable": 5, "cost": 15, "productName": "Cola"}
+    )
+    changed = test_client.get("/products/1", headers={"If-None-Match": tag})
+    assert changed.status_code == 200
+    assert changed.json()["cost"] == 15
+    assert changed.headers["ETag"] != tag
+
+
+def test_product_updates_honour_if_match(test_client: TestClient) -> None:
+    test_client.post(
+        "/products/create",
+        json={"amountAvailable": 5, "cost": 10, "productName": "Cola"},
+    )
+    tag = test_client.get("/products/1").headers["ETag"]
+    update = {"amountAvailable": 5, "cost": 20, "productName": "Cola"}
+
+    weak = test_client.put("/products/1", json=update, headers={"If-Match": f"W/{tag}"})
+    assert weak.status_code == 412
+
+    first = test_client.put("/products/1", json=update, headers={"If-Match": tag})
+    assert first.status_code == 200
+    assert first.headers["ETag"] == test_client.get("/products/1").headers["ETag"]
+
+    # A second edit based on the same read is refused
+    stale = test_client.put(
+        "/products/1", json={**update, "cost": 25}, headers={"If-Match": tag}
+    )
+    assert stale.status_code == 412
+    assert stale.headers["ETag"] == first.headers["ETag"]
+    assert test_client.get("/products/1").json()["cost"] == 20
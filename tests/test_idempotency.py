@@ -0,0 +1,138 @@
+import asyncio
+import json
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+from vending_machine.data_objects.idempotency_key import IdempotencyKey
+from vending_machine.idempotency import REPLAYED_HEADER, IdempotencyStore
+
+
+@pytest.fixture
+def store() -> IdempotencyStore:
+    return IdempotencyStore(ttl=60, max_entries=10)
+
+
+def _handler(calls: list, result=None, delay: float = 0):
+    async def execute(session):
+        calls.append(1)
+        await asyncio.sleep(delay)
+        session.commit()
+        return result if result is not None else {"deposited": len(calls)}
+
+    return execute
+
+
+def test_without_key_runs_every_time(db, store: IdempotencyStore) -> None:
+    calls = []
+
+    async def scenario():
+        await store.run(db, "u1", None, "deposit:5", _handler(calls))
+        return await store.run(db, "u1", None, "deposit:5", _handler(calls))
+
+    assert asyncio.run(scenario()) == {"deposited": 2}
+
+
+def test_replays_stored_response(db, store: IdempotencyStore) -> None:
+    calls = []
+
+    async def scenario():
+        first = await store.run(db, "u1", "k1", "deposit:5", _handler(calls))
+        second = await store.run(db, "u1", "k1", "deposit:5", _handler(calls))
+        return first, second
+
+    first, second = asyncio.run(scenario())
+
+    assert len(calls) == 1
+    assert json.loads(first.body) == json.loads(second.body) == {"deposited": 1}
+    assert second.headers[REPLAYED_HEADER] == "true"
+
+
+def test_replays_from_table_after_cache_is_lost(db, store: IdempotencyStore) -> None:
+    calls = []
+
+    async def scenario():
+        await store.run(db, "u1", "k1", "deposit:5", _handler(calls))
+        store.clear()
+        return await store.run(db, "u1", "k1", "deposit:5", _handler(calls))
+
+    assert json.loads(asyncio.run(scenario()).body) == {"deposited": 1}
+    assert len(calls) == 1
+
+
+def test_concurrent_duplicates_coalesce(db, store: IdempotencyStore) -> None:
+    calls = []
+
+    async def scenario():
+        return await asyncio.gather(
+            *(
+                store.run(db, "u1", "k1", "buy:1:1", _handler(calls, delay=0.01))
+                for _ in range(5)
+            )
+        )
+
+    responses = asyncio.run(scenario())
+
+    assert len(calls) == 1
+    assert len({response.body for response in responses}) == 1
+
+
+def test_keys_are_scoped_per_user(db, store: IdempotencyStore) -> None:
+    calls = []
+
+    async def scenario():
+        await store.run(db, "u1", "k1", "deposit:5", _handler(calls))
+        await store.run(db, "u2", "k1", "deposit:5", _handler(calls))
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+
+
+def test_key_cannot_be_reused_for_another_request(db, store: IdempotencyStore) -> None:
+    calls = []
+
+    async def scenario():
+        await store.run(db, "u1", "k1", "deposit:5", _handler(calls))
+        await store.run(db, "u1", "k1", "deposit:10", _handler(calls))
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(scenario())
+    assert e.value.status_code == 422
+
+
+def test_failures_are_not_stored(db, store: IdempotencyStore) -> None:
+    calls = []
+
+    async def failing(session):
+        calls.append(1)
+        raise HTTPException(status_code=400, detail="Insufficient funds")
+
+    async def scenario():
+        with pytest.raises(HTTPException):
+            await store.run(db, "u1", "k1", "buy:1:1", failing)
+        return await store.run(db, "u1", "k1", "buy:1:1", _handler(calls))
+
+    assert json.loads(asyncio.run(scenario()).body) == {"deposited": 2}
+    assert db.query(IdempotencyKey).count() == 1
+
+
+def test_work_and_response_are_committed_together(db, store: IdempotencyStore) -> None:
+    async def execute(session):
+        # Stands in for the handler's own writes, committed by the handler
+        session.add(
+            IdempotencyKey(
+                user_id="u1", key="work", fingerprint="", expires_at=datetime.max
+            )
+        )
+        session.commit()
+        # A response that can't be stored, like a crash before it is written
+        return object()
+
+    async def scenario():
+        await store.run(db, "u1", "k1", "deposit:5", execute)
+
+    with pytest.raises(Exception):
+        asyncio.run(scenario())
+    # Neither the work nor a claim without a response was left behind
+    assert db.query(IdempotencyKey).count() == 0
@@ -0,0 +1,109 @@
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+from vending_machine.invalidation import PRODUCTS, InvalidationBus, InvalidationEvent
+
+WORKERS = 4
+
+
+def _worker(directory, worker_id, barrier, results) -> None:
+    bus = InvalidationBus(directory)
+    seen = {}
+    converged = threading.Event()
+
+    def on_event(event: InvalidationEvent) -> None:
+        seen[event.key] = event.version
+        if len(seen) == WORKERS + 1:
+            converged.set()
+
+    bus.subscribe(PRODUCTS, on_event)
+    bus.start()
+    barrier.wait()
+
+    bus.publish(PRODUCTS, f"product-{worker_id}")
+    converged.wait(10)
+
+    # Stay on the bus until everyone has converged
+    barrier.wait()
+    results.put((worker_id, seen, bus.version(PRODUCTS)))
+    bus.stop()
+
+
+def test_workers_converge(tmp_path) -> None:
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(WORKERS + 1)
+    results = context.Queue()
+
+    bus = InvalidationBus(str(tmp_path))
+    seen = {}
+    bus.subscribe(PRODUCTS, lambda event: seen.__setitem__(event.key, event.version))
+    bus.start()
+
+    workers = [
+        context.Process(target=_worker, args=(str(tmp_path), i, barrier, results))
+        for i in range(WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+
+    barrier.wait()
+    bus.publish(PRODUCTS, "product-parent")
+    barrier.wait()
+
+    worker_results = [results.get(timeout=10) for _ in workers]
+    for worker in workers:
+        worker.join(timeout=10)
+        assert worker.exitcode == 0
+    bus.stop()
+
+    assert len(seen) == WORKERS + 1
+    for worker_id, worker_seen, version in worker_results:
+        assert worker_seen == seen, f"worker {worker_id} did not converge"
+        assert version == max(seen.values())
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_stale_events_are_dropped(tmp_path) -> None:
+    bus = InvalidationBus(str(tmp_path))
+    applied = []
+    bus.subscribe(PRODUCTS, applied.append)
+
+    newer = InvalidationEvent(PRODUCTS, "1", 200, os.getpid())
+    older = InvalidationEvent(PRODUCTS, "1", 100, os.getpid())
+    other_key = InvalidationEvent(PRODUCTS, "2", 150, os.getpid())
+
+    assert bus._deliver(newer)
+    assert not bus._deliver(older)
+    assert not bus._deliver(newer)
+    assert bus._deliver(other_key)
+
+    assert applied == [newer, other_key]
+    assert bus.version(PRODUCTS) == 200
+
+
+def test_dead_workers_are_pruned(tmp_path) -> None:
+    bus = InvalidationBus(str(tmp_path))
+    (tmp_path / "99999999.sock").touch()
+
+    bus.publish(PRODUCTS, "1")
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_bus_directory_is_kept_private(tmp_path) -> None:
+    directory = tmp_path / "bus"
+    directory.mkdir(mode=0o777)
+    os.chmod(directory, 0o777)
+
+    bus = InvalidationBus(str(directory))
+    bus.start()
+    bus.stop()
+    assert directory.stat().st_mode & 0o777 == 0o700
+
+    link = tmp_path / "link"
+    link.symlink_to(directory)
+    with pytest.raises(PermissionError):
+        InvalidationBus(str(link)).start()
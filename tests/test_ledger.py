@@ -0,0 +1,85 @@
+from sqlalchemy import event, func, select
+
+from vending_machine import ledger
+from vending_machine.config import settings
+from vending_machine.data_objects.balance_snapshot import BalanceSnapshot
+from vending_machine.data_objects.ledger_entry import LedgerEntry
+from vending_machine.data_objects.ledger_kind import LedgerKind
+
+
+def test_balance_follows_deposits_purchases_and_refunds(db) -> None:
+    ledger.deposit(db, "u1", 100)
+    ledger.deposit(db, "u1", 50)
+    ledger.purchase(db, "u1", product_id=1, quantity=3, cost=20)
+    ledger.deposit(db, "u2", 5)
+
+    assert ledger.balance(db, "u1") == 90
+    assert ledger.balance(db, "u2") == 5
+
+    ledger.refund(db, "u1", 90)
+
+    assert ledger.balance(db, "u1") == 0
+    assert ledger.balance(db, "nobody") == 0
+    assert [row.kind for row in db.execute(select(LedgerEntry)).scalars()] == [
+        LedgerKind.DEPOSIT,
+        LedgerKind.DEPOSIT,
+        LedgerKind.PURCHASE,
+        LedgerKind.DEPOSIT,
+        LedgerKind.REFUND,
+    ]
+
+
+def test_balances_are_snapshotted_every_interval(db) -> None:
+    interval = settings.ledger_snapshot_interval
+    for _ in range(interval * 3 + 1):
+        ledger.deposit(db, "u1", 5)
+
+    snapshots = db.execute(
+        select(BalanceSnapshot.entry_id, BalanceSnapshot.balance).order_by(
+            BalanceSnapshot.entry_id
+        )
+    ).all()
+
+    assert snapshots == [(interval * n, 5 * interval * n) for n in (1, 2, 3)]
+    assert ledger.balance(db, "u1") == ledger.replay(db, "u1") == 5 * (interval * 3 + 1)
+
+
+def test_append_writes_a_batch(db) -> None:
+    ledger.append(
+        db,
+        [ledger.entry("u1", LedgerKind.DEPOSIT, 10) for _ in range(10)]
+        + [ledger.entry("u2", LedgerKind.DEPOSIT, 20)],
+    )
+
+    assert db.execute(select(func.count(LedgerEntry.id))).scalar_one() == 11
+    assert ledger.balance(db, "u1") == 100
+    assert ledger.balance(db, "u2") == 20
+
+
+def test_appending_and_reading_a_balance_take_no_scans(db) -> None:
+    for _ in range(settings.ledger_snapshot_interval - 1):
+        ledger.deposit(db, "u1", 5)
+
+    statements = []
+
+    def record(conn, cursor, statement, *args) -> None:
+        statements.append(statement.split()[0])
+
+    engine = db.get_bind()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        # The entry and the balance, then the snapshot it brings about
+        ledger.deposit(db, "u1", 5)
+        assert statements == ["INSERT", "INSERT", "INSERT", "UPDATE"]
+
+        statements.clear()
+        ledger.deposit(db, "u1", 5)
+        assert statements == ["INSERT", "INSERT"]
+
+        statements.clear()
+        ledger.balance(db, "u1")
+        assert statements == ["SELECT"]
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+    assert ledger.balance(db, "u1") == ledger.replay(db, "u1")
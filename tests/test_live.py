@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import sessionmaker
+from starlette.websockets import WebSocketDisconnect
+
+from vending_machine import stock
+from vending_machine.authentication import get_password_hash
+from vending_machine.data_objects.product import Product
+from vending_machine.data_objects.role import Role
+from vending_machine.data_objects.user import User
+from vending_machine.invalidation import PRODUCTS, USERS, invalidation_bus
+from vending_machine.live import LiveHub
+
+
+@pytest.fixture
+def engine(engine):
+    session = sessionmaker(bind=engine)()
+    session.add(
+        User(
+            id="u1",
+            username="buyer",
+            deposit=0,
+            role=Role.BUYER,
+            hashed_password=get_password_hash("password"),
+        )
+    )
+    session.add(
+        Product(id=1, product_name="Cola", cost=50, amount_available=5, seller_id="u1")
+    )
+    stock.set_stock(session, 1, 5)
+    session.commit()
+    session.close()
+    return engine
+
+
+@pytest.fixture
+def app_settings() -> dict:
+    return {"stateless_sessions": True, "warmup": False}
+
+
+@pytest.fixture
+def test_client(test_client: TestClient):
+    # Entered, so the app starts up and the hub with it
+    with test_client:
+        yield test_client
+
+
+@pytest.fixture
+def token(test_client: TestClient) -> str:
+    response = test_client.post(
+        "/auth/token", data={"username": "buyer", "password": "password"}
+    )
+    assert response.status_code == 200
+    return response.json()["access_token"]
+
+
+def test_changes_are_pushed(test_client: TestClient, session_local, token: str) -> None:
+    with test_client.websocket_connect(f"/machine/live?token={token}") as websocket:
+        assert websocket.receive_json() == {
+            "type": "balance",
+            "balance": 0,
+            "latest": None,
+        }
+        assert websocket.receive_json() == {"type": "stock", "products": {"1": 5}}
+
+        response = test_client.post(
+            "/machine/deposit?amount=10",
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        assert response.status_code == 200
+        message = websocket.receive_json()
+        assert message["balance"] == 10
+        assert message["latest"]["kind"] == "DEPOSIT"
+
+        session = session_local()
+        stock.set_stock(session, 1, 3)
+        session.commit()
+        session.close()
+        invalidation_bus.publish(PRODUCTS, "1")
+        assert websocket.receive_json() == {"type": "stock", "products": {"1": 3}}
+
+
+def test_a_token_is_required(test_client: TestClient) -> None:
+    with pytest.raises(WebSocketDisconnect) as e:
+        with test_client.websocket_connect("/machine/live") as websocket:
+            websocket.receive_json()
+    assert e.value.code == 1008
+
+
+def test_logging_out_closes_the_socket(test_client: TestClient, token: str) -> None:
+    with test_client.websocket_connect(f"/machine/live?token={token}") as websocket:
+        websocket.receive_json()
+        websocket.receive_json()
+
+        response = test_client.post(
+            "/auth/logout", headers={"Authorization": f"Bearer {token}"}
+        )
+        assert response.status_code == 200
+        with pytest.raises(WebSocketDisconnect) as e:
+            websocket.receive_json()
+    assert e.value.code == 1008
+
+
+def test_disabled_users_are_closed(session_local) -> None:
+    async def scenario() -> None:
+        hub = LiveHub(2, session_local)
+        await hub.start()
+        try:
+            subscriber = hub.subscribe("u1", "buyer")
+            other = hub.subscribe("u2", "seller")
+
+            session = session_local()
+            session.get(User, "u1").disabled = True
+            session.commit()
+            session.close()
+            invalidation_bus.publish(USERS, "buyer")
+
+            assert await asyncio.wait_for(subscriber.queue.get(), 1) is None
+            assert subscriber.revoked
+            assert hub._subscribers == {"u2": {other}}
+        finally:
+            await hub.stop()
+
+    asyncio.run(scenario())
+
+
+def test_slow_subscribers_are_dropped(session_local) -> None:
+    async def scenario() -> None:
+        hub = LiveHub(2, session_local)
+        slow = hub.subscribe("u1")
+        fast = hub.subscribe("u1")
+
+        for n in range(3):
+            hub._offer(slow, {"n": n})
+            if n < 2:
+                hub._offer(fast, {"n": n})
+                await fast.queue.get()
+
+        assert slow.dropped
+        assert await slow.queue.get() is None
+        assert not fast.dropped
+        assert hub._subscribers == {"u1": {fast}}
+
+    asyncio.run(scenario())
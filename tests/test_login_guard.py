@@ -0,0 +1,93 @@
+import pytest
+
+from vending_machine import login_guard as login_guard_module
+from vending_machine.invalidation import USERS, invalidation_bus
+from vending_machine.login_guard import LoginGuard
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
+
+
+@pytest.fixture
+def guard(clock: FakeClock) -> LoginGuard:
+    return LoginGuard(
+        username_rate=1.0,
+        username_burst=2,
+        client_rate=10.0,
+        client_burst=5,
+        negative_ttl=30,
+        max_entries=3,
+        clock=clock,
+    )
+
+
+def test_username_bucket_throttles_and_refills(guard: LoginGuard, clock) -> None:
+    assert guard.admit("alice", "10.0.0.1") is None
+    assert guard.admit("alice", "10.0.0.2") is None
+
+    retry_after = guard.admit("alice", "10.0.0.3")
+    assert retry_after == pytest.approx(1.0)
+
+    clock.now += 1
+    assert guard.admit("alice", "10.0.0.3") is None
+
+
+def test_client_bucket_throttles_across_usernames(guard: LoginGuard) -> None:
+    for i in range(5):
+        assert guard.admit(f"user{i}", "10.0.0.1") is None
+
+    assert guard.admit("someone-else", "10.0.0.1") is not None
+    assert guard.admit("someone-else", "10.0.0.2") is None
+
+
+def test_failures_are_remembered_until_they_expire(guard: LoginGuard, clock) -> None:
+    guard.remember_failure("alice", "wrong")
+
+    assert guard.is_known_failure("alice", "wrong")
+    assert not guard.is_known_failure("alice", "right")
+
+    clock.now += 31
+    assert not guard.is_known_failure("alice", "wrong")
+
+
+def test_unknown_usernames_are_forgotten_on_creation(guard: LoginGuard) -> None:
+    guard.remember_unknown_username("bob")
+    assert guard.is_known_failure("bob", "anything")
+
+    guard.forget_username("bob")
+    assert not guard.is_known_failure("bob", "anything")
+
+
+def test_failures_are_forgotten_when_all_users_are_invalidated(
+    guard: LoginGuard, monkeypatch
+) -> None:
+    monkeypatch.setattr(login_guard_module, "login_guard", guard)
+    guard.remember_unknown_username("bob")
+    guard.remember_failure("alice", "wrong")
+
+    invalidation_bus.publish(USERS)
+
+    assert not guard.is_known_failure("bob", "anything")
+    assert not guard.is_known_failure("alice", "wrong")
+
+
+def test_state_is_bounded(guard: LoginGuard) -> None:
+    for i in range(10):
+        guard.remember_unknown_username(f"user{i}")
+        guard.admit(f"user{i}", f"10.0.0.{i}")
+
+    assert len(guard._negative) == 3
+    assert len(guard._username_buckets) == 3
+    assert len(guard._client_buckets) == 3
+    assert guard.is_known_failure("user9", "x")
+    assert not guard.is_known_failure("user0", "x")
@@ -0,0 +1,104 @@
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from vending_machine.profiling import (
+    Profile,
+    ProfileStore,
+    ProfilingMiddleware,
+    sign,
+    verify,
+)
+
+
+def busy(n: int) -> int:
+    return sum(i * i for i in range(n))
+
+
+@pytest.fixture
+def store(tmp_path) -> ProfileStore:
+    return ProfileStore(str(tmp_path), 1024 * 1024)
+
+
+def make_client(store: ProfileStore, **kwargs) -> TestClient:
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def get_item(item_id: int) -> dict:
+        return {"id": item_id, "sum": busy(20000)}
+
+    @app.get("/other")
+    async def get_other() -> dict:
+        return {}
+
+    app.add_middleware(
+        ProfilingMiddleware, store=store, secret="secret", sample_rate=0.0, **kwargs
+    )
+    return TestClient(app)
+
+
+def test_signed_header() -> None:
+    now = time.time()
+    value = sign(int(now) + 60, "secret")
+
+    assert verify(value, "secret", now)
+    assert not verify(value, "other", now)
+    assert not verify(value, "secret", now + 120)
+    # The expiry can't be pushed back without the secret
+    assert not verify(f"{int(now) + 600}.{value.partition('.')[2]}", "secret", now)
+    assert not verify("nonsense", "secret", now)
+
+
+def test_a_signed_request_is_profiled(store: ProfileStore) -> None:
+    client = make_client(store)
+
+    response = client.get("/items/1")
+    assert "X-Profile-Id" not in response.headers
+
+    header = sign(int(time.time()) + 60, "secret")
+    response = client.get("/items/1", headers={"X-Profile": header})
+    assert response.status_code == 200
+    name = response.headers["X-Profile-Id"]
+
+    collapsed = (store.directory / f"{name}.collapsed").read_text()
+    lines = collapsed.splitlines()
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    # The handler's own work is on a stack below it
+    assert any(
+        "test_profiling.make_client.<locals>.get_item" in line
+        and "test_profiling.busy" in line
+        for line in lines
+    )
+
+    summary = (store.directory / f"{name}.txt").read_text()
+    assert summary.startswith("GET /items/{item_id} -> 200")
+    assert "test_profiling.busy" in summary
+
+    # A forged header only gets the request served
+    response = client.get("/items/1", headers={"X-Profile": header[:-4] + "beef"})
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+
+
+def test_routes_are_sampled_at_their_rate(store: ProfileStore) -> None:
+    client = make_client(store, route_rates={"/items/{item_id}": 1.0})
+
+    assert "X-Profile-Id" in client.get("/items/2").headers
+    assert "X-Profile-Id" not in client.get("/other").headers
+
+
+def test_old_profiles_are_removed_to_stay_under_the_cap(tmp_path) -> None:
+    store = ProfileStore(str(tmp_path), 2000)
+    profile = Profile("GET", "/items")
+    profile.stacks["a;b"] = 10**6
+    profile.functions["b"] = [1, 10**6, 10**6]
+
+    for n in range(50):
+        store.write(f"profile-{n:02d}", profile)
+
+    files = list(tmp_path.iterdir())
+    assert sum(path.stat().st_size for path in files) <= 2000
+    assert (tmp_path / "profile-49.collapsed").exists()
+    assert not (tmp_path / "profile-00.collapsed").exists()
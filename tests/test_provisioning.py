@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+from sqlalchemy import select
+
+from vending_machine import provisioning
+from vending_machine.authentication import _verify_password, get_seller_user
+from vending_machine.data_objects.role import Role
+from vending_machine.data_objects.user import User
+from vending_machine.login_guard import login_guard
+from vending_machine.models.user import UserCreate, UserWithoutPassword
+from vending_machine.provisioning import PasswordHasher, provision_users
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(workers=2)
+    yield hasher
+    hasher.shutdown()
+
+
+def test_provisions_users_and_reports_collisions(db, hasher) -> None:
+    db.add(
+        User(
+            id="1",
+            username="taken",
+            deposit=0,
+            role=Role.BUYER,
+            hashed_password="x",
+        )
+    )
+    db.commit()
+
+    users = [
+        UserCreate(username="alice", role="BUYER", password="alice-password"),
+        UserCreate(username="taken", role="BUYER", password="password"),
+        UserCreate(username="bob", role="SELLER", password="bob-password"),
+        UserCreate(username="alice", role="SELLER", password="password"),
+        UserCreate(username="carol", role="BUYER", password="carol-password"),
+    ]
+
+    result = asyncio.run(provision_users(db, users, hasher))
+
+    assert (result.created, result.failed) == (3, 2)
+    assert [(user.username, user.created, user.error) for user in result.users] == [
+        ("alice", True, None),
+        ("taken", False, "Username already exists"),
+        ("bob", True, None),
+        ("alice", False, "Duplicate username in request"),
+        ("carol", True, None),
+    ]
+
+    stored = {
+        user.username: user
+        for user in db.execute(select(User).where(User.username != "taken")).scalars()
+    }
+    assert {name: user.id for name, user in stored.items()} == {
+        user.username: user.id for user in result.users if user.created
+    }
+    assert stored["bob"].role == Role.SELLER
+    assert _verify_password("carol-password", stored["carol"].hashed_password)
+
+    assert sum(worker.passwords for worker in result.hashing.workers) == 3
+    assert 1 <= len(result.hashing.workers) <= 2
+
+
+def test_usernames_taken_again_on_retry_are_reported(db, hasher, monkeypatch) -> None:
+    db.add(
+        User(id="1", username="taken", deposit=0, role=Role.BUYER, hashed_password="x")
+    )
+    db.commit()
+    # Never seen as taken, so every insert collides
+    monkeypatch.setattr(provisioning, "_taken", lambda db, usernames: set())
+
+    users = [
+        UserCreate(username="taken", role="BUYER", password="password"),
+        UserCreate(username="dave", role="BUYER", password="dave-password"),
+    ]
+    result = asyncio.run(provision_users(db, users, hasher))
+
+    assert (result.created, result.failed) == (0, 2)
+    assert {user.error for user in result.users} == {"Could not be created, try again"}
+    assert db.execute(select(User.username)).scalars().all() == ["taken"]
+
+
+def test_bulk_users_need_a_seller_and_are_throttled(test_client, monkeypatch) -> None:
+    login_guard.clear()
+    assert test_client.post("/users/bulk", json=[]).status_code == 401
+
+    seller = UserWithoutPassword(id="s1", username="seller", role="SELLER")
+    test_client.app.dependency_overrides[get_seller_user] = lambda: seller
+    monkeypatch.setattr(login_guard, "username_burst", 2)
+
+    statuses = [test_client.post("/users/bulk", json=[]).status_code for _ in range(3)]
+    assert statuses == [200, 200, 429]
+    login_guard.clear()
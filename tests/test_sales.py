@@ -0,0 +1,108 @@
+import pytest
+
+from vending_machine import ledger, sales
+from vending_machine.data_objects.product import Product
+
+
+@pytest.fixture
+def db(db):
+    db.add_all(
+        [
+            Product(
+                id=1, amount_available=10, cost=5, product_name="Cola", seller_id="s1"
+            ),
+            Product(
+                id=2,
+                amount_available=10,
+                cost=20,
+                product_name="Crisps",
+                seller_id="s1",
+            ),
+            Product(
+                id=3, amount_available=10, cost=50, product_name="Gum", seller_id="s2"
+            ),
+        ]
+    )
+    db.commit()
+
+    return db
+
+
+def _buy(db, product: Product, units: int) -> None:
+    ledger.purchase(db, "buyer", product.id, units, product.cost)
+    sales.record_sale(
+        db,
+        product.seller_id,
+        product.id,
+        product.product_name,
+        units,
+        product.cost * units,
+    )
+    db.commit()
+
+
+def test_sales_accumulate_per_seller_and_product(db) -> None:
+    cola, crisps, gum = (db.get(Product, i) for i in (1, 2, 3))
+
+    _buy(db, cola, 2)
+    _buy(db, cola, 1)
+    _buy(db, crisps, 1)
+    _buy(db, gum, 4)
+
+    seller = sales.seller_sales(db, "s1")
+
+    assert (seller.unitsSold, seller.revenue) == (4, 35)
+    assert [(p.productName, p.unitsSold, p.revenue) for p in seller.products] == [
+        ("Cola", 3, 15),
+        ("Crisps", 1, 20),
+    ]
+    assert sales.seller_sales(db, "s2").revenue == 200
+    assert sales.seller_sales(db, "nobody").products == []
+
+
+def test_rebuild_reports_and_repairs_drift(db) -> None:
+    cola, crisps = db.get(Product, 1), db.get(Product, 2)
+    _buy(db, cola, 3)
+    _buy(db, crisps, 1)
+
+    assert sales.rebuild(db) == []
+
+    # A purchase that skipped the summary
+    ledger.purchase(db, "buyer", crisps.id, 1, crisps.cost)
+    db.commit()
+
+    drift = sales.rebuild(db)
+    assert drift == [
+        sales.Drift("s1", 2, sales.Totals(1, 20), sales.Totals(2, 40)),
+    ]
+    assert sales.seller_sales(db, "s1").revenue == 35
+
+    sales.rebuild(db, apply=True)
+
+    assert sales.rebuild(db) == []
+    assert sales.seller_sales(db, "s1").revenue == 55
+
+
+def test_sales_of_deleted_products_are_kept(db) -> None:
+    cola, gum = db.get(Product, 1), db.get(Product, 3)
+    _buy(db, cola, 2)
+    _buy(db, gum, 1)
+
+    db.delete(gum)
+    db.commit()
+
+    assert [
+        (p.productName, p.revenue) for p in sales.seller_sales(db, "s2").products
+    ] == [("Gum", 50)]
+
+    # A purchase of the deleted product that skipped the summary is still
+    # put down to its seller
+    ledger.purchase(db, "buyer", 3, 1, 50)
+    db.commit()
+    assert sales.rebuild(db) == [
+        sales.Drift("s2", 3, sales.Totals(1, 50), sales.Totals(2, 100)),
+    ]
+
+    sales.rebuild(db, apply=True)
+    assert sales.rebuild(db) == []
+    assert sales.seller_sales(db, "s2").products[0].productName == "Gum"
@@ -0,0 +1,75 @@
+import pytest
+
+from vending_machine import stock
+from vending_machine.data_objects.product import Product
+from vending_machine.search import match_expression, search_products
+
+
+@pytest.fixture
+def db(db):
+    for id, name, cost, seller, amount in [
+        (1, "Cola", 50, "s1", 10),
+        (2, "Cherry Cola", 60, "s1", 0),
+        (3, "Crème brûlée", 150, "s2", 3),
+        (4, "Crisps", 40, "s2", 7),
+        (5, "Cola Zero", 55, "s2", 2),
+    ]:
+        db.add(
+            Product(
+                id=id,
+                amount_available=amount,
+                cost=cost,
+                product_name=name,
+                seller_id=seller,
+            )
+        )
+        db.flush()
+        stock.set_stock(db, id, amount)
+    db.commit()
+
+    return db
+
+
+def _names(result) -> list[str]:
+    return [product.productName for product in result.products]
+
+
+def test_match_expression_quotes_words_and_prefixes_the_last() -> None:
+    assert match_expression('cola "OR ze') == '"cola" "OR" "ze"*'
+    assert match_expression("  -*  ") is None
+
+
+def test_search_ranks_prefix_and_accent_insensitive_matches(db) -> None:
+    # Shorter names rank higher, and equal ranks keep their id order
+    assert _names(search_products(db, "cola")) == ["Cola", "Cherry Cola", "Cola Zero"]
+    assert _names(search_products(db, "cr")) == ["Crisps", "Crème brûlée"]
+    assert _names(search_products(db, "creme bru")) == ["Crème brûlée"]
+    assert search_products(db, "?!").total == 0
+
+
+def test_filters_and_pagination(db) -> None:
+    assert _names(search_products(db, min_cost=50, max_cost=60)) == [
+        "Cherry Cola",
+        "Cola",
+        "Cola Zero",
+    ]
+    assert _names(search_products(db, "cola", seller_id="s2")) == ["Cola Zero"]
+
+    in_stock = search_products(db, "cola", in_stock=True)
+    assert _names(in_stock) == ["Cola", "Cola Zero"]
+    assert [product.amountAvailable for product in in_stock.products] == [10, 2]
+
+    page = search_products(db, limit=2, offset=2)
+    assert page.total == 5
+    assert _names(page) == ["Cola Zero", "Crisps"]
+
+
+def test_index_follows_writes(db) -> None:
+    product = db.get(Product, 4)
+    product.product_name = "Pretzels"
+    db.delete(db.get(Product, 1))
+    db.commit()
+
+    assert _names(search_products(db, "cola")) == ["Cherry Cola", "Cola Zero"]
+    assert _names(search_products(db, "crisps")) == []
+    assert _names(search_products(db, "pretz")) == ["Pretzels"]
@@ -0,0 +1,26 @@
+import os
+import time
+
+import uvicorn
+
+from vending_machine.server import Supervisor
+
+
+def test_workers_dying_on_startup_are_restarted_with_growing_delays(
+    monkeypatch,
+) -> None:
+    supervisor = Supervisor(
+        uvicorn.Config(app=None), workers=1, min_uptime=60, max_restart_delay=4
+    )
+    exits = iter(range(100, 110))
+    monkeypatch.setattr(os, "waitpid", lambda pid, options: (next(exits), 256))
+
+    delays = []
+    for pid in range(100, 106):
+        supervisor.children[pid] = 0.0 if pid == 100 else time.monotonic()
+        supervisor._wait(block=True)
+        delays.append(supervisor.restart_delay())
+
+    # The first worker had been up long enough; the next ones died on startup
+    assert delays == [0.0, 0.5, 1.0, 2.0, 4.0, 4.0]
+    assert supervisor.fast_failures == 5
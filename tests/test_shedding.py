@@ -0,0 +1,230 @@
+import asyncio
+import threading
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from vending_machine.shedding import (
+    LoadShedder,
+    LoadSheddingMiddleware,
+    PriorityClass,
+    Shed,
+)
+from vending_machine.single_flight import SingleFlight
+
+CLASSES = {
+    "critical": {"concurrency": 1, "queue": 4, "wait": 5.0},
+    "normal": {"concurrency": 1, "queue": 4, "wait": 5.0},
+    "bulk": {"concurrency": 1, "queue": 0, "wait": 1.0},
+}
+ROUTES = {"/machine/buy/*": "critical", "GET /products": "bulk"}
+
+
+def test_requests_are_classified_by_the_first_matching_pattern() -> None:
+    shedder = LoadShedder(CLASSES, ROUTES)
+
+    assert shedder.classify("GET", "/machine/buy/1/2").name == "critical"
+    assert shedder.classify("GET", "/products").name == "bulk"
+    assert shedder.classify("POST", "/products").name == "normal"
+    assert shedder.classify("GET", "/products/1").name == "normal"
+
+    with pytest.raises(ValueError):
+        LoadShedder(CLASSES, {"/x": "urgent"})
+
+
+def test_turns_are_handed_to_waiters_in_order() -> None:
+    async def scenario() -> None:
+        priority = PriorityClass("normal", concurrency=1, queue_size=2, max_wait=0.2)
+        await priority.acquire()
+
+        first = asyncio.create_task(priority.acquire())
+        second = asyncio.create_task(priority.acquire())
+        await asyncio.sleep(0)
+        assert priority.queued == 2
+
+        with pytest.raises(Shed) as e:
+            await priority.acquire()
+        assert e.value.reason == "queue_full"
+
+        # A cancelled waiter gives up its place
+        second.cancel()
+        await asyncio.gather(second, return_exceptions=True)
+        assert priority.queued == 1
+
+        priority.release(0.01)
+        await first
+        assert priority.running == 1 and priority.queued == 0
+
+        # Nobody releases, so the next waiter runs out of time
+        with pytest.raises(Shed) as e:
+            await priority.acquire()
+        assert e.value.reason == "timeout"
+
+        priority.release(0.01)
+        assert priority.running == 0
+        assert priority.admitted == 2
+        assert priority.shed == {"queue_full": 1, "deadline": 0, "timeout": 1}
+
+    asyncio.run(scenario())
+
+
+def test_waits_known_to_run_past_the_deadline_are_shed_at_once() -> None:
+    async def scenario() -> None:
+        priority = PriorityClass("normal", concurrency=1, queue_size=8, max_wait=1.0)
+        await priority.acquire()
+        priority.service_time = 0.4
+
+        waiters = [asyncio.create_task(priority.acquire()) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(Shed) as e:
+            await priority.acquire()
+        assert e.value.reason == "deadline"
+        assert e.value.retry_after >= 1.2
+
+        for waiter in waiters:
+            waiter.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_a_saturated_class_is_shed_without_affecting_the_others() -> None:
+    app = FastAPI()
+    release = asyncio.Event()
+
+    @app.get("/products")
+    async def get_products() -> list:
+        await release.wait()
+        return []
+
+    @app.get("/machine/buy/{product_id}/{amount}")
+    async def buy(product_id: int, amount: int) -> dict:
+        return {"bought": amount}
+
+    shedder = LoadShedder(CLASSES, ROUTES)
+    app.add_middleware(LoadSheddingMiddleware, enabled=True, shedder=shedder)
+
+    async def scenario() -> None:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            listing = asyncio.create_task(client.get("/products"))
+            await asyncio.sleep(0.05)
+
+            shed = await client.get("/products")
+            assert shed.status_code == 503
+            assert shed.headers["Retry-After"] == "1"
+
+            assert (await client.get("/machine/buy/1/2")).status_code == 200
+
+            release.set()
+            assert (await listing).status_code == 200
+
+        stats = shedder.stats()
+        assert stats["bulk"]["admitted"] == 1
+        assert stats["bulk"]["shed"]["queue_full"] == 1
+        assert stats["critical"]["admitted"] == 1
+        assert stats["bulk"]["running"] == stats["critical"]["running"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_requests_for_a_read_in_flight_are_let_in_up_to_a_limit(db) -> None:
+    app = FastAPI()
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def work(session) -> list:
+        release.wait(5)
+        return []
+
+    @app.get("/products")
+    async def get_products() -> list:
+        return await flights.run(("GET /products",), work, db)
+
+    classes = {
+        **CLASSES,
+        "bulk": {"concurrency": 1, "queue": 1, "wait": 5.0, "coalesce": 1},
+    }
+    shedder = LoadShedder(classes, ROUTES)
+    app.add_middleware(
+        LoadSheddingMiddleware, enabled=True, shedder=shedder, flights=flights
+    )
+    bulk = shedder.classes["bulk"]
+
+    async def scenario() -> None:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            # A read already in flight, started outside the middleware
+            read = asyncio.create_task(flights.run(("GET /products",), work, db))
+            await asyncio.sleep(0.05)
+
+            # One is let in without a turn, the others take turns and give
+            # them back as they join the read
+            listings = []
+            for _ in range(3):
+                listings.append(asyncio.create_task(client.get("/products")))
+                await asyncio.sleep(0.05)
+            assert (bulk.running, bulk.queued) == (0, 0)
+            assert flights.joined == 3
+
+            release.set()
+            responses = await asyncio.gather(*listings)
+            assert [response.status_code for response in responses] == [200] * 3
+            assert await read == []
+
+        stats = shedder.stats()["bulk"]
+        assert (stats["admitted"], stats["coalesced"], stats["running"]) == (2, 1, 0)
+        assert sum(stats["shed"].values()) == 0
+        assert flights.started == 1
+
+    asyncio.run(scenario())
+
+
+def test_requests_beyond_the_limit_queue_and_are_shed(db) -> None:
+    app = FastAPI()
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def work(session) -> list:
+        release.wait(5)
+        return []
+
+    @app.get("/products")
+    async def get_products() -> list:
+        return await flights.run(("GET /products",), work, db)
+
+    classes = {
+        **CLASSES,
+        "bulk": {"concurrency": 1, "queue": 0, "wait": 1.0, "coalesce": 1},
+    }
+    shedder = LoadShedder(classes, ROUTES)
+    app.add_middleware(
+        LoadSheddingMiddleware, enabled=True, shedder=shedder, flights=flights
+    )
+
+    async def scenario() -> None:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            # Starts the read, and holds the only turn while it runs
+            first = asyncio.create_task(client.get("/products"))
+            await asyncio.sleep(0.05)
+            coalesced = asyncio.create_task(client.get("/products"))
+            await asyncio.sleep(0.05)
+
+            assert (await client.get("/products")).status_code == 503
+
+            release.set()
+            responses = await asyncio.gather(first, coalesced)
+            assert [response.status_code for response in responses] == [200] * 2
+
+        stats = shedder.stats()["bulk"]
+        assert (stats["admitted"], stats["coalesced"]) == (1, 1)
+        assert stats["shed"]["queue_full"] == 1
+
+    asyncio.run(scenario())
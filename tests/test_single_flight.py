@@ -0,0 +1,188 @@
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from vending_machine import authentication, stock
+from vending_machine.controllers import product as product_controller
+from vending_machine.data_objects.product import Product
+from vending_machine.data_objects.role import Role
+from vending_machine.data_objects.user import User
+from vending_machine.database import atomic_session
+from vending_machine.invalidation import PRODUCTS, invalidation_bus
+from vending_machine.models.user import UserWithoutPassword
+from vending_machine.single_flight import SingleFlight
+
+
+@pytest.fixture
+def engine(engine):
+    session = sessionmaker(bind=engine)()
+    session.add(
+        User(id="u1", username="buyer", deposit=0, role=Role.BUYER, hashed_password="")
+    )
+    session.add(
+        Product(id=1, amount_available=5, cost=5, product_name="Cola", seller_id="u1")
+    )
+    stock.set_stock(session, 1, 5)
+    session.commit()
+    session.close()
+    return engine
+
+
+def test_concurrent_calls_share_one_run(db) -> None:
+    flight = SingleFlight()
+    release = threading.Event()
+    runs = []
+
+    def work(session) -> object:
+        runs.append(session)
+        release.wait(5)
+        return object()
+
+    async def scenario() -> None:
+        calls = [
+            asyncio.create_task(flight.run(("GET /key",), work, db)) for _ in range(5)
+        ]
+        other = asyncio.create_task(flight.run(("GET /other",), lambda session: 1, db))
+        await asyncio.sleep(0.05)
+        release.set()
+
+        results = await asyncio.gather(*calls)
+        assert all(result is results[0] for result in results)
+        assert await other == 1
+
+    asyncio.run(scenario())
+    assert len(runs) == 1
+    assert (flight.started, flight.joined, flight.in_flight) == (2, 4, 0)
+
+
+def test_a_cancelled_caller_leaves_the_others_their_result(db) -> None:
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def work(session) -> str:
+        release.wait(5)
+        return "result"
+
+    async def scenario() -> None:
+        first = asyncio.create_task(flight.run(("GET /key",), work, db))
+        second = asyncio.create_task(flight.run(("GET /key",), work, db))
+        await asyncio.sleep(0.05)
+
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        release.set()
+        assert await second == "result"
+
+        # With nobody left waiting, the run is abandoned and a new one can start
+        release.clear()
+        lone = asyncio.create_task(flight.run(("GET /key",), work, db))
+        await asyncio.sleep(0.05)
+        lone.cancel()
+        await asyncio.gather(lone, return_exceptions=True)
+        assert flight.in_flight == 0
+        release.set()
+
+    asyncio.run(scenario())
+
+
+def test_a_batch_transaction_reads_on_its_own(engine) -> None:
+    flight = SingleFlight()
+
+    def work(session) -> list[str]:
+        return [name for (name,) in session.query(Product.product_name)]
+
+    async def scenario() -> None:
+        with atomic_session(engine) as session:
+            session.add(
+                Product(
+                    id=2,
+                    amount_available=0,
+                    cost=5,
+                    product_name="Fanta",
+                    seller_id="u1",
+                )
+            )
+            session.commit()
+            # The transaction's own uncommitted product, and no flight others could join
+            assert await flight.run(("GET /key",), work, session) == ["Cola", "Fanta"]
+            assert flight.in_flight == 0
+
+    asyncio.run(scenario())
+    assert (flight.started, flight.joined, flight.bypassed) == (0, 0, 1)
+
+
+def test_identical_product_listings_are_coalesced(test_app, monkeypatch) -> None:
+    buyer = UserWithoutPassword(id="u1", username="buyer", role="BUYER")
+    test_app.dependency_overrides[authentication.get_buyer_or_seller_user] = (
+        lambda: buyer
+    )
+
+    reads = []
+    products_body = product_controller._products_body
+
+    def slow_products_body(db) -> bytes:
+        reads.append(1)
+        time.sleep(0.1)
+        return products_body(db)
+
+    monkeypatch.setattr(product_controller, "_products_body", slow_products_body)
+
+    bodies = []
+    product_body = product_controller._product_body
+
+    def counted_product_body(db, product_id: int):
+        bodies.append(product_id)
+        return product_body(db, product_id)
+
+    monkeypatch.setattr(product_controller, "_product_body", counted_product_body)
+
+    async def scenario() -> None:
+        transport = httpx.ASGITransport(app=test_app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            # More than the listings' class runs at once, all let in to share one read
+            responses = await asyncio.gather(
+                *(client.get("/products") for _ in range(12))
+            )
+            assert {response.status_code for response in responses} == {200}
+            assert len({response.content for response in responses}) == 1
+            assert responses[0].json() == [
+                {
+                    "id": "1",
+                    "amountAvailable": 5,
+                    "cost": 5,
+                    "productName": "Cola",
+                    "sellerId": "u1",
+                }
+            ]
+            assert len(reads) == 1
+
+            # After a write, the next listing reads again
+            invalidation_bus.publish(PRODUCTS, 1)
+            assert (await client.get("/products")).status_code == 200
+            assert len(reads) == 2
+
+            response = await client.get("/users")
+            assert response.status_code == 200
+            assert [user["username"] for user in response.json()] == ["buyer"]
+
+            response = await client.get("/users/buyer")
+            assert response.json()["id"] == "u1"
+            tag = response.headers["ETag"]
+            response = await client.get("/users/u1", headers={"If-None-Match": tag})
+            assert response.status_code == 304
+
+            # A conditional read that matches never builds the body
+            response = await client.get("/products/1")
+            assert response.json()["productName"] == "Cola"
+            tag = response.headers["ETag"]
+            response = await client.get("/products/1", headers={"If-None-Match": tag})
+            assert response.status_code == 304
+            assert bodies == [1]
+
+    asyncio.run(scenario())
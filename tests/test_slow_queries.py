@@ -0,0 +1,92 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+from vending_machine.authentication import get_password_hash
+from vending_machine.config import settings
+from vending_machine.data_objects.role import Role
+from vending_machine.data_objects.user import User
+from vending_machine.slow_queries import normalize, parameter_shape, query_log
+
+
+@pytest.fixture
+def engine(engine, monkeypatch):
+    # Every statement counts as slow
+    monkeypatch.setattr(query_log, "threshold", 0.0)
+    query_log.clear()
+    return engine
+
+
+@pytest.fixture
+def app_settings() -> dict:
+    return {"stateless_sessions": False}
+
+
+def test_normalize() -> None:
+    assert normalize(
+        "SELECT *\n  FROM products WHERE id IN (?, ?, ?) AND cost > 10 "
+        "AND product_name = 'it''s' LIMIT 1"
+    ) == (
+        "SELECT * FROM products WHERE id IN (?, ...) AND cost > ? "
+        "AND product_name = ? LIMIT ?"
+    )
+    assert normalize("SELECT anon_1.id FROM anon_1") == "SELECT anon_1.id FROM anon_1"
+
+
+def test_parameter_shape() -> None:
+    assert parameter_shape((1, "a", None)) == "(int, str, NoneType)"
+    assert parameter_shape({"id": 1}) == "{id: int}"
+    assert parameter_shape([(1, "a"), (2, "b")], executemany=True) == "2 x (int, str)"
+
+
+def test_statements_are_aggregated_with_their_plan(engine) -> None:
+    with engine.connect() as connection:
+        for amount in (5, 10, 20):
+            connection.execute(
+                text("SELECT id FROM products WHERE amount_available > :amount"),
+                {"amount": amount},
+            )
+        connection.execute(text("SELECT id FROM products WHERE id = :id"), {"id": 1})
+
+    stats = {entry.statement: entry for entry in query_log.stats()}
+    scan = stats["SELECT id FROM products WHERE amount_available > ?"]
+    assert scan.calls == scan.slow == 3
+    assert scan.parameters == "(int)"
+    assert scan.routes == {"-": 3}
+    assert scan.scans
+
+    lookup = stats["SELECT id FROM products WHERE id = ?"]
+    assert lookup.calls == 1
+    assert lookup.plan and not lookup.scans
+
+
+def test_slow_queries_are_served_in_debug_mode(
+    test_client: TestClient, session_local, monkeypatch
+) -> None:
+    session = session_local()
+    session.add(
+        User(
+            id="u1",
+            username="buyer",
+            deposit=0,
+            role=Role.BUYER,
+            hashed_password=get_password_hash("password"),
+        )
+    )
+    session.commit()
+    session.close()
+
+    response = test_client.post(
+        "/auth/token", data={"username": "buyer", "password": "password"}
+    )
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    assert test_client.get("/products/7", headers=headers).status_code == 404
+
+    monkeypatch.setattr(settings, "debug", False)
+    assert test_client.get("/debug/slow-queries").status_code == 404
+
+    monkeypatch.setattr(settings, "debug", True)
+    stats = test_client.get("/debug/slow-queries", params={"limit": 100}).json()
+    routes = {route for entry in stats for route in entry["routes"]}
+    assert {"POST /auth/token", "GET /products/{product_id}"} <= routes
+    assert all(entry["plan"] is not None for entry in stats)
@@ -0,0 +1,185 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import sessionmaker
+
+from vending_machine import stock
+from vending_machine.authentication import get_password_hash
+from vending_machine.data_objects.product import Product
+from vending_machine.data_objects.revocation import Revocation
+from vending_machine.data_objects.role import Role
+from vending_machine.data_objects.session import UserSession
+from vending_machine.data_objects.user import User
+from vending_machine.invalidation import REVOCATIONS, invalidation_bus
+from vending_machine.revocation import revocation_list
+
+
+@pytest.fixture
+def engine(engine):
+    session = sessionmaker(bind=engine)()
+    session.add(
+        User(
+            id="u1",
+            username="buyer",
+            deposit=0,
+            role=Role.BUYER,
+            hashed_password=get_password_hash("password"),
+        )
+    )
+    session.commit()
+    session.close()
+    return engine
+
+
+@pytest.fixture
+def app_settings() -> dict:
+    return {"stateless_sessions": True}
+
+
+@pytest.fixture
+def test_app(test_app, monkeypatch):
+    # Synced once, on the first token check
+    monkeypatch.setattr(revocation_list, "sync_interval", 3600)
+    return test_app
+
+
+def _login(test_client: TestClient) -> dict:
+    response = test_client.post(
+        "/auth/token", data={"username": "buyer", "password": "password"}
+    )
+    assert response.status_code == 200
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def test_token_is_checked_without_the_db(
+    test_client: TestClient, session_local
+) -> None:
+    headers = _login(test_client)
+
+    session = session_local()
+    assert session.query(UserSession).one().user_id == "u1"
+    # Even with the user gone from the table, the token alone identifies them
+    session.query(User).delete()
+    session.commit()
+
+    response = test_client.post("/auth/whoami", headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {
+        "id": "u1",
+        "username": "buyer",
+        "role": "BUYER",
+        "deposit": None,
+    }
+
+
+def test_logout_revokes_only_that_session(test_client: TestClient) -> None:
+    first = _login(test_client)
+    second = _login(test_client)
+
+    assert test_client.post("/auth/logout", headers=first).status_code == 200
+
+    assert test_client.post("/auth/whoami", headers=first).status_code == 401
+    assert test_client.post("/auth/whoami", headers=second).status_code == 200
+
+
+def test_role_change_revokes_earlier_tokens(test_client: TestClient) -> None:
+    headers = _login(test_client)
+
+    response = test_client.put("/users/buyer", json={"role": "SELLER"}, headers=headers)
+    assert response.status_code == 200
+
+    assert test_client.post("/auth/whoami", headers=headers).status_code == 401
+    assert test_client.post("/auth/whoami", headers=_login(test_client)).json()[
+        "role"
+    ] == ("SELLER")
+
+
+def test_deleting_a_user_removes_their_sessions_and_products(
+    test_client: TestClient, session_local
+) -> None:
+    headers = _login(test_client)
+    session = session_local()
+    session.add(
+        Product(id=1, amount_available=5, cost=5, product_name="Cola", seller_id="u1")
+    )
+    stock.set_stock(session, 1, 5)
+    session.commit()
+
+    response = test_client.delete("/users/buyer", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["id"] == "u1"
+
+    assert session.query(User).count() == 0
+    assert session.query(UserSession).count() == 0
+    assert session.query(Product).count() == 0
+    assert stock.total_stock(session, 1) == 0
+    session.close()
+    assert test_client.post("/auth/whoami", headers=headers).status_code == 401
+
+
+def test_revocations_are_reloaded(test_client: TestClient, session_local) -> None:
+    headers = _login(test_client)
+    test_client.post("/auth/logout", headers=headers)
+
+    revocation_list.clear()
+    assert test_client.post("/auth/whoami", headers=headers).status_code == 200
+
+    session = session_local()
+    revocation_list.load(session)
+    session.close()
+    assert test_client.post("/auth/whoami", headers=headers).status_code == 401
+
+
+def test_revocations_whose_events_were_missed_are_synced(
+    test_client: TestClient, session_local, monkeypatch
+) -> None:
+    headers = _login(test_client)
+    assert test_client.post("/auth/whoami", headers=headers).status_code == 200
+
+    # Logged out on another worker, whose event never arrived
+    session = session_local()
+    session.add(
+        Revocation(
+            kind="user",
+            key="u1",
+            revoked_at=datetime.now(),
+            expires_at=datetime.now() + timedelta(hours=1),
+        )
+    )
+    session.commit()
+    session.close()
+    assert test_client.post("/auth/whoami", headers=headers).status_code == 200
+
+    monkeypatch.setattr(revocation_list, "sync_interval", 0)
+    assert test_client.post("/auth/whoami", headers=headers).status_code == 401
+
+
+def test_disabling_a_user_revokes_their_tokens(test_client: TestClient) -> None:
+    headers = _login(test_client)
+
+    response = test_client.put("/users/buyer", json={"disabled": True}, headers=headers)
+    assert response.status_code == 200
+
+    assert test_client.post("/auth/whoami", headers=headers).status_code == 401
+    response = test_client.post(
+        "/auth/token", data={"username": "buyer", "password": "password"}
+    )
+    assert response.status_code == 400
+
+
+def test_revocations_are_reloaded_when_the_table_is_replaced(
+    test_client: TestClient, session_local
+) -> None:
+    headers = _login(test_client)
+    test_client.post("/auth/logout", headers=headers)
+    assert test_client.post("/auth/whoami", headers=headers).status_code == 401
+
+    # As if reset to a snapshot taken before the logout
+    session = session_local()
+    session.query(Revocation).delete()
+    session.commit()
+    session.close()
+    invalidation_bus.publish(REVOCATIONS)
+
+    assert test_client.post("/auth/whoami", headers=headers).status_code == 200
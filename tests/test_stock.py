@@ -0,0 +1,65 @@
+from sqlalchemy import select
+
+from vending_machine import stock
+from vending_machine.config import settings
+from vending_machine.data_objects.stock_shard import StockShard
+
+
+def _shards(db, product_id: int) -> list[int]:
+    return list(
+        db.execute(
+            select(StockShard.amount)
+            .where(StockShard.product_id == product_id)
+            .order_by(StockShard.shard)
+        ).scalars()
+    )
+
+
+def test_stock_is_spread_across_shards(db) -> None:
+    stock.set_stock(db, 1, 19)
+
+    amounts = _shards(db, 1)
+    assert len(amounts) == settings.stock_shards
+    assert sum(amounts) == 19
+    assert max(amounts) - min(amounts) <= 1
+
+
+def test_reserve_takes_exactly_what_was_bought(db) -> None:
+    stock.set_stock(db, 1, 100)
+    stock.set_stock(db, 2, 5)
+
+    for _ in range(30):
+        assert stock.reserve(db, 1, 2)
+
+    assert stock.total_stock(db, 1) == 40
+    assert stock.stock_totals(db) == {1: 40, 2: 5}
+    assert stock.stock_totals(db, [2]) == {2: 5}
+
+
+def test_dry_shards_are_rebalanced(db) -> None:
+    stock.set_stock(db, 1, settings.stock_shards * 3)
+
+    # More than any one shard holds, so this has to gather stock from all of them
+    assert stock.reserve(db, 1, 5)
+
+    amounts = _shards(db, 1)
+    assert sum(amounts) == settings.stock_shards * 3 - 5
+    assert max(amounts) - min(amounts) <= 1
+
+
+def test_stock_can_be_sold_out_but_not_oversold(db) -> None:
+    stock.set_stock(db, 1, 10)
+
+    for _ in range(10):
+        assert stock.reserve(db, 1, 1)
+
+    assert not stock.reserve(db, 1, 1)
+    assert stock.total_stock(db, 1) == 0
+
+
+def test_delete_stock(db) -> None:
+    stock.set_stock(db, 1, 10)
+    stock.delete_stock(db, 1)
+
+    assert stock.total_stock(db, 1) == 0
+    assert stock.stock_totals(db) == {}
@@ -0,0 +1,138 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import sessionmaker
+
+from vending_machine import tracing
+from vending_machine.authentication import get_password_hash
+from vending_machine.data_objects.role import Role
+from vending_machine.data_objects.user import User
+from vending_machine.tracing import Tracer, parse_traceparent, span, tracer
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+@pytest.fixture
+def engine(engine):
+    session = sessionmaker(bind=engine)()
+    session.add(
+        User(
+            id="u1",
+            username="buyer",
+            deposit=0,
+            role=Role.BUYER,
+            hashed_password=get_password_hash("password"),
+        )
+    )
+    session.commit()
+    session.close()
+    return engine
+
+
+@pytest.fixture
+def app_settings() -> dict:
+    return {"stateless_sessions": False, "tracing": True, "debug": True}
+
+
+@pytest.fixture
+def test_client(test_client: TestClient, tmp_path, monkeypatch) -> TestClient:
+    monkeypatch.setattr(tracer, "path", str(tmp_path / "traces.jsonl"))
+    tracer.clear()
+    return test_client
+
+
+def test_parse_traceparent() -> None:
+    assert parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-01") == (TRACE_ID, PARENT_ID)
+    assert parse_traceparent(f"00-{'0' * 32}-{PARENT_ID}-01") is None
+    assert parse_traceparent(f"ff-{TRACE_ID}-{PARENT_ID}-01") is None
+    assert parse_traceparent("garbage") is None
+    assert parse_traceparent(None) is None
+
+
+def test_spans_are_a_no_op_outside_a_traced_request() -> None:
+    with span("anything") as current:
+        assert current is None
+    assert tracing.start_span("sql") is None
+
+
+def test_a_request_is_traced(test_client: TestClient) -> None:
+    response = test_client.post(
+        "/auth/token", data={"username": "buyer", "password": "password"}
+    )
+    headers = {
+        "Authorization": f"Bearer {response.json()['access_token']}",
+        "traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01",
+    }
+    assert "bcrypt.verify" in [s.name for s in tracer.recent(1)[0].spans]
+    assert "jwt.encode" in [s.name for s in tracer.recent(1)[0].spans]
+
+    response = test_client.get("/products", headers=headers)
+    assert response.status_code == 200
+
+    trace = tracer.recent(1)[0]
+    assert trace.trace_id == TRACE_ID
+    spans = {s.span_id: s for s in trace.spans}
+    root = trace.spans[-1]
+    assert root.name == "GET /products"
+    assert root.parent_id == PARENT_ID
+    assert root.attributes["status"] == 200
+    assert response.headers["traceresponse"] == f"00-{TRACE_ID}-{root.span_id}-01"
+
+    def parent_name(s) -> str:
+        return spans[s.parent_id].name
+
+    by_name = {}
+    for s in trace.spans:
+        by_name.setdefault(s.name, []).append(s)
+    assert parent_name(by_name["jwt.decode"][0]) == "auth.current_user"
+    # The user lookup runs inside the auth span, the product listing under the request
+    assert [parent_name(s) for s in by_name["sql"]].count("auth.current_user") == 1
+    assert "GET /products" in [parent_name(s) for s in by_name["sql"]]
+    assert "SELECT" in by_name["sql"][0].attributes["statement"]
+    assert parent_name(by_name["render"][0]) == "GET /products"
+
+    # The same spans were exported, one per line
+    with open(tracer.path) as f:
+        exported = [json.loads(line) for line in f]
+    assert [e["spanId"] for e in exported[-len(trace.spans) :]] == list(spans)
+
+    listed = test_client.get("/debug/traces?limit=1").json()
+    assert listed[0]["traceId"] == TRACE_ID
+
+
+def test_the_ring_is_bounded() -> None:
+    ring = Tracer(2)
+    for n in range(3):
+        ring.finish(tracing.Trace(str(n)))
+    assert [trace.trace_id for trace in ring.recent()] == ["1", "2"]
+
+
+def test_spans_past_the_limit_are_dropped(test_client: TestClient, monkeypatch) -> None:
+    monkeypatch.setattr(tracer, "max_spans", 3)
+    response = test_client.post(
+        "/auth/token", data={"username": "buyer", "password": "password"}
+    )
+    assert response.status_code == 200
+
+    trace = tracer.recent(1)[0]
+    root = trace.spans[-1]
+    assert len(trace.spans) == 4
+    assert root.attributes["droppedSpans"] > 0
+    # Only spans that were opened are kept, so every parent is in the trace
+    ids = {s.span_id for s in trace.spans}
+    assert all(s.parent_id in ids for s in trace.spans[:-1])
+
+
+def test_nothing_is_exported_without_a_file(
+    test_client: TestClient, monkeypatch
+) -> None:
+    monkeypatch.setattr(tracer, "path", None)
+
+    async def export(*args) -> None:
+        raise AssertionError("exported without a file")
+
+    monkeypatch.setattr(tracing, "run_in_threadpool", export)
+    assert test_client.get("/products").status_code == 401
+    assert tracer.recent(1)[0].spans[-1].attributes["status"] == 401
@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+from vending_machine import warmup
+from vending_machine.config import settings
+from vending_machine.main import main
+
+
+@pytest.fixture
+def engine(engine, monkeypatch):
+    monkeypatch.setattr(warmup, "engine", engine)
+    return engine
+
+
+def test_not_ready_until_warmed_up(test_client: TestClient, monkeypatch) -> None:
+    release = threading.Event()
+    warm_up_worker = warmup.warm_up_worker
+
+    def slow_warm_up_worker(bind):
+        release.wait(10)
+        return warm_up_worker(bind)
+
+    monkeypatch.setattr(warmup, "warm_up_worker", slow_warm_up_worker)
+
+    # Startup doesn't wait for the warm-up, so the worker answers meanwhile
+    with test_client:
+        response = test_client.get("/heartbeat")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+
+        release.set()
+        assert warmup.ready.wait(10)
+        assert test_client.get("/heartbeat").status_code == 200
+
+
+def test_warm_up_fills_the_caches(test_app, engine) -> None:
+    assert test_app.openapi_schema is None
+
+    timings = warmup.warm_up_process(test_app)
+    timings.update(warmup.warm_up_worker(engine))
+
+    assert set(timings) == {"openapi", "mappers", "conversion", "bcrypt", "jwt"} | {
+        "pool",
+        "statements",
+    }
+    assert test_app.openapi_schema is not None
+    # The hot statements are compiled and cached on the engine
+    assert len(engine._compiled_cache) >= 10
+
+
+def test_ready_at_once_without_warm_up(engine, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "warmup", False)
+    warmup.ready.clear()
+
+    main()
+    assert warmup.ready.is_set()
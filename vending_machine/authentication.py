@@ -1,37 +1,51 @@
-from datetime import datetime, timedelta, timezone
-from typing import Annotated
+import time
+from datetime import datetime, timedelta
+from typing import Annotated, Optional
 from uuid import uuid4
 
-from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi import Depends, HTTPException, WebSocket, WebSocketException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+from sqlalchemy import delete, select
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import HTTPConnection
 
+from vending_machine import cart
 from vending_machine.config import settings
 from vending_machine.data_objects.role import Role
+from vending_machine.data_objects.session import UserSession as UserSessionOrm
 from vending_machine.data_objects.user import User as UserOrm
-from vending_machine.database import SessionLocal
-from vending_machine.models.session import UserSession
-from vending_machine.models.session_product import SessionProduct
+from vending_machine.database import SessionLocal, get_db
+from vending_machine.invalidation import USERS, invalidation_bus
+from vending_machine.login_guard import login_guard
+from vending_machine.models.conversion import user_from_orm
 from vending_machine.models.token import TokenData
-from vending_machine.models.user import User, UserCreate, UserWithoutPassword
-
-app = FastAPI()
+from vending_machine.models.user import (
+    SessionUser,
+    User,
+    UserCreate,
+    UserWithoutPassword,
+)
+from vending_machine.revocation import revocation_list
+from vending_machine.tracing import span, traced
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
+@traced("bcrypt.verify")
 def _verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 
+@traced("bcrypt.hash")
 def get_password_hash(password):
     return pwd_context.hash(password)
 
 
 def _get_user(db: SessionLocal, username: str):
-    return app.db.query(User).filter(User.username == username).first()
+    return db.query(UserOrm).filter(UserOrm.username == username).first()
 
 
 def authenticate_user(
@@ -39,10 +53,14 @@ def authenticate_user(
 ) -> UserWithoutPassword | bool:
     user = _get_user(db, username)
     if not user:
+        login_guard.remember_unknown_username(username)
         return False
     if not _verify_password(password, user.hashed_password):
+        login_guard.remember_failure(username, password)
         return False
-    return UserWithoutPassword(**user.dict())
+    if user.disabled:
+        raise HTTPException(status_code=400, detail="Inactive user")
+    return user_from_orm(user)
 
 
 def user_create(db: SessionLocal, user: UserCreate) -> UserWithoutPassword:
@@ -57,79 +75,144 @@ def user_create(db: SessionLocal, user: UserCreate) -> UserWithoutPassword:
     db.commit()
     db.refresh(new_user)
 
-    return UserWithoutPassword(**new_user.__dict__)
+    invalidation_bus.publish(USERS, new_user.username)
+
+    return user_from_orm(new_user)
 
 
 def create_access_token(
-    db: SessionLocal, data: dict, expires_delta: timedelta | None = None
-):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.now(timezone.utc) + expires_delta
-    else:
-        expire = datetime.now(timezone.utc) + timedelta(minutes=15)
-
-    most_recent_session = (
-        db.query(UserSession)
-        .filter(UserSession.user_id == data["sub"])
-        .order_by(UserSession.expiry_time.desc())
-        .last()
-    )
+    db: SessionLocal, user: UserWithoutPassword, expires_delta: timedelta
+) -> str:
+    """
+    Creates a token for the user, replacing their expired sessions with a new one.
 
-    if most_recent_session and most_recent_session.expiry_time > datetime.now(
-        timezone.utc
-    ):
+    Raises:
+        HTTPException: If the user already has an active session.
+    """
+    now = datetime.now()
+    active_session = db.scalars(
+        select(UserSessionOrm.id)
+        .where(UserSessionOrm.user_id == user.id, UserSessionOrm.expiry_time > now)
+        .limit(1)
+    ).first()
+    if active_session:
         raise HTTPException(
             status_code=400, detail="Cannot log into a user with an active session"
         )
 
-    db.query(UserSession).filter(UserSession.user_id == data["sub"]).delete()
-    db.query(SessionProduct).filter(SessionProduct.user_id == data["sub"]).delete()
-    db.commit()
-
+    expire = now + expires_delta
+    cart.clear(db, user.id)
+    db.execute(delete(UserSessionOrm).where(UserSessionOrm.user_id == user.id))
     db.add(
-        UserSession(
-            user_id=data["sub"],
+        UserSessionOrm(
+            id=uuid4().hex,
+            user_id=user.id,
             expiry_time=expire,
+            deposited_amount=0,
         )
     )
+    db.commit()
+
+    claims = {"sub": user.username, "exp": int(expire.timestamp())}
+    with span("jwt.encode"):
+        return jwt.encode(claims, settings.jwt_secret, algorithm=settings.jwt_algorithm)
 
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(
-        to_encode, settings.jwt_secret, algorithm=settings.jwt_algorithm
+
+def create_stateless_access_token(
+    db: SessionLocal, user: UserWithoutPassword, expires_delta: timedelta
+) -> str:
+    """
+    Creates a token that carries the user's id, role and session, so checking it needs no DB.
+
+    Only the session's balance is stored; earlier sessions are left to expire.
+    """
+    issued_at = time.time()
+    expire = issued_at + expires_delta.total_seconds()
+    session_id = uuid4().hex
+
+    db.add(
+        UserSessionOrm(
+            id=session_id,
+            user_id=user.id,
+            expiry_time=datetime.fromtimestamp(expire),
+            deposited_amount=0,
+        )
     )
+    db.commit()
 
-    return encoded_jwt
+    claims = {
+        "sub": user.username,
+        "uid": user.id,
+        "role": user.role,
+        "sid": session_id,
+        # Kept fractional, so a revocation cuts off exactly at the moment it was made
+        "iat": issued_at,
+        "exp": int(expire),
+    }
+    with span("jwt.encode"):
+        return jwt.encode(claims, settings.jwt_secret, algorithm=settings.jwt_algorithm)
 
 
-async def _get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
+def _user_from_claims(payload: dict) -> Optional[SessionUser]:
+    try:
+        user = SessionUser(
+            id=payload["uid"],
+            username=payload["sub"],
+            role=payload["role"],
+            deposit=None,
+            session_id=payload["sid"],
+            issued_at=float(payload["iat"]),
+        )
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    if revocation_list.is_revoked(user.session_id, user.id, user.issued_at):
+        return None
+    return user
+
+
+@traced("auth.current_user")
+async def _get_current_user(
+    connection: HTTPConnection,
+    token: Annotated[str, Depends(oauth2_scheme)],
+    db: SessionLocal = Depends(get_db),
+):
+    # The sub-requests of a batch run as the user the batch was authenticated as
+    shared = getattr(connection.state, "user", None)
+    if shared is not None:
+        return shared
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(
-            token, settings.jwt_secret, algorithms=[settings.jwt_algorithm]
-        )
+        with span("jwt.decode"):
+            payload = jwt.decode(
+                token, settings.jwt_secret, algorithms=[settings.jwt_algorithm]
+            )
+        if settings.stateless_sessions:
+            # Now and then, the revocations whose events this worker missed
+            if revocation_list.sync_due():
+                await run_in_threadpool(revocation_list.sync, db)
+            # Everything needed is in the signed claims
+            user = _user_from_claims(payload)
+            if user is None:
+                raise credentials_exception
+            return user
+
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = _get_user(username=token_data.username)
-    if user is None:
+    # Only now, with a valid token, is the request's session opened
+    user = _get_user(db, token_data.username)
+    if user is None or user.disabled:
         raise credentials_exception
-    return UserWithoutPassword(**user.dict())
-
-
-async def _get_current_active_user(
-    current_user: Annotated[UserWithoutPassword, Depends(_get_current_user)]
-):
-    if current_user.disabled:
-        raise HTTPException(status_code=400, detail="Inactive user")
-    return current_user
+    return user_from_orm(user)
 
 
 async def get_buyer_user(
@@ -141,7 +224,7 @@ async def get_buyer_user(
     Raises:
         HTTPException: If the current user is not a buyer.
     """
-    if current_user.role != Role.buyer:
+    if current_user.role != Role.BUYER.value:
         raise HTTPException(status_code=400, detail="User is not a buyer")
     return current_user
 
@@ -155,7 +238,7 @@ async def get_seller_user(
     Raises:
         HTTPException: If the current user is not a seller.
     """
-    if current_user.role != Role.seller:
+    if current_user.role != Role.SELLER.value:
         raise HTTPException(status_code=400, detail="User is not a seller")
     return current_user
 
@@ -170,7 +253,36 @@ async def get_buyer_or_seller_user(
         HTTPException: If the current user role is not recognised.
     """
 
-    if current_user.role != Role.buyer and current_user.role != Role.seller:
+    if current_user.role not in (Role.BUYER.value, Role.SELLER.value):
         raise HTTPException(status_code=400, detail="User is not a buyer or seller")
 
     return current_user
+
+
+async def get_websocket_user(
+    websocket: WebSocket,
+    token: Optional[str] = None,
+    db: SessionLocal = Depends(get_db),
+):
+    """
+    Retrieves the user a WebSocket was opened by, from its bearer token.  Browsers
+    can't set headers on a WebSocket, so the token can also be sent as the ``token``
+    query parameter.
+
+    Raises:
+        WebSocketException: If there is no valid token, closing the socket with a policy violation.
+    """
+    scheme, _, credentials = websocket.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and credentials:
+        token = credentials
+    if not token:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION)
+
+    try:
+        current_user = await _get_current_user(websocket, token, db)
+        return await get_buyer_or_seller_user(current_user)
+    except HTTPException:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION)
+    finally:
+        # Not held for the life of the socket
+        db.close()
@@ -0,0 +1,227 @@
+"""
+Batched sub-requests.
+
+A kiosk interaction is a burst of small calls: who am I, what's in the
+machine, deposit, buy.  Made one by one, each pays for an HTTP round trip, a
+token check and a new DB session.  ``POST /batch`` takes them as one ordered
+list and runs each against the app's router in-process, in order.
+
+The sub-requests share the batch's authenticated user and DB session, which
+are put in their ASGI ``state`` where ``get_db`` and the authentication
+dependencies pick them up instead of opening a session or decoding the token
+again.  The state is never filled from the client, only by the batch.
+
+An atomic batch runs in one transaction, in which each handler's commit only
+releases a savepoint.  It is committed once every sub-request has succeeded,
+or rolled back at the first that didn't, and the rest are not run.  Its
+invalidation events are published when it ends, so no worker refills its
+caches from rows the transaction is still changing.
+"""
+
+import json
+from typing import Any, Optional
+
+from fastapi import HTTPException, Request
+from sqlalchemy.orm import Session
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.responses import JSONResponse
+from starlette.types import Message, Scope
+
+from vending_machine.config import settings
+from vending_machine.database import atomic_session
+from vending_machine.idempotency import IDEMPOTENCY_HEADER
+from vending_machine.invalidation import invalidation_bus
+from vending_machine.logging import get_logger
+from vending_machine.models.batch import (
+    BatchRequest,
+    BatchResponse,
+    SubRequest,
+    SubResponse,
+)
+from vending_machine.models.user import UserWithoutPassword
+
+logger = get_logger(__name__)
+
+BATCH_PATH = "/batch"
+
+# Headers of the batch request that every sub-request is sent with
+INHERITED_HEADERS = {"authorization", "user-agent"}
+
+
+class _RollBack(Exception):
+    pass
+
+
+def _sub_response(status: int, detail: str) -> SubResponse:
+    return SubResponse(
+        status=status,
+        headers={"content-type": "application/json"},
+        body={"detail": detail},
+    )
+
+
+def _scope(request: Request, state: dict, sub: SubRequest, body: bytes) -> Scope:
+    path, _, query = sub.path.partition("?")
+
+    headers = [
+        (name.encode("latin-1"), value.encode("latin-1"))
+        for name, value in request.headers.items()
+        if name in INHERITED_HEADERS
+    ]
+    headers += [
+        (name.lower().encode("latin-1"), value.encode("latin-1"))
+        for name, value in sub.headers.items()
+        if name.lower() not in INHERITED_HEADERS
+        and name.lower() not in ("content-type", "content-length")
+    ]
+    if body:
+        headers += [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ]
+
+    parent = request.scope
+    return {
+        "type": "http",
+        "asgi": parent.get("asgi", {"version": "3.0"}),
+        "http_version": parent.get("http_version", "1.1"),
+        "method": sub.method.upper(),
+        "scheme": parent["scheme"],
+        "server": parent.get("server"),
+        "client": parent.get("client"),
+        "root_path": parent.get("root_path", ""),
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "headers": headers,
+        "app": parent["app"],
+        "starlette.exception_handlers": parent.get("starlette.exception_handlers"),
+        "state": state,
+    }
+
+
+def _decode(headers: dict[str, str], body: bytes) -> Any:
+    if not body:
+        return None
+    if headers.get("content-type", "").startswith("application/json"):
+        return json.loads(body)
+    return body.decode(errors="replace")
+
+
+async def _dispatch(request: Request, state: dict, sub: SubRequest) -> SubResponse:
+    if sub.path.partition("?")[0] == BATCH_PATH:
+        return _sub_response(400, "Batches can't be nested")
+
+    body = b"" if sub.body is None else json.dumps(sub.body).encode()
+    scope = _scope(request, state, sub, body)
+
+    received = False
+    start: Optional[Message] = None
+    chunks: list[bytes] = []
+
+    async def receive() -> Message:
+        nonlocal received
+        if received:
+            return {"type": "http.disconnect"}
+        received = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message: Message) -> None:
+        nonlocal start
+        if message["type"] == "http.response.start":
+            start = message
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    try:
+        await request.app.router(scope, receive, send)
+    except StarletteHTTPException as e:
+        # Raised by the router itself, e.g. for an unknown path, before any handler
+        response = JSONResponse(
+            {"detail": e.detail}, status_code=e.status_code, headers=e.headers
+        )
+        await response(scope, receive, send)
+    except Exception as e:
+        logger.error(e)
+        return _sub_response(
+            500, "Internal server error" if not settings.debug else str(e)
+        )
+
+    headers = dict(Headers(raw=start["headers"]))
+    return SubResponse(
+        status=start["status"],
+        headers=headers,
+        body=_decode(headers, b"".join(chunks)),
+    )
+
+
+async def _run(
+    request: Request, state: dict, requests: list[SubRequest], atomic: bool
+) -> list[SubResponse]:
+    responses = []
+    for index, sub in enumerate(requests):
+        response = await _dispatch(request, state, sub)
+        responses.append(response)
+        if atomic and response.status >= 400:
+            responses += [
+                _sub_response(424, f"Not run, request {index} failed")
+                for _ in requests[index + 1 :]
+            ]
+            raise _RollBack(responses)
+    return responses
+
+
+async def run_batch(
+    request: Request,
+    batch: BatchRequest,
+    user: UserWithoutPassword,
+    db: Session,
+) -> BatchResponse:
+    """
+    Runs the batch's sub-requests in order, as the user and on the session given.
+
+    Args:
+        request (Request): The batch request, whose headers and connection the sub-requests inherit.
+        batch (BatchRequest): The sub-requests, and whether to run them in one transaction.
+        user (UserWithoutPassword): The user the batch was authenticated as.
+        db (Session): The batch's database session, shared by the sub-requests unless the batch is atomic.
+
+    Returns:
+        BatchResponse: A response for each sub-request, in order.
+
+    Raises:
+        HTTPException: If there are too many sub-requests, or an atomic one carries an idempotency key.
+    """
+    if len(batch.requests) > settings.batch_max_requests:
+        raise HTTPException(
+            status_code=413,
+            detail=f"A batch can have at most {settings.batch_max_requests} requests",
+        )
+
+    if not batch.atomic:
+        return BatchResponse(
+            responses=await _run(
+                request, {"user": user, "db": db}, batch.requests, False
+            )
+        )
+
+    # A key would be stored as used even if the transaction is then rolled back
+    if any(
+        name.lower() == IDEMPOTENCY_HEADER.lower()
+        for sub in batch.requests
+        for name in sub.headers
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail=f"The requests of an atomic batch can't carry an {IDEMPOTENCY_HEADER}",
+        )
+
+    try:
+        with invalidation_bus.deferred(), atomic_session(db.get_bind()) as session:
+            responses = await _run(
+                request, {"user": user, "db": session}, batch.requests, True
+            )
+    except _RollBack as e:
+        return BatchResponse(responses=e.args[0], rolledBack=True)
+    return BatchResponse(responses=responses)
@@ -0,0 +1,234 @@
+"""
+Streaming bulk import of products.
+
+The request body is read as it arrives and split into records line by line, so
+memory stays flat however large the upload is: at most ``bulk_chunk_size``
+records, and one line of at most ``bulk_max_line_length`` characters, are held
+at once.  Each chunk of records is validated against ``ProductCreate``; the
+rows that pass are inserted with one batched INSERT, plus one for their stock
+shards, and committed, while the rows that fail are reported by line number
+without stopping the import.
+
+Bodies are CSV with a header row naming the ``ProductCreate`` fields, or
+NDJSON with one ``ProductCreate`` object per line.
+"""
+
+import codecs
+import csv
+import json
+from typing import AsyncIterator, NamedTuple, Optional
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from vending_machine import stock
+from vending_machine.config import settings
+from vending_machine.data_objects.product import Product as ProductOrm
+from vending_machine.database import SessionLocal
+from vending_machine.invalidation import PRODUCTS, invalidation_bus
+from vending_machine.logging import get_logger
+from vending_machine.models.bulk import BulkImportResult, BulkRowError
+from vending_machine.models.conversion import product_columns
+from vending_machine.models.product import ProductCreate
+
+logger = get_logger(__name__)
+
+CSV_TYPES = {"text/csv", "application/csv"}
+NDJSON_TYPES = {"application/x-ndjson", "application/ndjson", "application/jsonl"}
+
+
+class Record(NamedTuple):
+    # The line the record starts on
+    row: int
+    data: Optional[dict]
+    # Set instead of data when the record couldn't be parsed
+    error: Optional[str] = None
+
+
+def _too_long(row: int) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Row {row} is longer than {settings.bulk_max_line_length} characters",
+    )
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, str]]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    number = 0
+
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *complete, pending = pending.split("\n")
+        for line in complete:
+            number += 1
+            yield number, line.rstrip("\r")
+        if len(pending) > settings.bulk_max_line_length:
+            raise _too_long(number + 1)
+
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield number + 1, pending.rstrip("\r")
+
+
+async def _csv_records(lines: AsyncIterator[tuple[int, str]]) -> AsyncIterator[Record]:
+    header = None
+    buffered: list[str] = []
+    start = 0
+
+    async for number, line in lines:
+        if not buffered:
+            start = number
+        buffered.append(line)
+        text = "\n".join(buffered)
+
+        # An odd number of quotes means a quoted field carries on onto the next line
+        if text.count('"') % 2:
+            if len(text) > settings.bulk_max_line_length:
+                raise _too_long(start)
+            continue
+        buffered = []
+
+        if not text.strip():
+            continue
+        values = next(csv.reader([text]))
+
+        if header is None:
+            header = [name.strip() for name in values]
+        elif len(values) != len(header):
+            yield Record(
+                start, None, f"Expected {len(header)} fields, got {len(values)}"
+            )
+        else:
+            yield Record(start, dict(zip(header, values)))
+
+    if buffered:
+        yield Record(start, None, "Unterminated quoted field")
+
+
+async def _ndjson_records(
+    lines: AsyncIterator[tuple[int, str]]
+) -> AsyncIterator[Record]:
+    async for number, line in lines:
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            yield Record(number, None, f"Invalid JSON: {e}")
+            continue
+
+        if isinstance(data, dict):
+            yield Record(number, data)
+        else:
+            yield Record(number, None, "Expected a JSON object")
+
+
+def records(content_type: str, chunks: AsyncIterator[bytes]) -> AsyncIterator[Record]:
+    """
+    Parses a streamed body into records, by its content type.
+
+    Raises:
+        HTTPException: If the body is neither CSV nor NDJSON.
+    """
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type in CSV_TYPES:
+        return _csv_records(_lines(chunks))
+    if media_type in NDJSON_TYPES:
+        return _ndjson_records(_lines(chunks))
+
+    raise HTTPException(
+        status_code=415, detail="Products must be uploaded as CSV or NDJSON"
+    )
+
+
+def _fail(result: BulkImportResult, row: int, errors: list) -> None:
+    result.failed += 1
+    if len(result.errors) < settings.bulk_max_errors:
+        result.errors.append(BulkRowError(row=row, errors=errors))
+    else:
+        result.errorsTruncated = True
+
+
+def _import_chunk(
+    db: SessionLocal, seller_id: str, chunk: list[Record], result: BulkImportResult
+) -> None:
+    rows = []
+    numbers = []
+    for record in chunk:
+        if record.error:
+            _fail(result, record.row, [record.error])
+            continue
+        try:
+            product = ProductCreate.model_validate(record.data)
+        except ValidationError as e:
+            _fail(
+                result, record.row, e.errors(include_url=False, include_context=False)
+            )
+            continue
+
+        rows.append({**product_columns(product), "seller_id": seller_id})
+        numbers.append(record.row)
+
+    if not rows:
+        return
+
+    try:
+        ids = (
+            db.execute(
+                insert(ProductOrm).returning(
+                    ProductOrm.id, sort_by_parameter_order=True
+                ),
+                rows,
+            )
+            .scalars()
+            .all()
+        )
+        stock.set_stocks(
+            db, {id: row["amount_available"] for id, row in zip(ids, rows)}
+        )
+        db.commit()
+    except SQLAlchemyError as e:
+        logger.error(e)
+        db.rollback()
+        for number in numbers:
+            _fail(result, number, ["The row could not be stored"])
+        return
+
+    result.created += len(ids)
+    # One event for the chunk, rather than a send to every worker per product
+    invalidation_bus.publish(PRODUCTS)
+
+
+async def import_products(
+    db: SessionLocal, seller_id: str, records: AsyncIterator[Record]
+) -> BulkImportResult:
+    """
+    Imports the records as products of the seller, committing every chunk.
+
+    Args:
+        db (SessionLocal): The database session.
+        seller_id (str): The seller the products are created for.
+        records (AsyncIterator[Record]): The records, as parsed by ``records``.
+
+    Returns:
+        BulkImportResult: How many products were created, and the rows that failed.
+
+    Raises:
+        HTTPException: If a row is too long.  The chunks before it stay imported.
+    """
+    result = BulkImportResult(created=0, failed=0, errors=[])
+    chunk: list[Record] = []
+
+    async for record in records:
+        chunk.append(record)
+        if len(chunk) >= settings.bulk_chunk_size:
+            _import_chunk(db, seller_id, chunk, result)
+            chunk = []
+
+    if chunk:
+        _import_chunk(db, seller_id, chunk, result)
+
+    return result
@@ -0,0 +1,17 @@
+from collections import OrderedDict
+
+
+class BoundedCache(OrderedDict):
+    """
+    An ``OrderedDict`` that drops its least recently used entries beyond ``max_entries``.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        super().__init__()
+        self.max_entries = max_entries
+
+    def touch(self, key, value) -> None:
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.max_entries:
+            self.popitem(last=False)
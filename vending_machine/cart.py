@@ -0,0 +1,67 @@
+"""
+The products bought in a session.
+
+A session's cart holds one ``session_products`` row per product, whose
+quantity each purchase adds to with an upsert, so it stays as small as the
+number of distinct products however many units are bought.  It is read with
+the session, in one extra query, by loading the session with ``CART``.
+"""
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import joinedload, selectinload
+
+from vending_machine.data_objects.session import UserSession as UserSessionOrm
+from vending_machine.data_objects.session_product import (
+    SessionProduct as SessionProductOrm,
+)
+from vending_machine.database import SessionLocal
+from vending_machine.models.session_product import SessionProduct
+
+# Loader option fetching a session's cart, and each line's product, in one SELECT
+CART = selectinload(UserSessionOrm.products).joinedload(SessionProductOrm.product)
+
+
+def add(db: SessionLocal, session_id: str, product_id: int, quantity: int) -> None:
+    """
+    Adds units of a product to the session's cart.  Doesn't commit, so it lands with the purchase.
+    """
+    statement = sqlite_insert(SessionProductOrm).values(
+        session_id=session_id, product_id=product_id, quantity=quantity
+    )
+    db.execute(
+        statement.on_conflict_do_update(
+            index_elements=[SessionProductOrm.session_id, SessionProductOrm.product_id],
+            set_={"quantity": SessionProductOrm.quantity + statement.excluded.quantity},
+        )
+    )
+
+
+def clear(db: SessionLocal, user_id: str) -> None:
+    """
+    Empties the carts of all the user's sessions.  Doesn't commit.
+    """
+    db.execute(
+        delete(SessionProductOrm).where(
+            SessionProductOrm.session_id.in_(
+                select(UserSessionOrm.id).where(UserSessionOrm.user_id == user_id)
+            )
+        )
+    )
+
+
+def items(user_session: UserSessionOrm) -> list[SessionProduct]:
+    """
+    Returns the lines of a session's cart, which should have been loaded with ``CART``.
+    """
+    return [
+        SessionProduct(
+            productId=str(line.product_id),
+            productName=line.product.product_name,
+            cost=line.product.cost,
+            quantity=line.quantity,
+        )
+        for line in user_session.products
+        # Lines of products deleted since are left out
+        if line.product is not None
+    ]
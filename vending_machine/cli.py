@@ -0,0 +1,115 @@
+"""
+Admin commands.
+
+Run with ``python -m vending_machine.cli <command>``, see ``--help``.
+"""
+
+import argparse
+import sqlite3
+import sys
+import time
+
+from vending_machine import sales
+from vending_machine.database import SessionLocal, engine, restore, snapshot
+from vending_machine.invalidation import (
+    PRODUCTS,
+    REVOCATIONS,
+    SESSIONS,
+    USERS,
+    invalidation_bus,
+)
+from vending_machine.profiling import sign
+
+
+def rebuild_sales(args: argparse.Namespace) -> int:
+    db = SessionLocal()
+    try:
+        drift = sales.rebuild(db, apply=args.apply)
+    finally:
+        db.close()
+
+    for row in drift:
+        print(
+            f"seller {row.seller_id} product {row.product_id}: "
+            f"summary {row.summary.units_sold} units / {row.summary.revenue}, "
+            f"recomputed {row.recomputed.units_sold} units / {row.recomputed.revenue}"
+        )
+    print(f"{len(drift)} rows drifted" + (", summary rebuilt" if args.apply else ""))
+
+    return 1 if drift and not args.apply else 0
+
+
+def take_snapshot(args: argparse.Namespace) -> int:
+    snapshot(engine, args.path).close()
+    print(f"Snapshot written to {args.path}")
+    return 0
+
+
+def reset_to_snapshot(args: argparse.Namespace) -> int:
+    try:
+        restore(args.path, engine)
+    except sqlite3.Error as e:
+        print(f"Could not restore {args.path}: {e}", file=sys.stderr)
+        return 1
+
+    # Running workers drop everything they cached from the replaced rows, and
+    # reload their revocations from the replaced table
+    for topic in (USERS, PRODUCTS, SESSIONS, REVOCATIONS):
+        invalidation_bus.publish(topic)
+
+    print(f"Database reset to {args.path}")
+    return 0
+
+
+def profile_header(args: argparse.Namespace) -> int:
+    print(f"X-Profile: {sign(int(time.time()) + args.ttl)}")
+    return 0
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m vending_machine.cli")
+    commands = parser.add_subparsers(required=True)
+
+    rebuild = commands.add_parser(
+        "rebuild-sales",
+        help="Recompute the sales summary from the purchases and report drift",
+    )
+    rebuild.add_argument(
+        "--apply",
+        action="store_true",
+        help="Replace the summary with the recomputed one",
+    )
+    rebuild.set_defaults(command=rebuild_sales)
+
+    take = commands.add_parser(
+        "snapshot", help="Copy the database to a snapshot file, e.g. once it is seeded"
+    )
+    take.add_argument("path", help="The snapshot file to write")
+    take.set_defaults(command=take_snapshot)
+
+    reset = commands.add_parser(
+        "reset-to-snapshot",
+        help="Replace the contents of the database with those of a snapshot file",
+    )
+    reset.add_argument("path", help="The snapshot file to restore")
+    reset.set_defaults(command=reset_to_snapshot)
+
+    profile = commands.add_parser(
+        "profile-header",
+        help="Make a header that has the requests carrying it profiled",
+    )
+    profile.add_argument(
+        "--ttl", type=int, default=3600, help="Seconds the header is accepted for"
+    )
+    profile.set_defaults(command=profile_header)
+
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = get_parser().parse_args(argv)
+    return args.command(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
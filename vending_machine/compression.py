@@ -0,0 +1,160 @@
+"""
+Response compression.
+
+Responses are compressed with gzip or deflate, whichever the client's
+``Accept-Encoding`` prefers, once they are at least ``compression_minimum_size``
+bytes; below that the framing costs more than it saves.
+
+The catalogue is fetched far more often than it changes, so for the routes in
+``CACHEABLE`` the compressed bytes are kept with the version of the
+invalidation bus topic the route depends on and a CRC of the uncompressed
+body.  While both still match, the stored bytes are sent again instead of
+compressing the same body once per request.
+"""
+
+import gzip
+import zlib
+from typing import Callable, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from vending_machine.cache import BoundedCache
+from vending_machine.config import settings
+from vending_machine.invalidation import PRODUCTS, invalidation_bus
+
+ENCODINGS = ("gzip", "deflate")
+
+# Path -> the invalidation bus topic its response depends on
+CACHEABLE = {"/products": PRODUCTS}
+
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Picks the encoding to use for an ``Accept-Encoding`` header, None for identity.
+    """
+    if not accept_encoding:
+        return None
+
+    weights: dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        weight = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.lower()] = weight
+
+    best, best_weight = None, 0.0
+    for encoding in ENCODINGS:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compress(body: bytes, encoding: str, level: int) -> bytes:
+    if encoding == "gzip":
+        # A fixed mtime keeps the output the same for the same body
+        return gzip.compress(body, compresslevel=level, mtime=0)
+    return zlib.compress(body, level)
+
+
+class CompressionMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = settings.compression_minimum_size,
+        level: int = settings.compression_level,
+        cacheable: Optional[dict[str, str]] = None,
+        version: Callable[[str], int] = invalidation_bus.version,
+        max_entries: int = 256,
+    ) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        self.cacheable = CACHEABLE if cacheable is None else cacheable
+        self.version = version
+        # (path, query string, encoding) -> (topic version, body CRC, compressed body)
+        self._cache = BoundedCache(max_entries)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Message] = None
+        chunks: list[bytes] = []
+        streaming = False
+
+        async def buffered_send(message: Message) -> None:
+            nonlocal start, streaming
+
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or streaming:
+                await send(message)
+                return
+
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                # A streamed response is passed through as it comes
+                streaming = True
+                await send(start)
+                await send({**message, "body": b"".join(chunks)})
+                return
+
+            await self._send(scope, start, b"".join(chunks), encoding, send)
+
+        await self.app(scope, receive, buffered_send)
+
+    def _compressed(self, scope: Scope, body: bytes, encoding: str) -> bytes:
+        topic = self.cacheable.get(scope["path"]) if scope["method"] == "GET" else None
+        if topic is None:
+            return compress(body, encoding, self.level)
+
+        key = (scope["path"], scope.get("query_string", b""), encoding)
+        version = self.version(topic)
+        crc = zlib.crc32(body)
+
+        cached = self._cache.get(key)
+        if cached and cached[0] == version and cached[1] == crc:
+            self._cache.move_to_end(key)
+            return cached[2]
+
+        compressed = compress(body, encoding, self.level)
+        self._cache.touch(key, (version, crc, compressed))
+        return compressed
+
+    async def _send(
+        self, scope: Scope, start: Message, body: bytes, encoding: str, send: Send
+    ) -> None:
+        headers = MutableHeaders(scope=start)
+
+        if (
+            len(body) >= self.minimum_size
+            and start["status"] == 200
+            and "content-encoding" not in headers
+        ):
+            body = self._compressed(scope, body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+
+            # The compressed bytes differ from the identity ones, so a strong tag can't be shared
+            tag = headers.get("etag")
+            if tag and not tag.startswith("W/"):
+                headers["ETag"] = f"W/{tag}"
+
+        await send(start)
+        await send({"type": "http.response.body", "body": body})
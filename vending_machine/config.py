@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -6,10 +8,110 @@ class Settings(BaseSettings):
     host: str = "0.0.0.0"
     port: int = 8000
     debug: bool = False
+
+    # Server processes, see vending_machine.server
+    workers: int = 1
+    server_loop: str = "auto"  # "auto", "uvloop" or "asyncio"
+    server_http: str = "auto"  # "auto", "httptools" or "h11"
+    server_backlog: int = 2048
+    server_keep_alive_timeout: int = 5
+    server_limit_concurrency: Optional[int] = None
+    graceful_shutdown_timeout: int = 30
+    # A worker dying sooner than this after starting, in seconds, is restarted with
+    # backoff, and the server gives up after this many of those in a row
+    worker_min_uptime: float = 10.0
+    worker_max_fast_failures: int = 5
+    # Warm each worker up before reporting it ready, see vending_machine.warmup
+    warmup: bool = True
+    # Directory for the workers' invalidation bus sockets, defaults to one in the temp dir
+    invalidation_bus_dir: Optional[str] = None
+
+    # Responses smaller than this, in bytes, are sent uncompressed
+    compression_minimum_size: int = 1024
+    compression_level: int = 6
+
     database_url: str = "sqlite:///./vending_machine.sqlite"
     jwt_secret: str
     jwt_timeout: int = 3600
     jwt_algorithm: str = "HS256"
+    # Carry the role, session id and expiry in the token instead of looking them up
+    stateless_sessions: bool = False
+    # Seconds between reads of the revocations table, for revocations whose
+    # events a worker missed
+    revocation_sync_interval: float = 1.0
+
+    # Login admission control; rates are attempts per second
+    login_username_rate: float = 0.1
+    login_username_burst: int = 5
+    login_client_rate: float = 1.0
+    login_client_burst: int = 20
+    login_negative_cache_ttl: int = 60
+    login_guard_max_entries: int = 10000
+
+    # Idempotency-Key replay window, in seconds, and in-memory LRU size
+    idempotency_ttl: int = 86400
+    idempotency_cache_size: int = 10000
+
+    # Rows each product's stock is split across
+    stock_shards: int = 8
+
+    # Ledger entries appended to an account before its balance is snapshotted
+    ledger_snapshot_interval: int = 64
+
+    # Bulk product import: rows per transaction, row errors reported, longest row
+    bulk_chunk_size: int = 500
+    bulk_max_errors: int = 1000
+    bulk_max_line_length: int = 65536
+    # Bulk user provisioning: users per request, and password hashing processes
+    bulk_max_users: int = 1000
+    password_hash_workers: Optional[int] = None  # Defaults to the CPU count
+
+    # Sub-requests per POST /batch
+    batch_max_requests: int = 50
+
+    # Messages queued per /machine/live subscriber before it is dropped as too slow
+    live_queue_size: int = 64
+
+    # Requests profiled without an X-Profile header, see vending_machine.profiling;
+    # the route rates are keyed by route path and override the overall one
+    profile_sample_rate: float = 0.0
+    profile_route_rates: dict[str, float] = {}
+    # Directory for the profiles, defaults to one in the temp dir, and its size cap in bytes
+    profile_dir: Optional[str] = None
+    profile_max_bytes: int = 64 * 1024 * 1024
+
+    # Per-request spans, see vending_machine.tracing: traces kept in memory, the
+    # JSON-lines file they are also appended to, and the spans kept per trace
+    tracing: bool = False
+    trace_buffer_size: int = 256
+    trace_file: Optional[str] = None
+    trace_max_spans: int = 1000
+
+    # Statement timing and plans, see vending_machine.slow_queries: statements slower
+    # than this, in milliseconds, are logged; stats are kept for this many statements
+    slow_query_log: bool = True
+    slow_query_ms: float = 100.0
+    slow_query_max_statements: int = 500
+
+    # Load shedding, see vending_machine.shedding: per priority class, the requests run
+    # at once, the requests queued beyond those, the seconds one may wait queued and
+    # optionally the requests let in without a turn per coalesced read in flight;
+    # routes are "[METHOD ]/path" patterns, the first match picks the class
+    load_shedding: bool = True
+    load_shedding_classes: dict[str, dict[str, float]] = {
+        "critical": {"concurrency": 64, "queue": 256, "wait": 5.0},
+        "normal": {"concurrency": 32, "queue": 64, "wait": 2.0},
+        "bulk": {"concurrency": 4, "queue": 16, "wait": 1.0, "coalesce": 64},
+    }
+    load_shedding_routes: dict[str, str] = {
+        "/machine/buy/*": "critical",
+        "/machine/deposit": "critical",
+        "/heartbeat": "critical",
+        "GET /products": "bulk",
+        "GET /users": "bulk",
+        "/products/bulk": "bulk",
+        "/users/bulk": "bulk",
+    }
 
     model_config = SettingsConfigDict(env_file=".env")
 
@@ -1,18 +1,28 @@
 from datetime import timedelta
+from math import ceil
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
 
 from vending_machine.authentication import (
     authenticate_user,
     create_access_token,
+    create_stateless_access_token,
     get_buyer_or_seller_user,
 )
 from vending_machine.config import settings
+from vending_machine.data_objects.session import UserSession as UserSessionOrm
+from vending_machine.database import get_db
+from vending_machine.invalidation import SESSIONS, invalidation_bus
 from vending_machine.logging import get_logger
+from vending_machine.login_guard import login_guard
+from vending_machine.models.api_messages import ApiMessage
 from vending_machine.models.token import Token
 from vending_machine.models.user import User, UserWithoutPassword
+from vending_machine.revocation import revocation_list
 
 routes = APIRouter()
 logger = get_logger(__name__)
@@ -29,26 +39,48 @@ async def whoami(user: User = Depends(get_buyer_or_seller_user)):
     Returns:
     - UserWithoutPassword: The user information without the password.
     """
-    return UserWithoutPassword(user)
+    return user
 
 
 @routes.post("/auth/token", response_model=Token, tags=["auth"])
 async def login_for_access_token(
-    form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
+    request: Request,
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+    db: Session = Depends(get_db),
 ) -> Token:
     """
     Authenticates a user and generates an access token.
 
+    Attempts are rate limited per username and per client, and attempts known to
+    fail are rejected before reaching the DB or bcrypt.  With stateless sessions, the
+    token carries the user's id, role and session, and only the session is stored.
+
     Args:
+        request (Request): The incoming request, used to identify the client.
         form_data (OAuth2PasswordRequestForm): The form data containing the username and password.
+        db (Session, optional): The database session. Defaults to Depends(get_db).
 
     Returns:
         Token: The generated access token.
 
     Raises:
-        HTTPException: If the user fails to authenticate.
+        HTTPException: If the client or username is over its attempt budget, or the user fails to authenticate.
     """
-    user = authenticate_user(form_data.username, form_data.password)
+    client = request.client.host if request.client else "unknown"
+    retry_after = login_guard.admit(form_data.username, client)
+    if retry_after is not None:
+        logger.info(f"Login attempt for {form_data.username} from {client} throttled")
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts",
+            headers={"Retry-After": str(ceil(retry_after))},
+        )
+
+    if login_guard.is_known_failure(form_data.username, form_data.password):
+        user = False
+    else:
+        user = authenticate_user(db, form_data.username, form_data.password)
+
     if not user:
         logger.info(f"User {form_data.username} failed to authenticate")
         raise HTTPException(
@@ -57,8 +89,39 @@ async def login_for_access_token(
             headers={"WWW-Authenticate": "Bearer"},
         )
     access_token_expires = timedelta(seconds=settings.jwt_timeout)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
+    if settings.stateless_sessions:
+        access_token = create_stateless_access_token(db, user, access_token_expires)
+    else:
+        access_token = create_access_token(db, user, access_token_expires)
     logger.info(f"User {form_data.username} authenticated successfully")
     return Token(access_token=access_token, token_type="bearer")
+
+
+@routes.post("/auth/logout", response_model=ApiMessage, tags=["auth"])
+async def logout(
+    user: User = Depends(get_buyer_or_seller_user),
+    db: Session = Depends(get_db),
+) -> ApiMessage:
+    """
+    Ends the current user's session.
+
+    A stateless token stays valid until it expires, so its session is added to the
+    revocation list; otherwise the user's sessions are deleted.
+
+    Args:
+        user (User): The current user.
+        db (Session, optional): The database session. Defaults to Depends(get_db).
+
+    Returns:
+        ApiMessage: A message confirming the logout.
+    """
+    session_id = getattr(user, "session_id", None)
+    if settings.stateless_sessions and session_id:
+        revocation_list.revoke_session(db, session_id)
+    else:
+        db.execute(delete(UserSessionOrm).where(UserSessionOrm.user_id == user.id))
+        db.commit()
+
+    invalidation_bus.publish(SESSIONS, user.id)
+    logger.info(f"User {user.username} logged out")
+    return ApiMessage(message="Logged out", success=True)
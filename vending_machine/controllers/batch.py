@@ -0,0 +1,51 @@
+from fastapi import APIRouter, Depends, HTTPException, Request
+from sqlalchemy.orm import Session
+
+from vending_machine.authentication import get_buyer_or_seller_user
+from vending_machine.batch import BATCH_PATH, run_batch
+from vending_machine.config import settings
+from vending_machine.database import get_db
+from vending_machine.logging import get_logger
+from vending_machine.models.batch import BatchRequest, BatchResponse
+from vending_machine.models.user import UserWithoutPassword
+
+routes = APIRouter()
+logger = get_logger(__name__)
+
+
+@routes.post(BATCH_PATH, response_model=BatchResponse, tags=["batch"])
+async def batch(
+    request: Request,
+    batch: BatchRequest,
+    current_user: UserWithoutPassword = Depends(get_buyer_or_seller_user),
+    db: Session = Depends(get_db),
+) -> BatchResponse:
+    """
+    Runs several requests in one round trip, in order, as the current user and on one DB session.
+
+    A sub-request's failure doesn't stop the others, unless the batch is atomic: then the
+    requests run in one transaction, which is rolled back at the first failure, and the
+    requests after it are answered with a 424 without being run.
+
+    Args:
+        request (Request): The batch request, whose Authorization the sub-requests inherit.
+        batch (BatchRequest): The sub-requests, and whether to run them atomically.
+        current_user (UserWithoutPassword): The current user.
+        db (Session, optional): The database session. Defaults to Depends(get_db).
+
+    Returns:
+        BatchResponse: The status, headers and body of each sub-request's response, in order.
+
+    Raises:
+        HTTPException: If there are too many sub-requests, or an atomic one carries an idempotency key.
+    """
+    try:
+        return await run_batch(request, batch, current_user, db)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(
+            status_code=500,
+            detail="Internal server error" if not settings.debug else str(e),
+        )
@@ -0,0 +1,57 @@
+from typing import Any
+
+from fastapi import APIRouter, HTTPException
+
+from vending_machine.config import settings
+from vending_machine.logging import get_logger
+from vending_machine.shedding import load_shedder
+from vending_machine.slow_queries import query_log
+from vending_machine.tracing import tracer
+
+routes = APIRouter()
+logger = get_logger(__name__)
+
+
+def _require_debug() -> None:
+    # Only served in debug mode, and then as if the routes weren't there otherwise
+    if not settings.debug:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+@routes.get("/debug/traces", tags=["debug"], include_in_schema=False)
+async def recent_traces(limit: int = 20) -> Any:
+    """
+    Lists the spans of the most recent traces kept by this worker, newest last.
+
+    Args:
+        limit (int, optional): The traces to list. Defaults to 20.
+    """
+    _require_debug()
+    return [
+        {"traceId": trace.trace_id, "spans": trace.as_dicts()}
+        for trace in tracer.recent(limit)
+    ]
+
+
+@routes.get("/debug/slow-queries", tags=["debug"], include_in_schema=False)
+async def slow_queries(limit: int = 50, slow_only: bool = True) -> Any:
+    """
+    Lists the statements this worker has run, those that took the most time in all
+    first, with their query plans.
+
+    Args:
+        limit (int, optional): The statements to list. Defaults to 50.
+        slow_only (bool, optional): Only list those that were slow at least once. Defaults to True.
+    """
+    _require_debug()
+    return [entry.as_dict() for entry in query_log.stats(slow_only)[:limit]]
+
+
+@routes.get("/debug/load", tags=["debug"], include_in_schema=False)
+async def load() -> Any:
+    """
+    Reports each priority class's budget, the requests it is running and queueing,
+    and how many it has admitted and shed, by reason.
+    """
+    _require_debug()
+    return load_shedder.stats()
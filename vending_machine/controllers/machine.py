@@ -1,16 +1,37 @@
+import asyncio
 from datetime import datetime
 from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    WebSocket,
+    WebSocketDisconnect,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from vending_machine.authentication import get_buyer_or_seller_user, get_buyer_user
+from vending_machine import cart, ledger, sales, stock
+from vending_machine.authentication import (
+    get_buyer_or_seller_user,
+    get_buyer_user,
+    get_websocket_user,
+)
 from vending_machine.config import settings
+from vending_machine.data_objects.product import Product as ProductOrm
+from vending_machine.data_objects.session import UserSession as UserSessionOrm
 from vending_machine.database import get_db
+from vending_machine.idempotency import IDEMPOTENCY_HEADER, idempotency_store
+from vending_machine.invalidation import PRODUCTS, SESSIONS, invalidation_bus
+from vending_machine.live import Subscriber, live_hub
 from vending_machine.logging import get_logger
 from vending_machine.models.api_messages import ApiMessage
+from vending_machine.models.conversion import product_from_orm
 from vending_machine.models.product import Product
-from vending_machine.models.session import UserSession
 from vending_machine.models.session_product import SessionProduct
 from vending_machine.models.user import UserWithoutPassword
 
@@ -22,29 +43,39 @@ routes = APIRouter()
 async def __get_user_session(
     current_user: UserWithoutPassword = Depends(get_buyer_user),
     db: AsyncSession = Depends(get_db),
-) -> Optional[UserSession]:
-    return (
-        await db.query(UserSession)
-        .filter(
-            UserSession.user_id == current_user.id,
-            UserSession.expiry_time > datetime.now(),
+    with_cart: bool = False,
+) -> Optional[UserSessionOrm]:
+    options = [cart.CART] if with_cart else []
+
+    session_id = getattr(current_user, "session_id", None)
+    if settings.stateless_sessions and session_id:
+        # The token already vouched for the session; only its balance is stored
+        return db.get(UserSessionOrm, session_id, options=options)
+
+    return db.scalars(
+        select(UserSessionOrm)
+        .where(
+            UserSessionOrm.user_id == current_user.id,
+            UserSessionOrm.expiry_time > datetime.now(),
         )
-        .last()
-    )
+        .order_by(UserSessionOrm.expiry_time.desc())
+        .limit(1)
+        .options(*options)
+    ).first()
 
 
-@routes.get("/machine/products", response_model=list[Product], tags=["machine"])
+@routes.get("/machine/products", response_model=list[SessionProduct], tags=["machine"])
 async def get_products(
     current_user: UserWithoutPassword = Depends(get_buyer_user),
     db: AsyncSession = Depends(get_db),
-) -> list[Product]:
+) -> list[SessionProduct]:
     try:
-        user_session = await __get_user_session(current_user, db)
+        user_session = await __get_user_session(current_user, db, with_cart=True)
 
         if not user_session:
             raise HTTPException(status_code=404, detail="Session not found")
 
-        return user_session.products
+        return cart.items(user_session)
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -55,11 +86,26 @@ async def get_products(
         )
 
 
-@routes.post("/machine/deposit", response_model=int, tags=["machine"])
+@routes.post("/machine/deposit", response_model=ApiMessage, tags=["machine"])
 async def deposit(
     amount: int,
     current_user: UserWithoutPassword = Depends(get_buyer_or_seller_user),
     db: AsyncSession = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER),
+) -> ApiMessage:
+    return await idempotency_store.run(
+        db,
+        current_user.id,
+        idempotency_key,
+        f"deposit:{amount}",
+        lambda session: _deposit(amount, current_user, session),
+    )
+
+
+async def _deposit(
+    amount: int,
+    current_user: UserWithoutPassword,
+    db: AsyncSession,
 ) -> ApiMessage:
     try:
         assert amount > 0, "Amount must be greater than 0"
@@ -75,8 +121,11 @@ async def deposit(
         if not user_session:
             raise HTTPException(status_code=404, detail="Session not found")
 
+        ledger.deposit(db, current_user.id, amount, user_session.id)
         user_session.deposited_amount += amount
-        await db.commit()
+        db.commit()
+
+        invalidation_bus.publish(SESSIONS, current_user.id)
         return ApiMessage(message="Deposited successfully", success=True)
     except HTTPException as e:
         raise e
@@ -96,6 +145,22 @@ async def buy_product(
     amount: int,
     current_user: UserWithoutPassword = Depends(get_buyer_user),
     db: AsyncSession = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER),
+) -> Product:
+    return await idempotency_store.run(
+        db,
+        current_user.id,
+        idempotency_key,
+        f"buy:{product_id}:{amount}",
+        lambda session: _buy_product(product_id, amount, current_user, session),
+    )
+
+
+async def _buy_product(
+    product_id: str,
+    amount: int,
+    current_user: UserWithoutPassword,
+    db: AsyncSession,
 ) -> Product:
     try:
         assert amount > 0, "Amount must be greater than 0"
@@ -104,18 +169,40 @@ async def buy_product(
         if not user_session:
             raise HTTPException(status_code=404, detail="Session not found")
 
-        product = await db.query(Product).filter(Product.id == product_id).first()
+        product = db.get(ProductOrm, product_id)
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
 
-        if product.price > user_session.deposited_amount:
+        balance = ledger.balance(db, current_user.id)
+        if product.cost * amount > balance:
             raise HTTPException(status_code=400, detail="Insufficient funds")
 
-        user_session.deposited_amount -= product.price * amount
-        user_session.products.append(product * amount)
+        if not stock.reserve(db, product.id, amount):
+            raise HTTPException(status_code=400, detail="Insufficient stock")
 
-        await db.commit()
-        return product
+        ledger.purchase(
+            db, current_user.id, product.id, amount, product.cost, user_session.id
+        )
+        user_session.deposited_amount = balance - product.cost * amount
+        sales.record_sale(
+            db,
+            product.seller_id,
+            product.id,
+            product.product_name,
+            amount,
+            product.cost * amount,
+        )
+        cart.add(db, user_session.id, product.id, amount)
+        # The stock left is in the shards, as GET /products/{id} reports it
+        left = stock.total_stock(db, product.id)
+
+        db.commit()
+
+        invalidation_bus.publish(SESSIONS, current_user.id)
+        invalidation_bus.publish(PRODUCTS, product_id)
+        bought = product_from_orm(product)
+        bought.amountAvailable = left
+        return bought
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -132,11 +219,83 @@ async def reset(
     db: AsyncSession = Depends(get_db),
 ) -> ApiMessage:
     try:
-        await db.query(SessionProduct).filter(
-            SessionProduct.user_id == current_user.id
-        ).delete()
-        await db.commit()
+        # Whatever is left of the deposit is handed back
+        balance = ledger.balance(db, current_user.id)
+        if balance > 0:
+            user_session = await __get_user_session(current_user, db)
+            ledger.refund(
+                db,
+                current_user.id,
+                balance,
+                user_session.id if user_session else None,
+            )
+            if user_session:
+                user_session.deposited_amount = 0
+
+        cart.clear(db, current_user.id)
+        db.commit()
+
+        invalidation_bus.publish(SESSIONS, current_user.id)
         return True
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail="Internal server error")
+
+
+async def _close_on_disconnect(websocket: WebSocket, subscriber: Subscriber) -> None:
+    # Nothing is expected from the client; this only notices it going away
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        subscriber.close()
+
+
+@routes.websocket("/machine/live")
+async def live(
+    websocket: WebSocket,
+    current_user: UserWithoutPassword = Depends(get_websocket_user),
+) -> None:
+    """
+    Pushes the current user's balance and the catalogue's stock as they change.
+
+    The first messages are the balance and the stock of every product; after that a
+    ``balance`` message follows every deposit, purchase or refund, with the entry that
+    caused it, and a ``stock`` message carries the products whose stock changed.  A
+    client that doesn't keep up is disconnected with 1013 (try again later), and one
+    whose token is revoked, e.g. by logging out, with 1008 (policy violation).
+
+    Args:
+        websocket (WebSocket): The connection.
+        current_user (UserWithoutPassword): The current user, from the bearer token.
+    """
+    # Subscribed before the snapshot is read, so no change falls in between
+    subscriber = live_hub.subscribe(
+        current_user.id,
+        current_user.username,
+        getattr(current_user, "session_id", None),
+        getattr(current_user, "issued_at", None),
+    )
+    receiver = None
+    try:
+        await websocket.accept()
+        for message in await run_in_threadpool(live_hub.snapshot, current_user.id):
+            await websocket.send_json(message)
+
+        receiver = asyncio.create_task(_close_on_disconnect(websocket, subscriber))
+        while (message := await subscriber.queue.get()) is not None:
+            await websocket.send_json(message)
+
+        if subscriber.revoked:
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        elif subscriber.dropped:
+            await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(e)
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+    finally:
+        live_hub.unsubscribe(subscriber)
+        if receiver is not None:
+            receiver.cancel()
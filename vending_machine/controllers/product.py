@@ -1,14 +1,32 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
 from pydantic import ValidationError
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
 
+from vending_machine import bulk, etag, sales, search, stock
 from vending_machine.authentication import get_buyer_or_seller_user, get_seller_user
 from vending_machine.config import settings
+from vending_machine.data_objects.product import Product as ProductOrm
 from vending_machine.database import get_db
+from vending_machine.invalidation import PRODUCTS, invalidation_bus
 from vending_machine.logging import get_logger
 from vending_machine.models.api_messages import ApiMessage
+from vending_machine.models.bulk import BulkImportResult
+from vending_machine.models.conversion import (
+    list_adapter,
+    product_columns,
+    product_from_orm,
+    products_from_orm,
+)
 from vending_machine.models.product import Product, ProductCreate
+from vending_machine.models.sales import SellerSales
+from vending_machine.models.search import ProductSearchResult
 from vending_machine.models.user import UserWithoutPassword
+from vending_machine.single_flight import single_flight
+from vending_machine.tracing import span
 
 routes = APIRouter()
 
@@ -20,7 +38,7 @@ logger = get_logger(__name__)
 async def create_product(
     product: ProductCreate,
     current_user: UserWithoutPassword = Depends(get_seller_user),
-    db: AsyncSession = Depends(get_db),
+    db: Session = Depends(get_db),
 ) -> Product:
     """
     Create a product in the vending machine.
@@ -28,7 +46,7 @@ async def create_product(
     Args:
         product (ProductCreate): The product data.
         current_user (UserWithoutPassword, optional): The current user making the request. Defaults to the seller user.
-        db (AsyncSession, optional): The database session. Defaults to the session obtained from get_db().
+        db (Session, optional): The database session. Defaults to the session obtained from get_db().
 
     Returns:
         Product: The created product.
@@ -38,14 +56,18 @@ async def create_product(
         ValidationError: If there are validation errors in the product data.
     """
     try:
-        new_product = Product(**product.model_dump())
+        new_product = ProductOrm(**product_columns(product))
         new_product.seller_id = current_user.id
 
         db.add(new_product)
-        await db.commit()
-        await db.refresh(new_product)
+        db.flush()
+        stock.set_stock(db, new_product.id, new_product.amount_available)
+        db.commit()
+        db.refresh(new_product)
+
+        invalidation_bus.publish(PRODUCTS, new_product.id)
 
-        return Product(new_product)
+        return product_from_orm(new_product)
 
     except ValidationError as e:
         logger.info(e)
@@ -58,18 +80,83 @@ async def create_product(
             raise HTTPException(status_code=500, detail="Internal server error")
 
 
+# Create products in bulk
+@routes.post("/products/bulk", response_model=BulkImportResult, tags=["products"])
+async def bulk_create_products(
+    request: Request,
+    current_user: UserWithoutPassword = Depends(get_seller_user),
+    db: Session = Depends(get_db),
+) -> BulkImportResult:
+    """
+    Create products from an uploaded CSV or NDJSON body, read as a stream.
+
+    Rows are validated and stored in chunks, each in its own transaction, and rows
+    that fail are reported without aborting the rest of the upload.
+
+    Args:
+        request (Request): The incoming request, whose body holds the products.
+        current_user (UserWithoutPassword, optional): The current user making the request. Defaults to the seller user.
+        db (Session, optional): The database session. Defaults to the session obtained from get_db().
+
+    Returns:
+        BulkImportResult: How many products were created, and the errors of the rows that weren't.
+
+    Raises:
+        HTTPException: If the user is not authorized, the body isn't CSV or NDJSON, a row is too long, or there is an internal server error.
+    """
+    try:
+        records = bulk.records(
+            request.headers.get("content-type", ""), request.stream()
+        )
+        return await bulk.import_products(db, current_user.id, records)
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(e)
+        if settings.debug:
+            raise HTTPException(status_code=500, detail=str(e))
+        else:
+            raise HTTPException(status_code=500, detail="Internal server error")
+
+
+def _products_body(db: Session) -> bytes:
+    products = products_from_orm(db.query(ProductOrm).all())
+
+    totals = stock.stock_totals(db)
+    for product in products:
+        product.amountAvailable = totals.get(int(product.id), 0)
+
+    with span("render"):
+        return list_adapter(Product).dump_json(products)
+
+
+def _product_body(db: Session, product_id: int) -> Optional[tuple[str, bytes]]:
+    found = db.get(ProductOrm, product_id)
+    if found is None:
+        return None
+
+    product = product_from_orm(found)
+    product.amountAvailable = stock.total_stock(db, product_id)
+
+    with span("render"):
+        body = product.model_dump_json().encode()
+    return etag.product_etag(found.version, product.amountAvailable), body
+
+
 # Get all Products
 @routes.get("/products", response_model=list[Product], tags=["products"])
 async def get_products(
     current_user: UserWithoutPassword = Depends(get_buyer_or_seller_user),
-    db: AsyncSession = Depends(get_db),
+    db: Session = Depends(get_db),
 ) -> list[Product]:
     """
-    Retrieve a list of products from the database.
+    Retrieve a list of products from the database.  Concurrent listings share one
+    read of the catalogue and its serialized body.
 
     Args:
         current_user (UserWithoutPassword): The current user making the request.
-        db (AsyncSession): The database session.
+        db (Session): The database session.
 
     Returns:
         list[Product]: A list of Product objects retrieved from the database.
@@ -81,9 +168,104 @@ async def get_products(
     try:
         assert isinstance(current_user, UserWithoutPassword), "User was not authorised"
 
-        products = await db.query(Product).all()
+        # Identical listings in flight at once share one read and one body
+        body = await single_flight.run(
+            ("GET /products", invalidation_bus.version(PRODUCTS)),
+            _products_body,
+            db,
+        )
+        return Response(content=body, media_type="application/json")
+    except AssertionError as e:
+        logger.info(e)
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    except Exception as e:
+        logger.error(e)
+        if settings.debug:
+            raise HTTPException(status_code=500, detail=str(e))
+        else:
+            raise HTTPException(status_code=500, detail="Internal server error")
+
+
+# Search products
+@routes.get("/products/search", response_model=ProductSearchResult, tags=["products"])
+async def search_products(
+    q: Optional[str] = Query(None, max_length=100),
+    min_cost: Optional[int] = Query(None, ge=0),
+    max_cost: Optional[int] = Query(None, ge=0),
+    seller_id: Optional[str] = None,
+    in_stock: bool = False,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    current_user: UserWithoutPassword = Depends(get_buyer_or_seller_user),
+    db: Session = Depends(get_db),
+) -> ProductSearchResult:
+    """
+    Search products by name, and filter them by cost, seller and stock.
+
+    Args:
+        q (Optional[str], optional): Text to match product names against, the last word as a prefix. Defaults to None, which matches every product.
+        min_cost (Optional[int], optional): The lowest cost to include. Defaults to None.
+        max_cost (Optional[int], optional): The highest cost to include. Defaults to None.
+        seller_id (Optional[str], optional): Only include this seller's products. Defaults to None.
+        in_stock (bool, optional): Only include products with stock left. Defaults to False.
+        limit (int, optional): The page size. Defaults to 20.
+        offset (int, optional): The number of results to skip. Defaults to 0.
+        current_user (UserWithoutPassword): The current user making the request.
+        db (Session): The database session.
+
+    Returns:
+        ProductSearchResult: A page of matching products, best matches first, and the total number of matches.
+
+    Raises:
+        HTTPException: If the user is not authorized or if there is an internal server error.
+    """
+    try:
+        assert isinstance(current_user, UserWithoutPassword), "User was not authorised"
+
+        return search.search_products(
+            db,
+            query=q,
+            min_cost=min_cost,
+            max_cost=max_cost,
+            seller_id=seller_id,
+            in_stock=in_stock,
+            limit=limit,
+            offset=offset,
+        )
+    except AssertionError as e:
+        logger.info(e)
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    except Exception as e:
+        logger.error(e)
+        if settings.debug:
+            raise HTTPException(status_code=500, detail=str(e))
+        else:
+            raise HTTPException(status_code=500, detail="Internal server error")
+
+
+# Get the current seller's sales
+@routes.get("/products/sales", response_model=SellerSales, tags=["products"])
+async def get_sales(
+    current_user: UserWithoutPassword = Depends(get_seller_user),
+    db: Session = Depends(get_db),
+) -> SellerSales:
+    """
+    Retrieve the units sold and revenue of each of the current seller's products.
 
-        return [Product(product) for product in products]
+    Args:
+        current_user (UserWithoutPassword, optional): The current user making the request. Defaults to the seller user.
+        db (Session, optional): The database session. Defaults to Depends(get_db).
+
+    Returns:
+        SellerSales: The seller's totals, and the totals per product.
+
+    Raises:
+        HTTPException: If the user is not authorized or if there is an internal server error.
+    """
+    try:
+        assert isinstance(current_user, UserWithoutPassword), "User was not authorised"
+
+        return sales.seller_sales(db, current_user.id)
     except AssertionError as e:
         logger.info(e)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
@@ -99,16 +281,23 @@ async def get_products(
 @routes.get("/products/{product_id}", response_model=Product, tags=["products"])
 async def get_product(
     product_id: int,
+    if_none_match: Optional[str] = Header(None),
     current_user: UserWithoutPassword = Depends(get_buyer_or_seller_user),
-    db: AsyncSession = Depends(get_db),
+    db: Session = Depends(get_db),
 ) -> Product:
     """
     Retrieve a product by its ID.
 
+    The response carries an ETag; a request whose If-None-Match holds the current one
+    is answered with a 304 and no body, having only read the product's version and
+    stock.  Concurrent reads of the same product that need the body share one read
+    and rendering of it.
+
     Args:
         product_id (int): The ID of the product to retrieve.
+        if_none_match (Optional[str], optional): ETags the client already has. Defaults to None.
         current_user (UserWithoutPassword, optional): The current user. Defaults to Depends(get_buyer_or_seller_user).
-        db (AsyncSession, optional): The database session. Defaults to Depends(get_db).
+        db (Session, optional): The database session. Defaults to Depends(get_db).
 
     Returns:
         Product: The retrieved product.
@@ -119,9 +308,33 @@ async def get_product(
     try:
         assert isinstance(current_user, UserWithoutPassword), "User was not authorised"
 
-        product = await db.query(Product).filter(Product.id == product_id).first()
-
-        return Product(product)
+        # Only the version is read until we know the client needs the body
+        version = db.execute(
+            select(ProductOrm.version).where(ProductOrm.id == product_id)
+        ).scalar_one_or_none()
+        if version is None:
+            raise HTTPException(status_code=404, detail="Product not found")
+
+        tag = etag.product_etag(version, stock.total_stock(db, product_id))
+        if etag.matches(if_none_match, tag):
+            return etag.not_modified(tag)
+
+        # Keyed on the tag, so a read never joins one of an older version
+        read = await single_flight.run(
+            (f"GET /products/{product_id}", tag),
+            lambda session: _product_body(session, product_id),
+            db,
+        )
+        if read is None:
+            raise HTTPException(status_code=404, detail="Product not found")
+
+        # The tag of the body sent, should the product have changed since
+        tag, body = read
+        return Response(
+            content=body, media_type="application/json", headers={"ETag": tag}
+        )
+    except HTTPException as e:
+        raise e
     except AssertionError as e:
         logger.info(e)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
@@ -138,42 +351,82 @@ async def get_product(
 async def update_product(
     product_id: int,
     product: ProductCreate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: UserWithoutPassword = Depends(get_seller_user),
-    db: AsyncSession = Depends(get_db),
+    db: Session = Depends(get_db),
 ) -> Product:
     """
     Update a product in the vending machine.
 
+    With If-Match, the product is only updated if it still has that ETag, checked by
+    a conditional UPDATE rather than a lock, and a 412 is returned otherwise.
+
     Args:
         product_id (int): The ID of the product to be updated.
         product (ProductCreate): The updated product data.
+        response (Response): The response, to set the new ETag on.
+        if_match (Optional[str], optional): The ETag the client last read. Defaults to None.
         current_user (UserWithoutPassword, optional): The current user making the request. Defaults to the seller user.
-        db (AsyncSession, optional): The database session. Defaults to the session obtained from get_db().
+        db (Session, optional): The database session. Defaults to the session obtained from get_db().
 
     Returns:
         Product: The updated product.
 
     Raises:
-        HTTPException: If the user is not authorized, the product does not exist, or there is a server error.
+        HTTPException: If the user is not authorized, the product does not exist, it changed since the If-Match ETag was read, or there is a server error.
         ValidationError: If there are validation errors in the updated product data.
     """
     try:
         assert isinstance(current_user, UserWithoutPassword), "User was not authorised"
 
-        product = await db.query(Product).filter(Product.id == product_id).first()
+        stored_product = db.get(ProductOrm, product_id)
 
-        if not product or (product.seller_id != current_user.id):
+        if not stored_product or (stored_product.seller_id != current_user.id):
             # We return a 400 here instead of a 404 to prevent leaking information about the existence of products
             # Technically, there's a layer of auth above this, but buyers could fuzz the system
             raise HTTPException(status_code=400, detail="Product retrieval")
 
-        product.update(**product.model_dump())
-
-        await db.commit()
-        await db.refresh(product)
-
-        return Product(product)
+        if if_match is not None:
+            current = etag.product_etag(
+                stored_product.version, stock.total_stock(db, product_id)
+            )
+            if not etag.matches(if_match, current, strong=True):
+                raise etag.precondition_failed(current)
+
+        # The UPDATE is conditional on the version read above, so a concurrent
+        # edit between here and the commit makes it match no row
+        for column, value in product_columns(product).items():
+            setattr(stored_product, column, value)
+        stock.set_stock(db, product_id, stored_product.amount_available)
+
+        try:
+            db.commit()
+        except StaleDataError:
+            db.rollback()
+            current = db.get(ProductOrm, product_id)
+            if not current:
+                raise HTTPException(status_code=400, detail="Product retrieval")
+
+            tag = etag.product_etag(current.version, stock.total_stock(db, product_id))
+            if if_match is not None:
+                raise etag.precondition_failed(tag)
+            raise HTTPException(
+                status_code=409,
+                detail="The product was changed by another request",
+                headers={"ETag": tag},
+            )
+        db.refresh(stored_product)
+
+        invalidation_bus.publish(PRODUCTS, product_id)
+
+        response.headers["ETag"] = etag.product_etag(
+            stored_product.version, stored_product.amount_available
+        )
+        return product_from_orm(stored_product)
 
+    except HTTPException as e:
+        raise e
     except AssertionError as e:
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
     except ValidationError as e:
@@ -190,7 +443,7 @@ async def update_product(
 async def delete_product(
     product_id: int,
     current_user: UserWithoutPassword = Depends(get_seller_user),
-    db: AsyncSession = Depends(get_db),
+    db: Session = Depends(get_db),
 ) -> ApiMessage:
     """
     Delete a product from the vending machine.
@@ -198,7 +451,7 @@ async def delete_product(
     Args:
         product_id (int): The ID of the product to be deleted.
         current_user (UserWithoutPassword, optional): The current user making the request. Defaults to the seller user.
-        db (AsyncSession, optional): The database session. Defaults to the session obtained from get_db().
+        db (Session, optional): The database session. Defaults to the session obtained from get_db().
 
     Returns:
         ApiMessage: A message indicating the success of the deletion.
@@ -209,15 +462,19 @@ async def delete_product(
     try:
         assert isinstance(current_user, UserWithoutPassword), "User was not authorised"
 
-        product = await db.query(Product).filter(Product.id == product_id).first()
+        product = db.get(ProductOrm, product_id)
 
         if not product or (product.seller_id != current_user.id):
             # We return a 400 here instead of a 404 to prevent leaking information about the existence of products
             # Technically, there's a layer of auth above this, but buyers could fuzz the system
             raise HTTPException(status_code=400, detail="Product retrieval")
 
+        # Its sales summary and ledger entries are kept, see vending_machine.sales
+        stock.delete_stock(db, product_id)
         db.delete(product)
-        await db.commit()
+        db.commit()
+
+        invalidation_bus.publish(PRODUCTS, product_id)
 
         return ApiMessage(message="Product deleted", success=True)
 
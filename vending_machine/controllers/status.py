@@ -5,6 +5,7 @@ from sqlalchemy.sql.expression import text
 
 from vending_machine.database import get_db
 from vending_machine.logging import get_logger
+from vending_machine.warmup import ready
 
 routes = APIRouter()
 logger = get_logger(__name__)
@@ -14,6 +15,12 @@ logger = get_logger(__name__)
 async def heartbeat(
     db: Depends = Depends(get_db),
 ) -> Any:
+    # Not ready for traffic until the worker has warmed up
+    if not ready.is_set():
+        raise HTTPException(
+            status_code=503, detail="Warming up", headers={"Retry-After": "1"}
+        )
+
     try:
         system_time = db.execute(text("SELECT datetime('now')")).first()[0]
     except Exception as e:
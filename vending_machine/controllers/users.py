@@ -1,23 +1,42 @@
+from math import ceil
+from typing import Optional
 from uuid import uuid4
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response
 from pydantic import ValidationError
+from sqlalchemy import delete, or_, select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.exc import StaleDataError
 
+from vending_machine import etag, stock
 from vending_machine.authentication import (
     get_buyer_or_seller_user,
     get_password_hash,
+    get_seller_user,
     user_create,
 )
 from vending_machine.config import settings
+from vending_machine.data_objects.product import Product as ProductOrm
+from vending_machine.data_objects.session import UserSession as UserSessionOrm
+from vending_machine.data_objects.session_product import (
+    SessionProduct as SessionProductOrm,
+)
+from vending_machine.data_objects.user import User as UserOrm
 from vending_machine.database import get_db
+from vending_machine.invalidation import PRODUCTS, SESSIONS, USERS, invalidation_bus
 from vending_machine.logging import get_logger
-from vending_machine.models.user import (
-    User,
-    UserCreate,
-    UserUpdate,
-    UserWithoutPassword,
+from vending_machine.login_guard import login_guard
+from vending_machine.models.bulk import BulkUsersResult
+from vending_machine.models.conversion import (
+    list_adapter,
+    user_from_orm,
+    users_from_orm,
 )
+from vending_machine.models.user import UserCreate, UserUpdate, UserWithoutPassword
+from vending_machine.provisioning import provision_users
+from vending_machine.revocation import revocation_list
+from vending_machine.single_flight import single_flight
+from vending_machine.tracing import span
 
 routes = APIRouter()
 logger = get_logger(__name__)
@@ -60,6 +79,72 @@ async def create_user(
             raise HTTPException(status_code=500, detail="Internal server error")
 
 
+# Create users in bulk
+@routes.post("/users/bulk", response_model=BulkUsersResult, tags=["users"])
+async def create_users(
+    users: list[UserCreate],
+    request: Request,
+    current_user: UserWithoutPassword = Depends(get_seller_user),
+    db: AsyncSession = Depends(get_db),
+) -> BulkUsersResult:
+    """
+    Create many users at once, hashing their passwords in parallel.
+
+    Users whose username is taken are reported and skipped; the rest are created in one transaction.
+
+    Args:
+        users (list[UserCreate]): The users to create.
+        request (Request): The request, for the client's address.
+        current_user (UserWithoutPassword): The seller making the request.
+        db (AsyncSession, optional): The database session. Defaults to Depends(get_db).
+
+    Returns:
+        BulkUsersResult: The outcome for each user, and how the password hashing was split across processes.
+
+    Raises:
+        HTTPException: If the seller or client is over its attempt budget, there are too many users, a validation error or an internal server error occurs.
+    """
+
+    try:
+        # Each request can keep every core hashing, so it is budgeted like a login
+        client = request.client.host if request.client else "unknown"
+        retry_after = login_guard.admit(current_user.username, client)
+        if retry_after is not None:
+            logger.info(f"Bulk users from {current_user.username} throttled")
+            raise HTTPException(
+                status_code=429,
+                detail="Too many bulk requests",
+                headers={"Retry-After": str(ceil(retry_after))},
+            )
+
+        if len(users) > settings.bulk_max_users:
+            raise HTTPException(
+                status_code=413,
+                detail=f"At most {settings.bulk_max_users} users can be created at once",
+            )
+
+        return await provision_users(db, users)
+
+    except HTTPException as e:
+        raise e
+    except ValidationError as e:
+        logger.info(e)
+        raise HTTPException(status_code=400, detail=e.errors())
+    except Exception as e:
+        logger.error(e)
+        if settings.debug:
+            raise HTTPException(status_code=500, detail=str(e))
+        else:
+            raise HTTPException(status_code=500, detail="Internal server error")
+
+
+def _users_body(db: AsyncSession) -> bytes:
+    users = users_from_orm(db.query(UserOrm).all())
+
+    with span("render"):
+        return list_adapter(UserWithoutPassword).dump_json(users)
+
+
 # Retrieve all users
 @routes.get("/users", response_model=list[UserWithoutPassword], tags=["users"])
 async def get_users(
@@ -67,7 +152,8 @@ async def get_users(
     db: AsyncSession = Depends(get_db),
 ) -> list[UserWithoutPassword]:
     """
-    Retrieve a list of users.
+    Retrieve a list of users.  Concurrent listings share one read of the users and
+    its serialized body.
 
     Args:
         current_user (UserWithoutPassword): The current authenticated user.
@@ -83,9 +169,11 @@ async def get_users(
     try:
         assert isinstance(current_user, UserWithoutPassword), "User was not authorised"
 
-        users = await db.query(User).all()
-
-        return [UserWithoutPassword(user) for user in users]
+        # Identical listings in flight at once share one read and one body
+        body = await single_flight.run(
+            ("GET /users", invalidation_bus.version(USERS)), _users_body, db
+        )
+        return Response(content=body, media_type="application/json")
     except AssertionError as e:
         logger.info(e)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
@@ -97,20 +185,73 @@ async def get_users(
             raise HTTPException(status_code=500, detail="Internal server error")
 
 
+def __delete_dependents(db: AsyncSession, user_id: str) -> list[int]:
+    # A user's sessions and products go with them, and their products leave
+    # every cart; sales and ledger rows are kept, see vending_machine.sales
+    session_ids = select(UserSessionOrm.id).where(UserSessionOrm.user_id == user_id)
+    product_ids = list(
+        db.execute(
+            select(ProductOrm.id).where(ProductOrm.seller_id == user_id)
+        ).scalars()
+    )
+
+    db.execute(
+        delete(SessionProductOrm).where(
+            or_(
+                SessionProductOrm.session_id.in_(session_ids),
+                SessionProductOrm.product_id.in_(product_ids),
+            )
+        )
+    )
+    db.execute(delete(UserSessionOrm).where(UserSessionOrm.user_id == user_id))
+    for product_id in product_ids:
+        stock.delete_stock(db, product_id)
+    db.execute(delete(ProductOrm).where(ProductOrm.seller_id == user_id))
+    return product_ids
+
+
+def __find_user(db: AsyncSession, user_id_or_username: str) -> Optional[UserOrm]:
+    return db.execute(
+        select(UserOrm).where(
+            or_(
+                UserOrm.id == user_id_or_username,
+                UserOrm.username == user_id_or_username,
+            )
+        )
+    ).scalar_one_or_none()
+
+
+def _user_body(db: AsyncSession, user_id: str) -> Optional[tuple[str, bytes]]:
+    user = db.get(UserOrm, user_id)
+    if not user:
+        return None
+
+    with span("render"):
+        body = user_from_orm(user).model_dump_json().encode()
+    return etag.user_etag(user.version), body
+
+
 # Retrieve a user by id or username
 @routes.get(
     "/users/{user_id_or_password}", response_model=UserWithoutPassword, tags=["users"]
 )
 async def get_user(
     user_id_or_password: str,
+    if_none_match: Optional[str] = Header(None),
     current_user: UserWithoutPassword = Depends(get_buyer_or_seller_user),
     db: AsyncSession = Depends(get_db),
 ) -> UserWithoutPassword:
     """
     Retrieve a user by their ID or username.
 
+    The response carries an ETag; a request whose If-None-Match holds the current one
+    is answered with a 304 and no body, having only read the user's version.
+    Concurrent reads of the same user that need the body share one read and
+    rendering of it.
+
     Args:
         user_id_or_password (str): The ID or username of the user to retrieve.
+        if_none_match (Optional[str], optional): ETags the client already has. Defaults to None.
         current_user (UserWithoutPassword, optional): The current authenticated user. Defaults to Depends(get_buyer_or_seller_user).
         db (AsyncSession, optional): The database session. Defaults to Depends(get_db).
 
@@ -124,16 +265,35 @@ async def get_user(
     try:
         assert isinstance(current_user, UserWithoutPassword), "User was not authorised"
 
-        if user_id_or_password.isdigit():
-            user: User = db.query(User).filter(User.id == user_id_or_password).first()
-        else:
-            user: User = (
-                db.query(User).filter(User.username == user_id_or_password).first()
+        # Only the version is read until we know the client needs the body
+        found = db.execute(
+            select(UserOrm.id, UserOrm.version).where(
+                or_(
+                    UserOrm.id == user_id_or_password,
+                    UserOrm.username == user_id_or_password,
+                )
             )
+        ).first()
+        if not found:
+            raise HTTPException(status_code=404, detail="User not found")
 
-        if not user:
+        user_id, version = found
+        tag = etag.user_etag(version)
+        if etag.matches(if_none_match, tag):
+            return etag.not_modified(tag)
+
+        # Keyed on the version, so a read never joins one of an older version
+        read = await single_flight.run(
+            (f"GET /users/{user_id}", version),
+            lambda session: _user_body(session, user_id),
+            db,
+        )
+        if read is None:
             raise HTTPException(status_code=404, detail="User not found")
 
+        # The tag of the body sent, should the user have changed since
+        tag, body = read
+
     except AssertionError as e:
         logger.info(e)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
@@ -144,7 +304,7 @@ async def get_user(
         logger.error(e)
         raise HTTPException(status_code=500, detail=str(e))
 
-    return UserWithoutPassword(user)
+    return Response(content=body, media_type="application/json", headers={"ETag": tag})
 
 
 # Update a user by id or username
@@ -154,15 +314,22 @@ async def get_user(
 async def update_user(
     user_id_or_password: str,
     user: UserUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: UserWithoutPassword = Depends(get_buyer_or_seller_user),
     db: AsyncSession = Depends(get_db),
 ) -> UserWithoutPassword:
     """
     Update a user's information in the database.
 
+    With If-Match, the user is only updated if it still has that ETag, checked by a
+    conditional UPDATE rather than a lock, and a 412 is returned otherwise.
+
     Args:
         user_id_or_password (str): The user's ID or password.
         user (UserUpdate): The updated user information.
+        response (Response): The response, to set the new ETag on.
+        if_match (Optional[str], optional): The ETag the client last read. Defaults to None.
         current_user (UserWithoutPassword, optional): The current authenticated user. Defaults to Depends(get_buyer_or_seller_user).
         db (AsyncSession, optional): The database session. Defaults to Depends(get_db).
 
@@ -170,26 +337,48 @@ async def update_user(
         UserWithoutPassword: The updated user information without the password.
 
     Raises:
-        HTTPException: If the user is not authorized, the user is not found, or there is an internal server error.
+        HTTPException: If the user is not authorized, the user is not found, a deposit is given, it changed since the If-Match ETag was read, or there is an internal server error.
     """
 
     try:
         assert isinstance(current_user, UserWithoutPassword), "User was not authorised"
 
-        if user_id_or_password.isdigit():
-            user: User = db.query(User).filter(User.id == user_id_or_password).first()
-        else:
-            user: User = (
-                db.query(User).filter(User.username == user_id_or_password).first()
-            )
+        stored_user = __find_user(db, user_id_or_password)
 
-        if not user:
+        if not stored_user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        user.update(**user.model_dump())
+        if if_match is not None and not etag.matches(
+            if_match, etag.user_etag(stored_user.version), strong=True
+        ):
+            raise etag.precondition_failed(etag.user_etag(stored_user.version))
 
-        await db.commit()
-        await db.refresh(user)
+        # Balances are kept by the ledger, so they only change through it
+        if "deposit" in user.model_fields_set:
+            raise HTTPException(
+                status_code=400,
+                detail="A deposit can't be set directly, use /machine/deposit",
+            )
+
+        # The UPDATE is conditional on the version read above
+        for field, value in user.model_dump(exclude_unset=True).items():
+            setattr(stored_user, field, value)
+
+        try:
+            db.commit()
+        except StaleDataError:
+            db.rollback()
+            raise HTTPException(
+                status_code=412 if if_match is not None else 409,
+                detail="The user was changed by another request",
+            )
+        db.refresh(stored_user)
+
+        # Stateless tokens carry the role, so ones issued with the old role must go,
+        # and they aren't checked against the user, so a disabled user's must too
+        if "role" in user.model_fields_set or stored_user.disabled:
+            revocation_list.revoke_user(db, stored_user.id)
+        invalidation_bus.publish(USERS, stored_user.username)
 
     except AssertionError as e:
         logger.info(e)
@@ -201,7 +390,8 @@ async def update_user(
         logger.error(e)
         raise HTTPException(status_code=500, detail=str(e))
 
-    return UserWithoutPassword(user)
+    response.headers["ETag"] = etag.user_etag(stored_user.version)
+    return user_from_orm(stored_user)
 
 
 # Delete a user by id or username
@@ -216,18 +406,21 @@ async def delete_user(
     try:
         assert isinstance(current_user, UserWithoutPassword), "User was not authorised"
 
-        if user_id_or_password.isdigit():
-            user: User = db.query(User).filter(User.id == user_id_or_password).first()
-        else:
-            user: User = (
-                db.query(User).filter(User.username == user_id_or_password).first()
-            )
+        user = __find_user(db, user_id_or_password)
 
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        await db.delete(user)
-        await db.commit()
+        product_ids = __delete_dependents(db, user.id)
+        db.delete(user)
+        db.commit()
+
+        revocation_list.revoke_user(db, user.id)
+
+        invalidation_bus.publish(USERS, user.username)
+        invalidation_bus.publish(SESSIONS, user.id)
+        for product_id in product_ids:
+            invalidation_bus.publish(PRODUCTS, product_id)
 
     except AssertionError as e:
         logger.info(e)
@@ -239,4 +432,4 @@ async def delete_user(
         logger.error(e)
         raise HTTPException(status_code=500, detail=str(e))
 
-    return UserWithoutPassword(user)
+    return user_from_orm(user)
@@ -0,0 +1,15 @@
+# Every mapped class is imported here, so relationships between them can
+# always be resolved whichever one is used first
+from vending_machine.data_objects import (  # noqa: F401
+    balance_snapshot,
+    idempotency_key,
+    ledger_balance,
+    ledger_entry,
+    product,
+    revocation,
+    sales_summary,
+    session,
+    session_product,
+    stock_shard,
+    user,
+)
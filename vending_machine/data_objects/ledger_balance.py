@@ -0,0 +1,17 @@
+from sqlalchemy import ForeignKey, Integer, String
+from sqlalchemy.orm import Mapped, mapped_column
+
+from vending_machine.database import Base
+
+
+class LedgerBalance(Base):
+    __tablename__ = "ledger_balances"
+
+    user_id: Mapped[str] = mapped_column(
+        String, ForeignKey("users.id"), primary_key=True
+    )
+    # The sum of the user's entries, up to and including entry_id
+    balance: Mapped[int] = mapped_column(Integer, default=0)
+    entry_id: Mapped[int] = mapped_column(Integer, default=0)
+    # Entries appended since the last snapshot
+    unsnapshotted: Mapped[int] = mapped_column(Integer, default=0)
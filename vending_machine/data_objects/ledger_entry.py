@@ -0,0 +1,24 @@
+from datetime import datetime
+
+from sqlalchemy import DateTime, Enum, ForeignKey, Index, Integer, String
+from sqlalchemy.orm import Mapped, mapped_column
+
+from vending_machine.database import Base
+
+from .ledger_kind import LedgerKind
+
+
+class LedgerEntry(Base):
+    __tablename__ = "ledger_entries"
+    __table_args__ = (Index("ix_ledger_entries_user_id_id", "user_id", "id"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user_id: Mapped[str] = mapped_column(String, ForeignKey("users.id"))
+    session_id: Mapped[str] = mapped_column(String, nullable=True)
+    kind: Mapped[LedgerKind] = mapped_column(Enum(LedgerKind))
+    # Signed: credits are positive, debits negative
+    amount: Mapped[int] = mapped_column(Integer)
+    # Not a foreign key: entries outlive the product, see vending_machine.sales
+    product_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    quantity: Mapped[int] = mapped_column(Integer, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime)
@@ -0,0 +1,7 @@
+from enum import Enum
+
+
+class LedgerKind(Enum):
+    DEPOSIT = "DEPOSIT"
+    PURCHASE = "PURCHASE"
+    REFUND = "REFUND"
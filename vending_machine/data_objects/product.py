@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import DDL, Column, ForeignKey, Index, Integer, String, event
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from vending_machine.database import Base
@@ -6,11 +6,47 @@ from vending_machine.database import Base
 
 class Product(Base):
     __tablename__ = "products"
+    __table_args__ = (Index("ix_products_seller_id_cost", "seller_id", "cost"),)
 
     id: Mapped[str] = mapped_column(Integer, primary_key=True)
     amount_available: Mapped[int] = mapped_column(Integer)
-    cost: Mapped[int] = mapped_column(Integer)
+    cost: Mapped[int] = mapped_column(Integer, index=True)
     product_name: Mapped[str] = mapped_column(String)
     seller_id: Mapped[str] = mapped_column(Integer, ForeignKey("users.id"))
+    # Bumped on every write, see vending_machine.etag
+    version: Mapped[int] = mapped_column(Integer, default=1, server_default="1")
 
     seller = relationship("User", back_populates="products")
+
+    __mapper_args__ = {"version_id_col": version}
+
+
+# Full text index over product names, see vending_machine.search.  It is an
+# external content table, so it only holds the index, and the triggers keep it
+# in step with every write to products.
+PRODUCTS_FTS_DDL = [
+    "CREATE VIRTUAL TABLE products_fts USING fts5("
+    "product_name, content='products', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER products_fts_insert AFTER INSERT ON products BEGIN "
+    "INSERT INTO products_fts (rowid, product_name) "
+    "VALUES (new.id, new.product_name); END",
+    "CREATE TRIGGER products_fts_delete AFTER DELETE ON products BEGIN "
+    "INSERT INTO products_fts (products_fts, rowid, product_name) "
+    "VALUES ('delete', old.id, old.product_name); END",
+    "CREATE TRIGGER products_fts_update AFTER UPDATE OF product_name ON products BEGIN "
+    "INSERT INTO products_fts (products_fts, rowid, product_name) "
+    "VALUES ('delete', old.id, old.product_name); "
+    "INSERT INTO products_fts (rowid, product_name) "
+    "VALUES (new.id, new.product_name); END",
+]
+
+for statement in PRODUCTS_FTS_DDL:
+    event.listen(
+        Product.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite")
+    )
+event.listen(
+    Product.__table__,
+    "before_drop",
+    DDL("DROP TABLE IF EXISTS products_fts").execute_if(dialect="sqlite"),
+)
@@ -0,0 +1,17 @@
+from datetime import datetime
+
+from sqlalchemy import DateTime, String
+from sqlalchemy.orm import Mapped, mapped_column
+
+from vending_machine.database import Base
+
+
+class Revocation(Base):
+    __tablename__ = "revocations"
+
+    # "session" for a logged out session id, "user" for every token of a user id
+    kind: Mapped[str] = mapped_column(String, primary_key=True)
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    revoked_at: Mapped[datetime] = mapped_column(DateTime)
+    # Once every token it covers has expired, the revocation can be forgotten
+    expires_at: Mapped[datetime] = mapped_column(DateTime, index=True)
@@ -0,0 +1,16 @@
+from sqlalchemy import Integer, String
+from sqlalchemy.orm import Mapped, mapped_column
+
+from vending_machine.database import Base
+
+
+class SalesSummary(Base):
+    __tablename__ = "sales_summaries"
+
+    seller_id: Mapped[str] = mapped_column(String, primary_key=True)
+    # Not a foreign key: the row outlives the product, see vending_machine.sales
+    product_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # As of the latest sale
+    product_name: Mapped[str] = mapped_column(String, nullable=True)
+    units_sold: Mapped[int] = mapped_column(Integer, default=0)
+    revenue: Mapped[int] = mapped_column(Integer, default=0)
@@ -12,4 +12,10 @@ class UserSession(Base):
     expiry_time: Mapped[DateTime] = mapped_column(DateTime)
     deposited_amount: Mapped[int] = mapped_column(Integer)
 
-    user = relationship("User", back_populates="users")
+    user = relationship("User", back_populates="sessions")
+    products = relationship(
+        "SessionProduct",
+        back_populates="session",
+        cascade="all, delete-orphan",
+        order_by="SessionProduct.product_id",
+    )
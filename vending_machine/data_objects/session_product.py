@@ -7,10 +7,14 @@ from vending_machine.database import Base
 class SessionProduct(Base):
     __tablename__ = "session_products"
 
-    id: Mapped[str] = mapped_column(Integer, primary_key=True)
+    # One row per product bought in the session, however many units
+    session_id: Mapped[str] = mapped_column(
+        String, ForeignKey("user_sessions.id"), primary_key=True
+    )
+    product_id: Mapped[int] = mapped_column(
+        Integer, ForeignKey("products.id"), primary_key=True
+    )
+    quantity: Mapped[int] = mapped_column(Integer, default=0)
 
-    product_id: Mapped[str] = mapped_column(String, ForeignKey("products.id"))
-    session_id: Mapped[str] = mapped_column(String, ForeignKey("user_sessions.id"))
-
-    session = relationship("UserSession", back_populates="user_sessions")
-    product = relationship("Product", back_populates="products")
+    session = relationship("UserSession", back_populates="products")
+    product = relationship("Product")
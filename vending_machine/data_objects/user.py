@@ -1,5 +1,5 @@
 from sqlalchemy import Boolean, Enum, Integer, String
-from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from vending_machine.database import Base
 
@@ -15,3 +15,12 @@ class User(Base):
     role: Mapped[Role] = mapped_column(Enum(Role))
     hashed_password: Mapped[str] = mapped_column(String)
     disabled: Mapped[bool] = mapped_column(Boolean, default=False)
+    # Bumped on every write, see vending_machine.etag
+    version: Mapped[int] = mapped_column(Integer, default=1, server_default="1")
+
+    # Read only, so deleting a user never nulls their rows' NOT NULL user ids;
+    # delete_user removes those rows itself
+    products = relationship("Product", back_populates="seller", viewonly=True)
+    sessions = relationship("UserSession", back_populates="user", viewonly=True)
+
+    __mapper_args__ = {"version_id_col": version}
@@ -1,7 +1,30 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+"""
+The database engine and sessions.
 
+``snapshot`` and ``restore`` copy a whole database with SQLite's online
+backup API, page by page rather than row by row.  A seeded database captured
+once can be cloned into a fresh in-memory engine for each test, or restored
+over a demo machine's database, in milliseconds.
+
+Every statement run by any engine is timed for the slow-query log, and in a
+tracing span when it runs within a traced request.
+"""
+
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, Optional, Union
+
+from sqlalchemy import Engine, create_engine, event
+from sqlalchemy.orm import Session, declarative_base, sessionmaker
+from sqlalchemy.pool import StaticPool
+from starlette.requests import HTTPConnection
+
+from vending_machine import tracing
 from vending_machine.config import settings
+from vending_machine.slow_queries import query_log
 
 SQLALCHEMY_DATABASE_URL = settings.database_url
 
@@ -10,12 +33,191 @@ engine = create_engine(
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Connections can't be shared with a forked worker; it starts its own pool
+os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+
 Base = declarative_base()
 
 
-def get_db():
-    db = SessionLocal()
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_statement_span(conn, cursor, statement, parameters, context, executemany):
+    context._trace_span = tracing.start_span(
+        "sql", statement=statement, executemany=executemany
+    )
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    if settings.slow_query_log:
+        query_log.record(
+            cursor.connection,
+            conn.dialect.name,
+            statement,
+            parameters,
+            executemany,
+            time.perf_counter() - context._query_started,
+        )
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_statement_span(conn, cursor, statement, parameters, context, executemany):
+    span = getattr(context, "_trace_span", None)
+    if span is not None:
+        span.attributes["rows"] = cursor.rowcount
+        span.end()
+
+
+@event.listens_for(Engine, "handle_error")
+def _fail_statement_span(exception_context) -> None:
+    context = exception_context.execution_context
+    span = getattr(context, "_trace_span", None) if context else None
+    if span is not None:
+        span.end(exception_context.original_exception)
+
+
+class LazySession:
+    """
+    Stands in for a session that is only opened when first used, so a request
+    rejected before its handler touches the DB never creates one.
+    """
+
+    __slots__ = ("_factory", "_session")
+
+    def __init__(self, factory: Callable[[], Session]) -> None:
+        self._factory = factory
+        self._session: Optional[Session] = None
+
+    @property
+    def opened(self) -> bool:
+        return self._session is not None
+
+    def __getattr__(self, name: str):
+        if self._session is None:
+            self._session = self._factory()
+        return getattr(self._session, name)
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+def get_db(connection: HTTPConnection):
+    """
+    Yields the request's session, opened on first use.  It is kept in the
+    request's state, so every dependency of the request, the auth chain
+    included, shares it; a batch puts its own there for its sub-requests.
+    """
+    shared = getattr(connection.state, "db", None)
+    if shared is not None:
+        yield shared
+        return
+
+    db = LazySession(SessionLocal)
+    connection.state.db = db
     try:
         yield db
     finally:
+        del connection.state.db
         db.close()
+
+
+@contextmanager
+def atomic_session(bind: Engine) -> Iterator[Session]:
+    """
+    Opens a session in which ``commit`` only releases a savepoint, inside one
+    transaction that is committed when the block exits, or rolled back if it raises.
+
+    Args:
+        bind (Engine): The engine to take a connection from.
+
+    Yields:
+        Session: The session.
+    """
+    with bind.connect() as connection:
+        driver_connection = connection.connection.driver_connection
+        isolation_level = driver_connection.isolation_level
+        # pysqlite begins transactions implicitly, and releasing the first savepoint
+        # would commit one it didn't begin, so the transaction is begun here instead
+        driver_connection.isolation_level = None
+        try:
+            transaction = connection.begin()
+            connection.exec_driver_sql("BEGIN")
+            session = Session(
+                bind=connection,
+                autoflush=False,
+                join_transaction_mode="create_savepoint",
+            )
+            try:
+                yield session
+                transaction.commit()
+            except BaseException:
+                transaction.rollback()
+                raise
+            finally:
+                session.close()
+        finally:
+            driver_connection.isolation_level = isolation_level
+
+
+def snapshot(bind: Engine, path: str = ":memory:") -> sqlite3.Connection:
+    """
+    Copies the bind's database into a snapshot.
+
+    Args:
+        bind (Engine): The engine of the database to copy.
+        path (str, optional): The file to write the snapshot to. Defaults to one held in memory.
+
+    Returns:
+        sqlite3.Connection: The snapshot, to pass to ``restore`` or close.
+    """
+    target = sqlite3.connect(path, check_same_thread=False)
+    with bind.connect() as connection:
+        connection.connection.driver_connection.backup(target)
+    return target
+
+
+def restore(source: Union[sqlite3.Connection, str], bind: Engine) -> None:
+    """
+    Replaces everything in the bind's database with the contents of a snapshot.
+
+    Open sessions on the bind should be closed first.  Only engines with a single
+    connection, like those from ``clone``, can be restored into when in memory.
+
+    Args:
+        source (sqlite3.Connection | str): The snapshot, or the file it was written to.
+        bind (Engine): The engine of the database to overwrite.
+
+    Raises:
+        sqlite3.Error: If the snapshot file can't be read, before anything is overwritten.
+    """
+    own_source = isinstance(source, str)
+    if own_source:
+        # Read only, so a mistyped path fails instead of restoring an empty database
+        source = sqlite3.connect(
+            f"{Path(source).absolute().as_uri()}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+        )
+    try:
+        with bind.connect() as connection:
+            source.backup(connection.connection.driver_connection)
+    finally:
+        if own_source:
+            source.close()
+
+
+def clone(source: Union[sqlite3.Connection, str]) -> Engine:
+    """
+    Returns a new in-memory engine holding a copy of the snapshot.
+    """
+    bind = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    restore(source, bind)
+    return bind
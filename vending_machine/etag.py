@@ -0,0 +1,59 @@
+"""
+Entity tags for conditional requests.
+
+Rows carry a version column that SQLAlchemy bumps on every ORM write and checks
+in the UPDATE's WHERE clause (``version_id_col``), so a tag built from it
+changes whenever the row does.  A product's stock lives in its stock shards
+rather than in its row, so its tag carries the stock total too.
+
+Reads answer a matching ``If-None-Match`` with a 304 and no body, and writes
+refuse a stale ``If-Match`` with a 412.  ``If-Match`` is compared strongly, so
+a weak tag never satisfies it.
+"""
+
+from typing import Optional
+
+from fastapi import HTTPException, Response
+
+
+def product_etag(version: int, stock: int) -> str:
+    return f'"{version}-{stock}"'
+
+
+def user_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def _tags(header: str, strong: bool) -> list[str]:
+    tags = [tag.strip() for tag in header.split(",")]
+    if strong:
+        # A weak tag never matches in a strong comparison
+        return [tag for tag in tags if not tag.startswith("W/")]
+    return [tag.removeprefix("W/") for tag in tags]
+
+
+def matches(header: Optional[str], etag: str, strong: bool = False) -> bool:
+    """
+    Whether an ``If-None-Match`` or ``If-Match`` header matches the tag.
+
+    Args:
+        header (Optional[str]): The header's value, if it was sent.
+        etag (str): The current tag, always a strong one.
+        strong (bool): Compare strongly, as ``If-Match`` must (RFC 9110 13.1.1).
+    """
+    if header is None:
+        return False
+    tags = _tags(header, strong)
+    return "*" in tags or etag in tags
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def precondition_failed(etag: str) -> HTTPException:
+    return HTTPException(
+        status_code=412,
+        detail="The resource has changed since it was read",
+        headers={"ETag": etag},
+    )
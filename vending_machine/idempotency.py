@@ -0,0 +1,252 @@
+"""
+Idempotency keys for mutating routes.
+
+A client sending an ``Idempotency-Key`` header gets the stored response when it
+retries, without the request being processed again.  Responses are kept in an
+in-memory LRU in front of the ``idempotency_keys`` table.
+
+A keyed request runs in one transaction (``database.atomic_session``), in which
+the handler's own commits only release savepoints: the key's row, the work it
+protects and the stored response are committed together or not at all, so a
+crash can't leave a key claimed without its response.  Duplicates racing on
+another worker fail to commit; concurrent duplicates within a worker wait for
+the first execution instead.
+"""
+
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Optional
+
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+
+from vending_machine.cache import BoundedCache
+from vending_machine.config import settings
+from vending_machine.data_objects.idempotency_key import IdempotencyKey
+from vending_machine.database import SessionLocal, atomic_session
+from vending_machine.invalidation import invalidation_bus
+from vending_machine.logging import get_logger
+
+logger = get_logger(__name__)
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+class StoredResponse:
+    __slots__ = ("fingerprint", "status_code", "body", "expires_at")
+
+    def __init__(
+        self,
+        fingerprint: str,
+        status_code: Optional[int],
+        body: Optional[bytes],
+        expires_at: datetime,
+    ) -> None:
+        self.fingerprint = fingerprint
+        self.status_code = status_code
+        self.body = body
+        self.expires_at = expires_at
+
+
+class IdempotencyStore:
+    def __init__(self, ttl: int, max_entries: int, purge_interval: int = 60) -> None:
+        self.ttl = timedelta(seconds=ttl)
+        self.purge_interval = purge_interval
+
+        self._cache = BoundedCache(max_entries)
+        self._in_flight: dict[tuple[str, str], asyncio.Future] = {}
+        self._last_purge = 0.0
+
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    @classmethod
+    def from_settings(cls) -> "IdempotencyStore":
+        return cls(
+            ttl=settings.idempotency_ttl,
+            max_entries=settings.idempotency_cache_size,
+        )
+
+    async def run(
+        self,
+        db: SessionLocal,
+        user_id: str,
+        key: Optional[str],
+        fingerprint: str,
+        execute: Callable[[SessionLocal], Awaitable[Any]],
+    ) -> Any:
+        """
+        Runs ``execute`` once per idempotency key, replaying its response for repeats.
+
+        Args:
+            db (SessionLocal): The request's database session.
+            user_id (str): The user the key belongs to; keys are scoped per user.
+            key (Optional[str]): The Idempotency-Key header, if the client sent one.
+            fingerprint (str): Identifies the request, so a key can't be reused for a different one.
+            execute (Callable): Performs the request on the session it is given, and returns its result.
+
+        Returns:
+            The result of ``execute`` if no key was given, otherwise a JSON Response.
+
+        Raises:
+            HTTPException: If the key was used for a different request, or that request is still being processed.
+        """
+        if key is None:
+            return await execute(db)
+
+        cache_key = (user_id, key)
+
+        while True:
+            stored = self._cached(cache_key)
+            if stored is None:
+                in_flight = self._in_flight.get(cache_key)
+                if in_flight is not None:
+                    try:
+                        stored = await asyncio.shield(in_flight)
+                    except asyncio.CancelledError:
+                        if not in_flight.cancelled():
+                            raise
+                        # The first execution was cancelled, try to take it over
+                        continue
+            if stored is None:
+                stored = self._load(db, user_id, key)
+            if stored is not None:
+                return self._replay(stored, fingerprint)
+
+            future = asyncio.get_running_loop().create_future()
+            self._in_flight[cache_key] = future
+            try:
+                stored = await self._execute(db, user_id, key, fingerprint, execute)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                # Mark the exception as retrieved in case nobody else was waiting
+                future.exception()
+                raise
+            else:
+                future.set_result(stored)
+            finally:
+                self._in_flight.pop(cache_key, None)
+
+            return self._response(stored)
+
+    def _cached(self, cache_key: tuple[str, str]) -> Optional[StoredResponse]:
+        stored = self._cache.get(cache_key)
+        if stored is not None and stored.expires_at <= datetime.now():
+            del self._cache[cache_key]
+            return None
+        return stored
+
+    def _load(
+        self, db: SessionLocal, user_id: str, key: str
+    ) -> Optional[StoredResponse]:
+        record = db.get(IdempotencyKey, (user_id, key))
+        if record is None or record.expires_at <= datetime.now():
+            return None
+
+        stored = StoredResponse(
+            record.fingerprint,
+            record.status_code,
+            record.response_body,
+            record.expires_at,
+        )
+        if stored.status_code is not None:
+            self._cache.touch((user_id, key), stored)
+        return stored
+
+    async def _execute(
+        self,
+        db: SessionLocal,
+        user_id: str,
+        key: str,
+        fingerprint: str,
+        execute: Callable[[SessionLocal], Awaitable[Any]],
+    ) -> StoredResponse:
+        now = datetime.now()
+        expires_at = now + self.ttl
+
+        try:
+            # Events published by the handler go out once the transaction is committed
+            with invalidation_bus.deferred(), atomic_session(db.get_bind()) as session:
+                self._purge_expired(session, now)
+
+                # Merging reuses an expired row for the key if there is one
+                record = session.merge(
+                    IdempotencyKey(
+                        user_id=user_id,
+                        key=key,
+                        fingerprint=fingerprint,
+                        status_code=None,
+                        response_body=None,
+                        expires_at=expires_at,
+                    )
+                )
+
+                result = await execute(session)
+
+                if isinstance(result, Response):
+                    status_code, body = result.status_code, bytes(result.body)
+                else:
+                    status_code = 200
+                    body = json.dumps(jsonable_encoder(result)).encode()
+
+                record.status_code = status_code
+                record.response_body = body
+                session.add(record)
+                session.commit()
+        except Exception:
+            # A duplicate on another worker may have won the race for the key
+            stored = self._load(db, user_id, key)
+            if stored is None:
+                raise
+            logger.info(f"Idempotency key {key} was claimed concurrently")
+            # Raises unless it holds a finished response for this same request
+            self._replay(stored, fingerprint)
+            return stored
+
+        stored = StoredResponse(fingerprint, status_code, body, expires_at)
+        self._cache.touch((user_id, key), stored)
+        return stored
+
+    def _purge_expired(self, db: SessionLocal, now: datetime) -> None:
+        if time.monotonic() - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = time.monotonic()
+
+        db.query(IdempotencyKey).filter(IdempotencyKey.expires_at <= now).delete()
+
+    def _replay(self, stored: StoredResponse, fingerprint: str) -> Response:
+        if stored.fingerprint != fingerprint:
+            raise HTTPException(
+                status_code=422,
+                detail=f"{IDEMPOTENCY_HEADER} was already used for a different request",
+            )
+        if stored.status_code is None:
+            raise HTTPException(
+                status_code=409,
+                detail=f"A request with this {IDEMPOTENCY_HEADER} is still being processed",
+            )
+        return self._response(stored, replayed=True)
+
+    def _response(self, stored: StoredResponse, replayed: bool = False) -> Response:
+        return Response(
+            content=stored.body,
+            status_code=stored.status_code,
+            media_type="application/json",
+            headers={REPLAYED_HEADER: "true"} if replayed else None,
+        )
+
+    def _after_fork(self) -> None:
+        # In-flight executions belong to the parent's event loop
+        self._in_flight = {}
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
+idempotency_store = IdempotencyStore.from_settings()
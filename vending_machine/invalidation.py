@@ -0,0 +1,268 @@
+"""
+Cross-worker cache invalidation.
+
+Each worker on the host binds a Unix datagram socket in a shared directory.
+Publishing an event delivers it to the local subscribers and sends it to every
+other socket in the directory, where a receiver thread delivers it to that
+worker's subscribers.
+
+Events carry a version taken from the monotonic clock, which is shared by all
+processes on the host, so every worker applies them in version order: an
+event older than the last one seen for the same topic and key is dropped.
+Delivery is best effort; a worker that misses an event keeps a stale entry
+until the next event for it, or until the cache expires it.  Sends don't
+block: an event for a worker whose socket buffer is full is dropped.
+
+Whoever can write to the directory can feed the workers events, so it is
+created private to the user running the server, and one owned by someone else
+is refused.  The list of peers is kept between publishes and only read again
+once the directory has changed.
+
+Writes that only become visible when an enclosing transaction commits publish
+inside ``deferred``, so no worker refills its cache from the old rows first.
+"""
+
+import json
+import os
+import socket
+import stat
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Callable, Iterator, NamedTuple, Optional
+
+from vending_machine.cache import BoundedCache
+from vending_machine.config import settings
+from vending_machine.logging import get_logger
+
+logger = get_logger(__name__)
+
+USERS = "users"
+PRODUCTS = "products"
+SESSIONS = "sessions"
+REVOCATIONS = "revocations"
+
+
+class InvalidationEvent(NamedTuple):
+    topic: str
+    key: Optional[str]
+    version: int
+    origin: int
+
+
+Subscriber = Callable[[InvalidationEvent], None]
+
+# (topic, key) of the events held back by the innermost ``deferred`` block
+_deferred: ContextVar[Optional[list[tuple[str, Optional[str]]]]] = ContextVar(
+    "invalidation_deferred", default=None
+)
+
+
+class InvalidationBus:
+    def __init__(self, directory: str, max_entries: int = 100000) -> None:
+        self.directory = Path(directory)
+
+        self._subscribers: dict[str, list[Subscriber]] = defaultdict(list)
+        # (topic, key) -> version of the last event applied
+        self._versions = BoundedCache(max_entries)
+        self._topic_versions: dict[str, int] = {}
+        self._reset()
+
+        os.register_at_fork(after_in_child=self._reset)
+
+    @classmethod
+    def from_settings(cls) -> "InvalidationBus":
+        return cls(
+            settings.invalidation_bus_dir
+            or os.path.join(
+                tempfile.gettempdir(),
+                f"vending_machine-{os.getuid()}-{settings.port}-bus",
+            )
+        )
+
+    def _reset(self) -> None:
+        # Also runs in forked workers: the socket and thread belong to the parent
+        self._lock = threading.Lock()
+        self._socket: Optional[socket.socket] = None
+        self._sender: Optional[socket.socket] = None
+        self._path: Optional[Path] = None
+        self._thread: Optional[threading.Thread] = None
+        # The other workers' sockets, and the directory's mtime when they were listed
+        self._peers: Optional[list[str]] = None
+        self._peers_mtime: Optional[int] = None
+
+    def subscribe(self, topic: str, callback: Subscriber) -> None:
+        with self._lock:
+            self._subscribers[topic].append(callback)
+
+    def version(self, topic: str) -> int:
+        """
+        Returns the version of the latest event applied for the topic, 0 if there was none.
+        """
+        return self._topic_versions.get(topic, 0)
+
+    def publish(self, topic: str, key=None) -> int:
+        """
+        Publishes an invalidation to this worker and every other one on the host.
+
+        Args:
+            topic (str): What was written, e.g. PRODUCTS.
+            key (optional): Which entry was written, or None for the whole topic.
+
+        Returns:
+            int: The version of the event, or of the time it was held back at inside ``deferred``.
+        """
+        pending = _deferred.get()
+        if pending is not None:
+            pending.append((topic, key))
+            return time.monotonic_ns()
+
+        event = InvalidationEvent(
+            topic,
+            None if key is None else str(key),
+            time.monotonic_ns(),
+            os.getpid(),
+        )
+        self._deliver(event)
+        self._broadcast(event)
+        return event.version
+
+    @contextmanager
+    def deferred(self) -> Iterator[None]:
+        """
+        Holds back the events published in the block, in this context, and
+        publishes them once it exits, e.g. after the transaction they belong to.
+        """
+        pending: list[tuple[str, Optional[str]]] = []
+        token = _deferred.set(pending)
+        try:
+            yield
+        finally:
+            _deferred.reset(token)
+            # Also after a rollback, where they only cost a refill
+            for topic, key in pending:
+                self.publish(topic, key)
+
+    def _deliver(self, event: InvalidationEvent) -> bool:
+        with self._lock:
+            version_key = (event.topic, event.key)
+            if self._versions.get(version_key, -1) >= event.version:
+                return False
+            self._versions.touch(version_key, event.version)
+            if event.version > self._topic_versions.get(event.topic, 0):
+                self._topic_versions[event.topic] = event.version
+            subscribers = list(self._subscribers.get(event.topic, ()))
+
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error(e)
+        return True
+
+    def _list_peers(self) -> Optional[list[str]]:
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        if self._peers is None or mtime != self._peers_mtime:
+            own = str(self._path) if self._path else None
+            self._peers = [
+                str(peer) for peer in self.directory.glob("*.sock") if str(peer) != own
+            ]
+            # A socket added in the same clock tick as the listing leaves the
+            # mtime as it was, so list again until the directory has settled
+            settled = time.time_ns() - mtime > 1_000_000_000
+            self._peers_mtime = mtime if settled else None
+        return self._peers
+
+    def _broadcast(self, event: InvalidationEvent) -> None:
+        peers = self._list_peers()
+        if not peers:
+            return
+
+        if self._sender is None:
+            self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sender.setblocking(False)
+
+        data = json.dumps(event).encode()
+        for peer in peers:
+            try:
+                self._sender.sendto(data, peer)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The worker is gone
+                Path(peer).unlink(missing_ok=True)
+            except BlockingIOError:
+                logger.warning(f"Invalidation bus peer {peer} is not keeping up")
+
+    def _prepare_directory(self) -> None:
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        info = os.lstat(self.directory)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+            raise PermissionError(
+                f"Invalidation bus directory {self.directory} "
+                "is not a directory owned by this user"
+            )
+        if info.st_mode & 0o077:
+            logger.warning(
+                f"Invalidation bus directory {self.directory} was open to other users, "
+                "making it private"
+            )
+            os.chmod(self.directory, 0o700)
+
+    def start(self) -> None:
+        """
+        Joins the bus, receiving other workers' events on a background thread.
+        """
+        if self._socket is not None:
+            return
+
+        self._prepare_directory()
+        path = self.directory / f"{os.getpid()}.sock"
+        path.unlink(missing_ok=True)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(str(path))
+        sock.settimeout(0.5)
+
+        self._socket, self._path = sock, path
+        self._thread = threading.Thread(
+            target=self._receive, args=(sock,), name="invalidation-bus", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        sock, path, thread = self._socket, self._path, self._thread
+        if sock is None:
+            return
+
+        self._socket = None
+        self._path = None
+        path.unlink(missing_ok=True)
+        thread.join()
+        sock.close()
+
+    def _receive(self, sock: socket.socket) -> None:
+        while self._socket is sock:
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+
+            try:
+                event = InvalidationEvent(*json.loads(data))
+            except (TypeError, ValueError):
+                logger.warning(f"Ignoring malformed invalidation event {data!r}")
+                continue
+
+            self._deliver(event)
+
+
+invalidation_bus = InvalidationBus.from_settings()
@@ -0,0 +1,181 @@
+"""
+Append-only ledger of deposits, purchases and refunds.
+
+Every change to a user's balance is a signed row of ``ledger_entries``;
+nothing there is ever updated or deleted, so the history can be audited and
+any balance recovered from it.  Entries are written with one batched INSERT
+per call to ``append``.
+
+Reading a balance from the whole history would cost a scan of every entry the
+user ever made, so ``append`` also adds the entries to the user's row of
+``ledger_balances`` in the same transaction, with one upsert that returns the
+new balance and the entries since the last snapshot.  Reading a balance is
+then one primary key lookup.  Every ``ledger_snapshot_interval`` entries the
+balance is also written to ``balance_snapshots``, as checkpoints an audit can
+check the history against without replaying all of it.
+
+The ledger is the source of truth for balances; user_sessions.deposited_amount
+only mirrors it for the session view, and users.deposit isn't written at all.
+The running balance and snapshots assume entries commit in id order, which
+holds on SQLite since it serializes writers.
+"""
+
+from datetime import datetime
+from typing import Iterable, Optional
+
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from vending_machine.config import settings
+from vending_machine.data_objects.balance_snapshot import BalanceSnapshot
+from vending_machine.data_objects.ledger_balance import LedgerBalance
+from vending_machine.data_objects.ledger_entry import LedgerEntry
+from vending_machine.data_objects.ledger_kind import LedgerKind
+from vending_machine.database import SessionLocal
+
+
+def entry(
+    user_id: str,
+    kind: LedgerKind,
+    amount: int,
+    session_id: Optional[str] = None,
+    product_id: Optional[int] = None,
+    quantity: Optional[int] = None,
+) -> dict:
+    return {
+        "user_id": user_id,
+        "session_id": session_id,
+        "kind": kind,
+        "amount": amount,
+        "product_id": product_id,
+        "quantity": quantity,
+        "created_at": datetime.now(),
+    }
+
+
+def append(db: SessionLocal, entries: Iterable[dict]) -> None:
+    """
+    Appends the entries in one INSERT, adds them to their users' balances,
+    and snapshots the balance of any user they take past the snapshot
+    interval.  Doesn't commit.
+
+    Args:
+        db (SessionLocal): The database session.
+        entries (Iterable[dict]): Entries, as built by ``entry``.
+    """
+    entries = list(entries)
+    if not entries:
+        return
+
+    ids = db.execute(
+        insert(LedgerEntry).returning(LedgerEntry.id, sort_by_parameter_order=True),
+        entries,
+    ).scalars()
+
+    # User -> [entries, their total, the last one's id]
+    appended: dict[str, list[int]] = {}
+    for row, entry_id in zip(entries, ids):
+        counts = appended.setdefault(row["user_id"], [0, 0, 0])
+        counts[0] += 1
+        counts[1] += row["amount"]
+        counts[2] = max(counts[2], entry_id)
+
+    for user_id, (count, total, last_id) in appended.items():
+        statement = sqlite_insert(LedgerBalance).values(
+            user_id=user_id, balance=total, entry_id=last_id, unsnapshotted=count
+        )
+        balance, unsnapshotted = db.execute(
+            statement.on_conflict_do_update(
+                index_elements=[LedgerBalance.user_id],
+                set_={
+                    "balance": LedgerBalance.balance + statement.excluded.balance,
+                    "entry_id": statement.excluded.entry_id,
+                    "unsnapshotted": LedgerBalance.unsnapshotted
+                    + statement.excluded.unsnapshotted,
+                },
+            ).returning(LedgerBalance.balance, LedgerBalance.unsnapshotted)
+        ).one()
+
+        if unsnapshotted >= settings.ledger_snapshot_interval:
+            db.execute(
+                insert(BalanceSnapshot).values(
+                    user_id=user_id, entry_id=last_id, balance=balance
+                )
+            )
+            db.execute(
+                update(LedgerBalance)
+                .where(LedgerBalance.user_id == user_id)
+                .values(unsnapshotted=0)
+            )
+
+
+def deposit(
+    db: SessionLocal, user_id: str, amount: int, session_id: Optional[str] = None
+) -> None:
+    append(db, [entry(user_id, LedgerKind.DEPOSIT, amount, session_id)])
+
+
+def purchase(
+    db: SessionLocal,
+    user_id: str,
+    product_id: int,
+    quantity: int,
+    cost: int,
+    session_id: Optional[str] = None,
+) -> None:
+    append(
+        db,
+        [
+            entry(
+                user_id,
+                LedgerKind.PURCHASE,
+                -cost * quantity,
+                session_id,
+                product_id=product_id,
+                quantity=quantity,
+            )
+        ],
+    )
+
+
+def refund(
+    db: SessionLocal, user_id: str, amount: int, session_id: Optional[str] = None
+) -> None:
+    append(db, [entry(user_id, LedgerKind.REFUND, -amount, session_id)])
+
+
+def balance(db: SessionLocal, user_id: str) -> int:
+    """
+    Returns the user's balance, from their running balance row.
+    """
+    return (
+        db.execute(
+            select(LedgerBalance.balance).where(LedgerBalance.user_id == user_id)
+        ).scalar_one_or_none()
+        or 0
+    )
+
+
+def replay(db: SessionLocal, user_id: str) -> int:
+    """
+    Returns the user's balance recomputed from their whole history, ignoring
+    the running balance and snapshots.  For auditing them; use ``balance`` to
+    read a balance.
+    """
+    return db.execute(
+        select(func.coalesce(func.sum(LedgerEntry.amount), 0)).where(
+            LedgerEntry.user_id == user_id
+        )
+    ).scalar_one()
+
+
+def latest(db: SessionLocal, user_id: str) -> Optional[LedgerEntry]:
+    """
+    Returns the user's most recent entry, None if they have none.
+    """
+    return db.execute(
+        select(LedgerEntry)
+        .where(LedgerEntry.user_id == user_id)
+        .order_by(LedgerEntry.id.desc())
+        .limit(1)
+    ).scalar_one_or_none()
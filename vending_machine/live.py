@@ -0,0 +1,298 @@
+"""
+Live machine state for kiosk screens.
+
+Instead of each screen polling for its balance and the catalogue's stock, it
+holds a ``/machine/live`` WebSocket and is sent them when they change.
+
+The hub follows the ``sessions`` and ``products`` topics of the invalidation
+bus, so it hears about writes made by any worker.  Events are handed to the
+event loop, where they collect until the hub's task gets to them; however
+many arrived meanwhile, each balance and product is then read once, off the
+loop, and the result fanned out to the subscribers it concerns.
+
+Every subscriber has a queue of at most ``live_queue_size`` messages.  A
+subscriber that falls that far behind is dropped, and its socket closed,
+rather than letting its backlog grow or holding up the others.
+
+A socket is only authenticated when it opens, so the hub also follows the
+``revocations`` and ``users`` topics: a subscriber whose token is revoked, or
+whose user is deleted or disabled, is closed as well.
+"""
+
+import asyncio
+from typing import Callable, Iterable, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+
+from vending_machine import ledger, stock
+from vending_machine.config import settings
+from vending_machine.data_objects.product import Product as ProductOrm
+from vending_machine.data_objects.user import User as UserOrm
+from vending_machine.database import SessionLocal
+from vending_machine.invalidation import (
+    PRODUCTS,
+    REVOCATIONS,
+    SESSIONS,
+    USERS,
+    InvalidationEvent,
+    invalidation_bus,
+)
+from vending_machine.logging import get_logger
+from vending_machine.models.live import LiveBalance, LiveEntry, LiveStock
+from vending_machine.revocation import revocation_list
+
+logger = get_logger(__name__)
+
+
+class Subscriber:
+    __slots__ = (
+        "user_id",
+        "username",
+        "session_id",
+        "issued_at",
+        "queue",
+        "dropped",
+        "revoked",
+    )
+
+    def __init__(
+        self,
+        user_id: str,
+        size: int,
+        username: Optional[str] = None,
+        session_id: Optional[str] = None,
+        issued_at: Optional[float] = None,
+    ) -> None:
+        self.user_id = user_id
+        self.username = username
+        # The stateless token the socket was opened with, if any
+        self.session_id = session_id
+        self.issued_at = issued_at
+        # Messages to send, then None once the subscriber is closed
+        self.queue: asyncio.Queue[Optional[dict]] = asyncio.Queue(size + 1)
+        self.dropped = False
+        self.revoked = False
+
+    def is_revoked(self) -> bool:
+        return self.issued_at is not None and revocation_list.is_revoked(
+            self.session_id, self.user_id, self.issued_at
+        )
+
+    def close(self) -> None:
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+def _balance(db: SessionLocal, user_id: str) -> dict:
+    entry = ledger.latest(db, user_id)
+    latest = (
+        LiveEntry(
+            kind=entry.kind.value,
+            amount=entry.amount,
+            productId=None if entry.product_id is None else str(entry.product_id),
+            quantity=entry.quantity,
+        )
+        if entry
+        else None
+    )
+    return LiveBalance(balance=ledger.balance(db, user_id), latest=latest).model_dump()
+
+
+def _stock(db: SessionLocal, product_ids: Optional[Iterable[str]] = None) -> dict:
+    statement = select(ProductOrm.id)
+    if product_ids is not None:
+        product_ids = [int(id) for id in product_ids]
+        statement = statement.where(ProductOrm.id.in_(product_ids))
+    existing = set(db.execute(statement).scalars())
+    totals = stock.stock_totals(db, existing)
+
+    ids = existing if product_ids is None else product_ids
+    return LiveStock(
+        products={str(id): totals.get(id, 0) if id in existing else None for id in ids}
+    ).model_dump()
+
+
+class LiveHub:
+    def __init__(
+        self,
+        queue_size: int,
+        session_factory: Callable[[], SessionLocal] = SessionLocal,
+    ) -> None:
+        self.queue_size = queue_size
+        self.session_factory = session_factory
+
+        self._subscribers: dict[str, set[Subscriber]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        # Keys that changed since the last flush; None for a whole topic
+        self._users: set[str] = set()
+        self._products: Optional[set[str]] = set()
+        self._usernames: Optional[set[str]] = set()
+
+        invalidation_bus.subscribe(SESSIONS, self._on_event)
+        invalidation_bus.subscribe(PRODUCTS, self._on_event)
+        invalidation_bus.subscribe(USERS, self._on_event)
+        invalidation_bus.subscribe(REVOCATIONS, self._on_event)
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="live-hub")
+
+    async def stop(self) -> None:
+        task, self._task, self._loop = self._task, None, None
+        if task is not None:
+            task.cancel()
+        for subscribers in self._subscribers.values():
+            for subscriber in subscribers:
+                subscriber.close()
+        self._subscribers.clear()
+
+    def subscribe(
+        self,
+        user_id: str,
+        username: Optional[str] = None,
+        session_id: Optional[str] = None,
+        issued_at: Optional[float] = None,
+    ) -> Subscriber:
+        subscriber = Subscriber(
+            user_id, self.queue_size, username, session_id, issued_at
+        )
+        self._subscribers.setdefault(user_id, set()).add(subscriber)
+        # In case the token was revoked since it was checked
+        if subscriber.is_revoked():
+            self._revoke(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        subscribers = self._subscribers.get(subscriber.user_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[subscriber.user_id]
+
+    def snapshot(self, user_id: str) -> list[dict]:
+        """
+        Returns the messages bringing a new subscriber up to date: its balance and every product's stock.
+        """
+        db = self.session_factory()
+        try:
+            return [_balance(db, user_id), _stock(db)]
+        finally:
+            db.close()
+
+    def _on_event(self, event: InvalidationEvent) -> None:
+        # Called on whichever thread published or received the event
+        loop = self._loop
+        if loop is None or not self._subscribers:
+            return
+        try:
+            loop.call_soon_threadsafe(self._collect, event.topic, event.key)
+        except RuntimeError:
+            # The loop has closed
+            pass
+
+    def _collect(self, topic: str, key: Optional[str]) -> None:
+        if topic == REVOCATIONS:
+            # The revocation list has already taken the event in
+            for subscribers in list(self._subscribers.values()):
+                for subscriber in list(subscribers):
+                    if subscriber.is_revoked():
+                        self._revoke(subscriber)
+            return
+        if topic == SESSIONS:
+            if key in self._subscribers:
+                self._users.add(key)
+        elif topic == USERS:
+            if key is None:
+                self._usernames = None
+            elif self._usernames is not None:
+                self._usernames.add(key)
+        elif key is None:
+            self._products = None
+        elif self._products is not None:
+            self._products.add(key)
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            users, self._users = self._users, set()
+            products, self._products = self._products, set()
+            usernames, self._usernames = self._usernames, set()
+            subscribed = {
+                subscriber.username
+                for subscribers in self._subscribers.values()
+                for subscriber in subscribers
+                if subscriber.username is not None
+            }
+            usernames = subscribed if usernames is None else usernames & subscribed
+            try:
+                balances, stock_message, gone = await run_in_threadpool(
+                    self._read, users, products, usernames
+                )
+            except Exception as e:
+                logger.error(e)
+                continue
+
+            for subscribers in list(self._subscribers.values()):
+                for subscriber in list(subscribers):
+                    if subscriber.username in gone:
+                        self._revoke(subscriber)
+
+            for user_id, message in balances.items():
+                for subscriber in list(self._subscribers.get(user_id, ())):
+                    self._offer(subscriber, message)
+            if stock_message is not None:
+                for subscribers in list(self._subscribers.values()):
+                    for subscriber in list(subscribers):
+                        self._offer(subscriber, stock_message)
+
+    def _read(
+        self, users: set[str], products: Optional[set[str]], usernames: set[str]
+    ) -> tuple[dict[str, dict], Optional[dict], set[str]]:
+        """
+        Returns the balances and stock to push, and which of the usernames no longer belong to an active user.
+        """
+        db = self.session_factory()
+        try:
+            balances = {user_id: _balance(db, user_id) for user_id in users}
+            if products is None:
+                stock_message = _stock(db)
+            else:
+                stock_message = _stock(db, products) if products else None
+            gone = set()
+            if usernames:
+                active = db.scalars(
+                    select(UserOrm.username).where(
+                        UserOrm.username.in_(usernames), UserOrm.disabled.is_not(True)
+                    )
+                )
+                gone = usernames - set(active)
+            return balances, stock_message, gone
+        finally:
+            db.close()
+
+    def _offer(self, subscriber: Subscriber, message: dict) -> None:
+        if subscriber.queue.qsize() < self.queue_size:
+            subscriber.queue.put_nowait(message)
+            return
+
+        logger.info(f"Dropping live subscriber {subscriber.user_id}, too far behind")
+        subscriber.dropped = True
+        self.unsubscribe(subscriber)
+        subscriber.close()
+
+    def _revoke(self, subscriber: Subscriber) -> None:
+        logger.info(f"Closing live subscriber {subscriber.user_id}, token revoked")
+        subscriber.revoked = True
+        self.unsubscribe(subscriber)
+        subscriber.close()
+
+
+live_hub = LiveHub(settings.live_queue_size)
@@ -0,0 +1,182 @@
+"""
+Admission control in front of ``authentication.authenticate_user``.
+
+Every login attempt costs a DB lookup and a bcrypt verify, so attempts are
+rate limited per username and per client with token buckets, and recent
+failures are remembered for a short while so that repeating them is answered
+without touching the DB or bcrypt.  All state is in memory and bounded.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from vending_machine.cache import BoundedCache
+from vending_machine.config import settings
+from vending_machine.invalidation import USERS, InvalidationEvent, invalidation_bus
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float) -> None:
+        self.tokens = tokens
+        self.updated = updated
+
+    def take(self, now: float, rate: float, burst: int) -> float:
+        """
+        Takes a token if one is available.
+
+        Returns:
+            float: 0 if a token was taken, otherwise the seconds until one will be.
+        """
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+
+        return (1 - self.tokens) / rate if rate > 0 else float("inf")
+
+
+class LoginGuard:
+    def __init__(
+        self,
+        username_rate: float,
+        username_burst: int,
+        client_rate: float,
+        client_burst: int,
+        negative_ttl: float,
+        max_entries: int,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.username_rate = username_rate
+        self.username_burst = username_burst
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+
+        self._username_buckets = BoundedCache(max_entries)
+        self._client_buckets = BoundedCache(max_entries)
+        # key -> expiry time, for unknown usernames and failed username/password pairs
+        self._negative = BoundedCache(max_entries)
+        # Failed passwords are only ever held as a keyed digest
+        self._digest_key = os.urandom(16)
+        self._lock = threading.Lock()
+
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    @classmethod
+    def from_settings(cls) -> "LoginGuard":
+        return cls(
+            username_rate=settings.login_username_rate,
+            username_burst=settings.login_username_burst,
+            client_rate=settings.login_client_rate,
+            client_burst=settings.login_client_burst,
+            negative_ttl=settings.login_negative_cache_ttl,
+            max_entries=settings.login_guard_max_entries,
+        )
+
+    def _bucket(self, buckets: BoundedCache, key: str, burst: int, now: float):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(burst, now)
+        buckets.touch(key, bucket)
+        return bucket
+
+    def admit(self, username: str, client: str) -> Optional[float]:
+        """
+        Spends a login attempt for the username and the client.
+
+        Returns:
+            Optional[float]: None if the attempt is admitted, otherwise the seconds to wait before retrying.
+        """
+        with self._lock:
+            now = self.clock()
+            client_wait = self._bucket(
+                self._client_buckets, client, self.client_burst, now
+            ).take(now, self.client_rate, self.client_burst)
+            if client_wait:
+                return client_wait
+
+            username_wait = self._bucket(
+                self._username_buckets, username, self.username_burst, now
+            ).take(now, self.username_rate, self.username_burst)
+            if username_wait:
+                return username_wait
+
+        return None
+
+    def _failure_key(self, username: str, password: str) -> bytes:
+        return hashlib.blake2b(
+            f"{username}\0{password}".encode(), key=self._digest_key, digest_size=16
+        ).digest()
+
+    def _is_cached(self, key) -> bool:
+        expiry = self._negative.get(key)
+        if expiry is None:
+            return False
+        if expiry <= self.clock():
+            del self._negative[key]
+            return False
+        return True
+
+    def is_known_failure(self, username: str, password: str) -> bool:
+        """
+        Returns whether the username is recently known not to exist, or this
+        username/password pair recently failed to authenticate.
+        """
+        failure_key = self._failure_key(username, password)
+        with self._lock:
+            return self._is_cached(("user", username)) or self._is_cached(failure_key)
+
+    def remember_unknown_username(self, username: str) -> None:
+        with self._lock:
+            self._negative.touch(("user", username), self.clock() + self.negative_ttl)
+
+    def remember_failure(self, username: str, password: str) -> None:
+        failure_key = self._failure_key(username, password)
+        with self._lock:
+            self._negative.touch(failure_key, self.clock() + self.negative_ttl)
+
+    def forget_username(self, username: str) -> None:
+        """
+        Drops the unknown-username entry, e.g. once a user with that name is created.
+        """
+        with self._lock:
+            self._negative.pop(("user", username), None)
+
+    def forget_all(self) -> None:
+        """
+        Drops every remembered failure, e.g. once the users table was replaced.
+        """
+        with self._lock:
+            self._negative.clear()
+
+    def _after_fork(self) -> None:
+        # The lock may have been held by another thread at the time of the fork
+        self._lock = threading.Lock()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._username_buckets.clear()
+            self._client_buckets.clear()
+            self._negative.clear()
+
+
+login_guard = LoginGuard.from_settings()
+
+
+def _forget_written_user(event: InvalidationEvent) -> None:
+    # No key means any user may have changed, e.g. on a reset to a snapshot
+    if event.key is None:
+        login_guard.forget_all()
+    else:
+        login_guard.forget_username(event.key)
+
+
+invalidation_bus.subscribe(USERS, _forget_written_user)
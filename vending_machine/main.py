@@ -1,4 +1,5 @@
 import importlib
+from functools import partial
 from pathlib import Path
 from typing import List
 
@@ -10,8 +11,18 @@ from fastapi.openapi.docs import (
     get_swagger_ui_oauth2_redirect_html,
 )
 
+from vending_machine.compression import CompressionMiddleware
 from vending_machine.config import settings
+from vending_machine.invalidation import invalidation_bus
+from vending_machine.live import live_hub
 from vending_machine.logging import get_logger
+from vending_machine.profiling import ProfilingMiddleware
+from vending_machine.provisioning import password_hasher
+from vending_machine.revocation import revocation_list
+from vending_machine.shedding import LoadSheddingMiddleware
+from vending_machine.slow_queries import QueryRouteMiddleware
+from vending_machine.tracing import TracedJSONResponse, TracingMiddleware
+from vending_machine.warmup import ready, start_warm_up, stop_warm_up
 
 logger = get_logger(__name__)
 
@@ -51,6 +62,7 @@ def main() -> FastAPI:
     app = FastAPI(
         title=settings.app_name,
         debug=settings.debug,
+        default_response_class=TracedJSONResponse,
     )
 
     if settings.debug:
@@ -94,9 +106,14 @@ def main() -> FastAPI:
     # Add the assets to the app
     app.logger = logger
 
+    # Inside set_default_content_type, which streams the body on in chunks, so
+    # this still sees each response whole
+    app.add_middleware(CompressionMiddleware)
+
     @app.middleware("http")
     async def set_default_content_type(request, call_next):
         response = await call_next(request)
+        # Only the Content-Type is replaced; Content-Encoding and the rest are kept
         if request.url.path.endswith("/docs"):
             response.headers["Content-Type"] = "text/html"
         else:
@@ -104,23 +121,39 @@ def main() -> FastAPI:
 
         return response
 
+    app.add_middleware(QueryRouteMiddleware)
+    app.add_middleware(TracingMiddleware)
+    # Before anything else is spent on a request that is turned away
+    app.add_middleware(LoadSheddingMiddleware)
+    # Outermost, so a profile covers every other middleware too
+    app.add_middleware(ProfilingMiddleware)
+
+    # Each worker joins the invalidation bus once it is running
+    app.add_event_handler("startup", invalidation_bus.start)
+    app.add_event_handler("shutdown", invalidation_bus.stop)
+    app.add_event_handler("startup", live_hub.start)
+    app.add_event_handler("shutdown", live_hub.stop)
+    app.add_event_handler("shutdown", password_hasher.shutdown)
+    if settings.stateless_sessions:
+        app.add_event_handler("startup", revocation_list.load)
+
     routes = get_routes_from_controllers()
     for route in routes:
         app.include_router(route)
 
+    # Last, so the worker is only reported ready once everything above has started
+    if settings.warmup:
+        ready.clear()
+        app.add_event_handler("startup", partial(start_warm_up, app))
+        app.add_event_handler("shutdown", partial(stop_warm_up, app))
+    else:
+        ready.set()
+
     return app
 
 
 # Run the app
 if __name__ == "__main__":
-    import uvicorn
+    from vending_machine.server import run
 
-    app = main()
-
-    uvicorn.run(
-        app,
-        host=settings.host or "0.0.0.0",
-        port=settings.port or 8000,
-        log_level="debug" if settings.debug else "info",
-        reload=settings.debug,
-    )
+    run(main())
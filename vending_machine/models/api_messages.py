@@ -1,9 +1,7 @@
-from typing import Literal
-
 from pydantic import BaseModel
 
 
 class ApiMessage(BaseModel):
     message: str
-    success: Literal["true", "false"]
+    success: bool
     errors: list[str] = []
@@ -0,0 +1,30 @@
+from typing import Any
+
+from pydantic import BaseModel
+
+
+class SubRequest(BaseModel):
+    method: str = "GET"
+    # With the query string, e.g. "/machine/deposit?amount=5"
+    path: str
+    headers: dict[str, str] = {}
+    # Sent as JSON
+    body: Any = None
+
+
+class BatchRequest(BaseModel):
+    requests: list[SubRequest]
+    # Run the requests in one transaction, stopping at the first that fails
+    atomic: bool = False
+
+
+class SubResponse(BaseModel):
+    status: int
+    headers: dict[str, str]
+    body: Any = None
+
+
+class BatchResponse(BaseModel):
+    responses: list[SubResponse]
+    # Set when an atomic batch was rolled back
+    rolledBack: bool = False
@@ -0,0 +1,43 @@
+from typing import Any, Optional
+
+from pydantic import BaseModel
+
+
+class BulkRowError(BaseModel):
+    row: int
+    errors: list[Any]
+
+
+class BulkImportResult(BaseModel):
+    created: int
+    failed: int
+    errors: list[BulkRowError]
+    # Set when there were more failed rows than errors reported
+    errorsTruncated: bool = False
+
+
+class BulkUserResult(BaseModel):
+    username: str
+    created: bool
+    id: Optional[str] = None
+    error: Optional[str] = None
+
+
+class HashingWorker(BaseModel):
+    pid: int
+    passwords: int
+    # Time spent hashing in this worker
+    seconds: float
+
+
+class HashingStats(BaseModel):
+    # Wall clock time for all the hashing
+    seconds: float
+    workers: list[HashingWorker]
+
+
+class BulkUsersResult(BaseModel):
+    created: int
+    failed: int
+    users: list[BulkUserResult]
+    hashing: HashingStats
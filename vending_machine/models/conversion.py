@@ -0,0 +1,209 @@
+"""
+Conversion of ORM rows into the API's pydantic models.
+
+Rows that come straight out of our own database are trusted: they are mapped
+from ORM column names to model field names through precomputed field maps and
+constructed without validation. Untrusted rows are validated as a whole result
+set through a cached ``TypeAdapter``.
+"""
+
+from enum import Enum
+from functools import lru_cache
+from operator import attrgetter
+from typing import Any, Callable, Iterable, Optional, TypeVar
+
+from pydantic import BaseModel, TypeAdapter
+
+from vending_machine.models.product import Product
+from vending_machine.models.user import UserWithoutPassword
+from vending_machine.tracing import traced
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+# ORM column name -> API field name
+PRODUCT_FIELD_MAP: dict[str, str] = {
+    "id": "id",
+    "amount_available": "amountAvailable",
+    "cost": "cost",
+    "product_name": "productName",
+    "seller_id": "sellerId",
+}
+
+USER_FIELD_MAP: dict[str, str] = {
+    "id": "id",
+    "username": "username",
+    "role": "role",
+    "deposit": "deposit",
+}
+
+FIELD_MAPS: dict[type[BaseModel], dict[str, str]] = {
+    Product: PRODUCT_FIELD_MAP,
+    UserWithoutPassword: USER_FIELD_MAP,
+}
+
+# API field name -> ORM column name, for writes
+PRODUCT_COLUMN_MAP: dict[str, str] = {
+    field: column for column, field in PRODUCT_FIELD_MAP.items()
+}
+
+
+def _as_str(value: Any) -> Any:
+    return value if value is None or isinstance(value, str) else str(value)
+
+
+def _enum_value(value: Any) -> Any:
+    return value.value if isinstance(value, Enum) else value
+
+
+def _converter_for(model: type[BaseModel], field_name: str) -> Optional[Callable]:
+    """
+    Picks the cheap coercion a trusted value still needs to match the field, if any.
+
+    The ORM stores some string ids as integers and hands back enum members where
+    the models are configured to hold enum values.
+    """
+    annotation = model.model_fields[field_name].annotation
+
+    if annotation is str:
+        return _as_str
+    if (
+        model.model_config.get("use_enum_values")
+        and isinstance(annotation, type)
+        and issubclass(annotation, Enum)
+    ):
+        return _enum_value
+    return None
+
+
+class _CompiledFieldMap:
+    """
+    A field map prepared for one model: an attribute getter fetching every mapped
+    column at once, the field names in the same order, and the coercions to apply.
+    """
+
+    def __init__(self, model: type[BaseModel]) -> None:
+        field_map = FIELD_MAPS[model]
+
+        self.fields = tuple(field_map.values())
+        self.fields_set = frozenset(self.fields)
+        self.covers_model = self.fields_set == set(model.model_fields)
+        self.converters = tuple(
+            (index, converter)
+            for index, converter in enumerate(
+                _converter_for(model, field) for field in self.fields
+            )
+            if converter is not None
+        )
+
+        getter = attrgetter(*field_map)
+        self.values = getter if len(field_map) > 1 else lambda row: (getter(row),)
+
+    def to_fields(self, row: Any) -> dict[str, Any]:
+        values = self.values(row)
+        if self.converters:
+            values = list(values)
+            for index, convert in self.converters:
+                values[index] = convert(values[index])
+        return dict(zip(self.fields, values))
+
+
+@lru_cache(maxsize=None)
+def _compiled_field_map(model: type[BaseModel]) -> _CompiledFieldMap:
+    return _CompiledFieldMap(model)
+
+
+@lru_cache(maxsize=None)
+def list_adapter(model: type[ModelT]) -> TypeAdapter:
+    """
+    Returns the cached ``TypeAdapter`` validating a ``list`` of ``model``.
+    """
+    return TypeAdapter(list[model])
+
+
+def _construct_many(
+    model: type[ModelT], field_map: _CompiledFieldMap, rows: Iterable[Any]
+) -> list[ModelT]:
+    if not field_map.covers_model:
+        construct = model.model_construct
+        return [construct(**field_map.to_fields(row)) for row in rows]
+
+    # Every field is supplied, so there are no defaults for ``model_construct`` to
+    # fill in; setting the instance state directly is what it would do, minus the
+    # per-field bookkeeping that makes it slower than validating.
+    new = model.__new__
+    set_attribute = object.__setattr__
+    fields_set = field_map.fields_set
+
+    models = []
+    for row in rows:
+        instance = new(model)
+        set_attribute(instance, "__dict__", field_map.to_fields(row))
+        set_attribute(instance, "__pydantic_fields_set__", set(fields_set))
+        set_attribute(instance, "__pydantic_extra__", None)
+        set_attribute(instance, "__pydantic_private__", None)
+        models.append(instance)
+    return models
+
+
+@traced("conversion")
+def from_orm_rows(
+    model: type[ModelT], rows: Iterable[Any], trusted: bool = True
+) -> list[ModelT]:
+    """
+    Converts a result set of ORM rows into instances of ``model``.
+
+    Args:
+        model (type[BaseModel]): The API model to build, must have an entry in FIELD_MAPS.
+        rows (Iterable): The ORM rows.
+        trusted (bool, optional): Skip validation for rows read from our own database. Defaults to True.
+
+    Returns:
+        list[BaseModel]: The converted models, in the order of the rows.
+
+    Raises:
+        ValidationError: If the rows are not trusted and fail validation.
+    """
+    field_map = _compiled_field_map(model)
+
+    if trusted:
+        return _construct_many(model, field_map, rows)
+
+    return list_adapter(model).validate_python(
+        [field_map.to_fields(row) for row in rows]
+    )
+
+
+def from_orm_row(model: type[ModelT], row: Any, trusted: bool = True) -> ModelT:
+    """
+    Converts a single ORM row into an instance of ``model``.  See ``from_orm_rows``.
+    """
+    return from_orm_rows(model, (row,), trusted=trusted)[0]
+
+
+def product_columns(product: BaseModel) -> dict[str, Any]:
+    """
+    Maps a product model, e.g. a ``ProductCreate``, to ORM column values.
+    """
+    return {
+        PRODUCT_COLUMN_MAP[field]: value
+        for field, value in product.model_dump().items()
+        if field in PRODUCT_COLUMN_MAP
+    }
+
+
+def products_from_orm(rows: Iterable[Any], trusted: bool = True) -> list[Product]:
+    return from_orm_rows(Product, rows, trusted=trusted)
+
+
+def product_from_orm(row: Any, trusted: bool = True) -> Product:
+    return from_orm_row(Product, row, trusted=trusted)
+
+
+def users_from_orm(
+    rows: Iterable[Any], trusted: bool = True
+) -> list[UserWithoutPassword]:
+    return from_orm_rows(UserWithoutPassword, rows, trusted=trusted)
+
+
+def user_from_orm(row: Any, trusted: bool = True) -> UserWithoutPassword:
+    return from_orm_row(UserWithoutPassword, row, trusted=trusted)
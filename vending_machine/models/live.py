@@ -0,0 +1,24 @@
+from typing import Literal, Optional
+
+from pydantic import BaseModel
+
+
+class LiveEntry(BaseModel):
+    kind: str
+    # Signed: credits are positive, debits negative
+    amount: int
+    productId: Optional[str] = None
+    quantity: Optional[int] = None
+
+
+class LiveBalance(BaseModel):
+    type: Literal["balance"] = "balance"
+    balance: int
+    # What last changed the balance, e.g. a purchase
+    latest: Optional[LiveEntry] = None
+
+
+class LiveStock(BaseModel):
+    type: Literal["stock"] = "stock"
+    # Product id -> stock left, None once the product is deleted
+    products: dict[str, Optional[int]]
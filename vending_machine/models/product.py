@@ -8,11 +8,12 @@ class ProductBase(BaseModel):
 
 
 class ProductCreate(ProductBase):
-    @root_validator
+    @root_validator(skip_on_failure=True)
     def validate_amount_available(cls, values):
         if "sellerId" in values:
             # We don't want to allow the user to set the sellerId - it's set from their session
             raise ValueError("Cannot create product with sellerId")
+        return values
 
     class Config:
         from_attributes = True
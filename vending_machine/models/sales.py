@@ -0,0 +1,18 @@
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class ProductSales(BaseModel):
+    productId: str
+    # None for a product deleted before its name was kept with its sales
+    productName: Optional[str]
+    unitsSold: int
+    revenue: int
+
+
+class SellerSales(BaseModel):
+    sellerId: str
+    unitsSold: int
+    revenue: int
+    products: list[ProductSales]
@@ -0,0 +1,11 @@
+from pydantic import BaseModel
+
+from vending_machine.models.product import Product
+
+
+class ProductSearchResult(BaseModel):
+    products: list[Product]
+    # Matches across all pages
+    total: int
+    limit: int
+    offset: int
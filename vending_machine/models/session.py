@@ -2,7 +2,7 @@ from datetime import datetime
 
 from pydantic import BaseModel
 
-from vending_machine.models.product import Product
+from vending_machine.models.session_product import SessionProduct
 from vending_machine.models.user import User
 
 
@@ -13,7 +13,7 @@ class UserSession(BaseModel):
     deposited_amount: int
 
     user: User
-    products: list[Product]
+    products: list[SessionProduct]
 
     class Config:
         from_attributes = True
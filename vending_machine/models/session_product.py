@@ -2,9 +2,7 @@ from pydantic import BaseModel
 
 
 class SessionProduct(BaseModel):
-    id: int
-    session_id: int
-    product_id: int
-
-    class Config:
-        from_attributes = True
+    productId: str
+    productName: str
+    cost: int
+    quantity: int
@@ -1,7 +1,7 @@
 from typing import Optional
 from uuid import UUID
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from vending_machine.data_objects.role import Role
 
@@ -20,6 +20,8 @@ class UserCreate(UserBase):
 
 class UserUpdate(BaseModel):
     role: Optional[Role] = None
+    disabled: Optional[bool] = None
+    # Refused, balances only change through the ledger
     deposit: Optional[int] = None
 
 
@@ -61,3 +63,10 @@ class UserWithoutPassword(UserBase):
 
     class Config:
         from_attributes = True
+
+
+class SessionUser(UserWithoutPassword):
+    # The session of a stateless token; never sent back to clients
+    session_id: Optional[str] = Field(None, exclude=True)
+    # When the token was issued, to check it against later revocations
+    issued_at: Optional[float] = Field(None, exclude=True)
@@ -0,0 +1,307 @@
+"""
+Opt-in profiling of single requests.
+
+A request is profiled when it carries a valid ``X-Profile`` header, made with
+``python -m vending_machine.cli profile-header``, or when it is picked by the
+sample rate for its route (``profile_route_rates``, keyed by route path, or
+``profile_sample_rate`` for the rest).  Nothing is profiled by default.
+
+While a profiled request is in flight a ``sys.setprofile`` hook is installed
+on the event loop thread, and on any thread started meanwhile.  The hook
+records only the calls made in the request's own context, so the requests
+interleaved with it on the loop are left out; time spent suspended at an
+``await`` isn't counted.  Work handed to threads that already existed, such as
+the thread pool's idle workers, isn't seen.
+
+Each profile is written to ``profile_dir`` as a ``.collapsed`` file, one
+``frame;frame;frame microseconds`` line per stack, which ``flamegraph.pl`` and
+speedscope read as is, and a ``.txt`` summary of the functions with the most
+time.  The oldest profiles are removed to keep the directory under
+``profile_max_bytes``.  The response carries the profile's name in
+``X-Profile-Id``.
+"""
+
+import hashlib
+import hmac
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextvars import ContextVar
+from pathlib import Path
+from types import FrameType
+from typing import Any, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from vending_machine.config import settings
+from vending_machine.logging import get_logger
+
+logger = get_logger(__name__)
+
+HEADER = "x-profile"
+
+# Functions listed in a profile's summary
+SUMMARY_SIZE = 40
+
+
+def sign(expires: int, secret: Optional[str] = None) -> str:
+    """
+    Makes the ``X-Profile`` header value that asks for profiling until ``expires``.
+
+    Args:
+        expires (int): Epoch seconds after which the header is refused.
+        secret (Optional[str]): Defaults to the JWT secret.
+
+    Returns:
+        str: The header value.
+    """
+    secret = settings.jwt_secret if secret is None else secret
+    signature = hmac.new(
+        secret.encode(), f"profile:{expires}".encode(), hashlib.sha256
+    ).hexdigest()
+    return f"{expires}.{signature}"
+
+
+def verify(
+    value: str, secret: Optional[str] = None, now: Optional[float] = None
+) -> bool:
+    """
+    Checks an ``X-Profile`` header value made by ``sign``.
+    """
+    expires, _, _ = value.partition(".")
+    if not expires.isdigit():
+        return False
+    if int(expires) < (time.time() if now is None else now):
+        return False
+    return hmac.compare_digest(value, sign(int(expires), secret))
+
+
+def _label(frame: FrameType, event: str, arg: Any) -> str:
+    if event == "c_call":
+        module = getattr(arg, "__module__", None)
+        name = getattr(arg, "__qualname__", None) or repr(arg)
+        label = f"{module}.{name}" if module else name
+    else:
+        code = frame.f_code
+        module = frame.f_globals.get("__name__", "?")
+        label = f"{module}.{code.co_qualname}:{code.co_firstlineno}"
+    # The separators of the collapsed format
+    return label.replace(";", ":").replace(" ", "_")
+
+
+class Profile:
+    """
+    The calls made while handling one request, built from profile hook events.
+    """
+
+    def __init__(self, method: str, route: str) -> None:
+        self.method = method
+        self.route = route
+        self.status: Optional[int] = None
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+        # [label, entered at, time spent in callees], innermost last
+        self._stack: list[list] = []
+        # Stack -> nanoseconds spent in its innermost frame
+        self.stacks: dict[str, int] = defaultdict(int)
+        # Label -> [calls, total, own] nanoseconds
+        self.functions: dict[str, list[int]] = defaultdict(lambda: [0, 0, 0])
+
+    def event(self, frame: FrameType, event: str, arg: Any) -> None:
+        now = time.perf_counter_ns()
+
+        if event == "call" or event == "c_call":
+            self._stack.append([_label(frame, event, arg), now, 0])
+            return
+
+        # Returns from frames entered before profiling started have nothing to pop
+        if not self._stack:
+            return
+
+        label, entered, callees = self._stack.pop()
+        elapsed = now - entered
+        own = elapsed - callees
+
+        path = ";".join(entry[0] for entry in self._stack)
+        self.stacks[f"{path};{label}" if path else label] += own
+
+        function = self.functions[label]
+        function[0] += 1
+        # A recursive function's inner calls are counted in its total again
+        function[1] += elapsed
+        function[2] += own
+
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def collapsed(self) -> str:
+        return "".join(
+            f"{stack} {ns // 1000}\n"
+            for stack, ns in sorted(self.stacks.items())
+            if ns >= 1000
+        )
+
+    def summary(self, size: int = SUMMARY_SIZE) -> str:
+        lines = [
+            f"{self.method} {self.route} -> {self.status}, "
+            f"{self.elapsed * 1000:.1f} ms wall",
+            "",
+            f"{'own ms':>10} {'total ms':>10} {'calls':>8}  function",
+        ]
+        top = sorted(self.functions.items(), key=lambda item: item[1][2], reverse=True)
+        for label, (calls, total, own) in top[:size]:
+            lines.append(f"{own / 1e6:10.3f} {total / 1e6:10.3f} {calls:8d}  {label}")
+        return "\n".join(lines) + "\n"
+
+
+_active: ContextVar[Optional[Profile]] = ContextVar("profile", default=None)
+
+
+def _hook(frame: FrameType, event: str, arg: Any) -> None:
+    profile = _active.get()
+    if profile is not None:
+        profile.event(frame, event, arg)
+
+
+class ProfileStore:
+    """
+    Profiles on disk, the oldest removed first to stay under ``max_bytes``.
+    """
+
+    def __init__(self, directory: Optional[str], max_bytes: int) -> None:
+        self.directory = Path(
+            directory or os.path.join(tempfile.gettempdir(), "vending_machine-profiles")
+        )
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def write(self, name: str, profile: Profile) -> None:
+        collapsed = profile.collapsed().encode()
+        summary = profile.summary().encode()
+
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._make_room(len(collapsed) + len(summary))
+            (self.directory / f"{name}.collapsed").write_bytes(collapsed)
+            (self.directory / f"{name}.txt").write_bytes(summary)
+
+    def _make_room(self, size: int) -> None:
+        files = []
+        for path in self.directory.iterdir():
+            if path.suffix in (".collapsed", ".txt"):
+                stat = path.stat()
+                files.append((stat.st_mtime, path, stat.st_size))
+        files.sort()
+
+        used = sum(file_size for _, _, file_size in files)
+        for _, path, file_size in files:
+            if used + size <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            used -= file_size
+
+
+class ProfilingMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        sample_rate: Optional[float] = None,
+        route_rates: Optional[dict[str, float]] = None,
+        store: Optional[ProfileStore] = None,
+        secret: Optional[str] = None,
+    ) -> None:
+        self.app = app
+        self.sample_rate = (
+            settings.profile_sample_rate if sample_rate is None else sample_rate
+        )
+        self.route_rates = (
+            settings.profile_route_rates if route_rates is None else route_rates
+        )
+        self.store = store or ProfileStore(
+            settings.profile_dir, settings.profile_max_bytes
+        )
+        self.secret = secret
+        # Profiled requests in flight on this worker, guarded by the lock
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def _route(self, scope: Scope) -> str:
+        app = scope.get("app")
+        for route in getattr(getattr(app, "router", None), "routes", ()):
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", scope["path"])
+        return scope["path"]
+
+    def _wanted(self, scope: Scope, route: Optional[str]) -> bool:
+        header = Headers(scope=scope).get(HEADER)
+        if header is not None:
+            if verify(header, self.secret):
+                return True
+            logger.warning(f"Refused an invalid {HEADER} header for {scope['path']}")
+
+        rate = (
+            self.route_rates.get(route, self.sample_rate) if route else self.sample_rate
+        )
+        return rate > 0 and random.random() < rate
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Routes are only matched when per-route rates make it matter
+        route = self._route(scope) if self.route_rates else None
+        if not self._wanted(scope, route):
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profile(scope["method"], route or self._route(scope))
+        name = (
+            time.strftime("%Y%m%dT%H%M%S")
+            + f"-{scope['method']}"
+            + profile.route.replace("/", "_").replace("{", "").replace("}", "")
+            + f"-{uuid.uuid4().hex[:8]}"
+        )
+
+        async def profiled_send(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                MutableHeaders(scope=message)["X-Profile-Id"] = name
+            await send(message)
+
+        self._start()
+        token = _active.set(profile)
+        try:
+            await self.app(scope, receive, profiled_send)
+        finally:
+            _active.reset(token)
+            self._stop()
+            profile.elapsed = time.perf_counter() - profile.started
+
+            try:
+                await run_in_threadpool(self.store.write, name, profile)
+            except OSError as e:
+                logger.warning(f"Could not write profile {name}: {e}")
+
+    def _start(self) -> None:
+        with self._lock:
+            self._running += 1
+            if self._running == 1:
+                sys.setprofile(_hook)
+                threading.setprofile(_hook)
+
+    def _stop(self) -> None:
+        with self._lock:
+            self._running -= 1
+            if self._running == 0:
+                sys.setprofile(None)
+                threading.setprofile(None)
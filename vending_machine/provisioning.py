@@ -0,0 +1,192 @@
+"""
+Bulk user provisioning.
+
+bcrypt is deliberately slow, so hashing hundreds of passwords one after the
+other on the event loop stalls every other request for seconds.  Here the
+passwords are hashed in parallel on a process pool, usernames already taken
+are found with a single ``IN`` query before any hashing is spent on them, and
+the new users are inserted in one batched transaction.
+
+The pool is started on first use, in the worker process that uses it, and
+forgotten by forked children, which start their own.  Its processes are
+started by a fork server rather than forked from the worker, so they don't
+inherit the worker's threads, locks held by them, sockets or DB connections.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from uuid import uuid4
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+
+from vending_machine.authentication import get_password_hash
+from vending_machine.config import settings
+from vending_machine.data_objects.user import User as UserOrm
+from vending_machine.database import SessionLocal
+from vending_machine.invalidation import USERS, invalidation_bus
+from vending_machine.logging import get_logger
+from vending_machine.models.bulk import (
+    BulkUserResult,
+    BulkUsersResult,
+    HashingStats,
+    HashingWorker,
+)
+from vending_machine.models.user import UserCreate
+
+logger = get_logger(__name__)
+
+# Inserts tried before giving up on users whose usernames keep being taken
+INSERT_ATTEMPTS = 2
+
+
+def _hash(password: str) -> tuple[str, int, float]:
+    start = time.perf_counter()
+    hashed = get_password_hash(password)
+    return hashed, os.getpid(), time.perf_counter() - start
+
+
+class PasswordHasher:
+    def __init__(self, workers: Optional[int] = None) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        # The parent's pool processes belong to the parent
+        self._pool = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+        return self._pool
+
+    async def hash_all(self, passwords: list[str]) -> tuple[list[str], HashingStats]:
+        """
+        Hashes the passwords across the pool.
+
+        Returns:
+            tuple[list[str], HashingStats]: The hashes, in order, and how the hashing was split across the pool.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(
+                loop.run_in_executor(self.pool, _hash, password)
+                for password in passwords
+            )
+        )
+        elapsed = time.perf_counter() - start
+
+        per_worker: dict[int, HashingWorker] = {}
+        for _, pid, seconds in results:
+            worker = per_worker.setdefault(
+                pid, HashingWorker(pid=pid, passwords=0, seconds=0.0)
+            )
+            worker.passwords += 1
+            worker.seconds += seconds
+
+        return [hashed for hashed, _, _ in results], HashingStats(
+            seconds=elapsed, workers=sorted(per_worker.values(), key=lambda w: w.pid)
+        )
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+
+password_hasher = PasswordHasher(settings.password_hash_workers)
+
+
+def _taken(db: SessionLocal, usernames: list[str]) -> set[str]:
+    if not usernames:
+        return set()
+    return set(
+        db.execute(
+            select(UserOrm.username).where(UserOrm.username.in_(usernames))
+        ).scalars()
+    )
+
+
+async def provision_users(
+    db: SessionLocal, users: list[UserCreate], hasher: PasswordHasher = password_hasher
+) -> BulkUsersResult:
+    """
+    Creates the users in one transaction, skipping those whose username is taken.
+
+    Args:
+        db (SessionLocal): The database session.
+        users (list[UserCreate]): The users to create.
+        hasher (PasswordHasher, optional): Hashes the passwords. Defaults to the shared pool.
+
+    Returns:
+        BulkUsersResult: The outcome for each user, in order, and the hashing stats.
+    """
+    results = [BulkUserResult(username=user.username, created=False) for user in users]
+
+    # The first of any repeated username in the request is the one created
+    pending: dict[str, int] = {}
+    for index, user in enumerate(users):
+        if user.username in pending:
+            results[index].error = "Duplicate username in request"
+        else:
+            pending[user.username] = index
+
+    for username in _taken(db, list(pending)):
+        results[pending.pop(username)].error = "Username already exists"
+
+    hashes, stats = await hasher.hash_all(
+        [users[index].password for index in pending.values()]
+    )
+    rows = {
+        username: {
+            "id": str(uuid4()),
+            "username": username,
+            "role": users[index].role,
+            "deposit": 0,
+            "hashed_password": hashed,
+        }
+        for (username, index), hashed in zip(pending.items(), hashes)
+    }
+
+    for _ in range(INSERT_ATTEMPTS):
+        try:
+            if rows:
+                db.execute(insert(UserOrm), list(rows.values()))
+            db.commit()
+            break
+        except IntegrityError as e:
+            # Someone took a username since it was checked; leave those out and retry
+            logger.info(e)
+            db.rollback()
+            for username in _taken(db, list(rows)):
+                del rows[username]
+                results[pending[username]].error = "Username already exists"
+    else:
+        # Still refused, and rolled back, so none of the rest were created either
+        for username in rows:
+            results[pending[username]].error = "Could not be created, try again"
+        rows = {}
+
+    for username, row in rows.items():
+        result = results[pending[username]]
+        result.id = row["id"]
+        result.created = True
+        invalidation_bus.publish(USERS, username)
+
+    return BulkUsersResult(
+        created=len(rows),
+        failed=len(users) - len(rows),
+        users=results,
+        hashing=stats,
+    )
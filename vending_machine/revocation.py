@@ -0,0 +1,206 @@
+"""
+Revocation list for stateless sessions.
+
+A stateless token is valid until it expires, so logging out, deleting a user
+or changing their role has to be recorded somewhere the token check can see
+without a DB query.  Each revocation is a small in-memory entry: a session id,
+or a user id with the time it was revoked, which rejects every token of that
+user issued before then.  An entry is dropped once every token it covers has
+expired, so the list only ever holds ``jwt_timeout`` seconds' worth.
+
+Revocations are written to the ``revocations`` table, which each worker loads
+when it starts, and broadcast to the other workers over the invalidation bus.
+The bus is best effort, so a worker also reads the revocations written since
+it last looked at most every ``revocation_sync_interval`` seconds, on the next
+token check; a missed event only lets a revoked token through until then.  An
+event for the whole topic, published when the database is reset, has every
+worker load the table again in place of what it holds.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from vending_machine.config import settings
+from vending_machine.data_objects.revocation import Revocation
+from vending_machine.database import SessionLocal
+from vending_machine.invalidation import (
+    REVOCATIONS,
+    InvalidationEvent,
+    invalidation_bus,
+)
+from vending_machine.logging import get_logger
+
+logger = get_logger(__name__)
+
+SESSION = "session"
+USER = "user"
+
+# A revocation's time is taken before it commits, so it can commit after a
+# later one was already read; each sync reads this many seconds further back
+SYNC_OVERLAP = 5.0
+
+
+class RevocationList:
+    def __init__(self, timeout: int, sync_interval: float) -> None:
+        self.timeout = timeout
+        self.sync_interval = sync_interval
+        # Monotonic time of the last sync
+        self._synced = 0.0
+        # Epoch seconds of the latest revocation read from the table
+        self._latest: Optional[float] = None
+
+        # session id -> expiry
+        self._sessions: dict[str, float] = {}
+        # user id -> (revoked at, expiry)
+        self._users: dict[str, tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+        invalidation_bus.subscribe(REVOCATIONS, self._on_event)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def is_revoked(self, session_id: str, user_id: str, issued_at: float) -> bool:
+        if session_id in self._sessions:
+            return True
+        user = self._users.get(user_id)
+        return user is not None and issued_at <= user[0]
+
+    def _add(self, kind: str, key: str, revoked_at: float) -> None:
+        # Called with the lock held
+        expires_at = revoked_at + self.timeout
+        if kind == SESSION:
+            self._sessions[key] = expires_at
+        else:
+            previous = self._users.get(key)
+            if previous is None or previous[0] < revoked_at:
+                self._users[key] = (revoked_at, expires_at)
+
+    def _remember(self, kind: str, key: str, revoked_at: float) -> None:
+        with self._lock:
+            self._add(kind, key, revoked_at)
+            self._prune(time.time())
+
+    def _prune(self, now: float) -> None:
+        for session_id in [s for s, exp in self._sessions.items() if exp < now]:
+            del self._sessions[session_id]
+        for user_id in [u for u, (_, exp) in self._users.items() if exp < now]:
+            del self._users[user_id]
+
+    def _revoke(self, db: SessionLocal, kind: str, key: str) -> None:
+        revoked_at = time.time()
+        values = {
+            "kind": kind,
+            "key": key,
+            "revoked_at": datetime.fromtimestamp(revoked_at),
+            "expires_at": datetime.fromtimestamp(revoked_at + self.timeout),
+        }
+        statement = sqlite_insert(Revocation).values(**values)
+        db.execute(
+            statement.on_conflict_do_update(
+                index_elements=[Revocation.kind, Revocation.key], set_=values
+            )
+        )
+        db.execute(delete(Revocation).where(Revocation.expires_at < datetime.now()))
+        db.commit()
+
+        self._remember(kind, key, revoked_at)
+        # The time goes with the event, so every worker cuts off at the same point
+        invalidation_bus.publish(REVOCATIONS, f"{kind}:{key}:{revoked_at!r}")
+
+    def revoke_session(self, db: SessionLocal, session_id: str) -> None:
+        """
+        Rejects the session's token from now on, e.g. on logout.  Commits.
+        """
+        self._revoke(db, SESSION, session_id)
+
+    def revoke_user(self, db: SessionLocal, user_id: str) -> None:
+        """
+        Rejects every token issued to the user until now, e.g. when they are deleted or their role changes.  Commits.
+        """
+        self._revoke(db, USER, user_id)
+
+    def _on_event(self, event: InvalidationEvent) -> None:
+        if event.key is None:
+            # The table was replaced, e.g. by reset-to-snapshot
+            self.load(replace=True)
+            return
+        # Also sees this worker's own revocations, which are already remembered
+        kind, key, revoked_at = event.key.rsplit(":", 2)
+        self._remember(kind, key, float(revoked_at))
+
+    def load(
+        self,
+        db: Optional[SessionLocal] = None,
+        replace: bool = False,
+        since: Optional[float] = None,
+    ) -> None:
+        """
+        Loads the revocations that are still in force, when the worker starts.
+
+        Args:
+            db (Optional[SessionLocal]): Defaults to a session of its own.
+            replace (bool): Drop the revocations held that the table no longer has.
+            since (Optional[float]): Only load those revoked from this epoch time on.
+        """
+        statement = select(
+            Revocation.kind, Revocation.key, Revocation.revoked_at
+        ).where(Revocation.expires_at >= datetime.now())
+        if since is not None:
+            statement = statement.where(
+                Revocation.revoked_at >= datetime.fromtimestamp(since)
+            )
+
+        own_db = db is None
+        db = db or SessionLocal()
+        try:
+            rows = db.execute(statement).all()
+        except SQLAlchemyError as e:
+            logger.warning(f"Could not load revocations: {e}")
+            return
+        finally:
+            if own_db:
+                db.close()
+
+        with self._lock:
+            if replace:
+                self._sessions.clear()
+                self._users.clear()
+            for kind, key, revoked_at in rows:
+                revoked_at = revoked_at.timestamp()
+                self._add(kind, key, revoked_at)
+                if self._latest is None or self._latest < revoked_at:
+                    self._latest = revoked_at
+            self._prune(time.time())
+
+    def sync_due(self) -> bool:
+        return time.monotonic() - self._synced >= self.sync_interval
+
+    def sync(self, db: SessionLocal) -> None:
+        """
+        Loads the revocations written since the last sync, by any worker, in case
+        their events never arrived.
+        """
+        # Set first, so the requests that come in meanwhile don't sync as well
+        self._synced = time.monotonic()
+        since = None if self._latest is None else self._latest - SYNC_OVERLAP
+        self.load(db, since=since)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sessions.clear()
+            self._users.clear()
+            self._latest = None
+
+
+revocation_list = RevocationList(
+    settings.jwt_timeout, settings.revocation_sync_interval
+)
@@ -0,0 +1,187 @@
+"""
+Per-seller, per-product sales summary.
+
+Each purchase adds its units and revenue to the ``sales_summaries`` row for
+the product in the same transaction, so reading a seller's sales costs one row
+per product they sell, rather than a scan of the raw purchases.
+
+``rebuild`` recomputes the summary from the purchases in the ledger to check
+it for drift, and optionally replaces it.
+
+Sales outlive the product sold: deleting a product leaves its summary row and
+its ledger entries in place, which is why the row keeps the seller and the
+product's name as of its latest sale, and why neither table's ``product_id``
+is a foreign key.  A recomputation attributes purchases of a deleted product
+to the seller its summary row names.
+"""
+
+from typing import NamedTuple, Optional
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from vending_machine.data_objects.ledger_entry import LedgerEntry
+from vending_machine.data_objects.ledger_kind import LedgerKind
+from vending_machine.data_objects.product import Product as ProductOrm
+from vending_machine.data_objects.sales_summary import SalesSummary
+from vending_machine.database import SessionLocal
+from vending_machine.logging import get_logger
+from vending_machine.models.sales import ProductSales, SellerSales
+
+logger = get_logger(__name__)
+
+
+class Totals(NamedTuple):
+    units_sold: int
+    revenue: int
+
+
+class Drift(NamedTuple):
+    seller_id: str
+    product_id: int
+    summary: Totals
+    recomputed: Totals
+
+
+def record_sale(
+    db: SessionLocal,
+    seller_id: str,
+    product_id: int,
+    product_name: str,
+    units: int,
+    revenue: int,
+) -> None:
+    """
+    Adds a purchase to the summary.  Doesn't commit, so it lands with the purchase.
+    """
+    statement = sqlite_insert(SalesSummary).values(
+        seller_id=seller_id,
+        product_id=product_id,
+        product_name=product_name,
+        units_sold=units,
+        revenue=revenue,
+    )
+    db.execute(
+        statement.on_conflict_do_update(
+            index_elements=[SalesSummary.seller_id, SalesSummary.product_id],
+            set_={
+                "product_name": statement.excluded.product_name,
+                "units_sold": SalesSummary.units_sold + statement.excluded.units_sold,
+                "revenue": SalesSummary.revenue + statement.excluded.revenue,
+            },
+        )
+    )
+
+
+def seller_sales(db: SessionLocal, seller_id: str) -> SellerSales:
+    rows = db.execute(
+        select(
+            SalesSummary.product_id,
+            SalesSummary.product_name,
+            SalesSummary.units_sold,
+            SalesSummary.revenue,
+        )
+        .where(SalesSummary.seller_id == seller_id)
+        .order_by(SalesSummary.product_id)
+    ).all()
+
+    products = [
+        ProductSales(
+            productId=str(product_id),
+            productName=product_name,
+            unitsSold=units_sold,
+            revenue=revenue,
+        )
+        for product_id, product_name, units_sold, revenue in rows
+    ]
+    return SellerSales(
+        sellerId=seller_id,
+        unitsSold=sum(product.unitsSold for product in products),
+        revenue=sum(product.revenue for product in products),
+        products=products,
+    )
+
+
+def _recompute(
+    db: SessionLocal, summary_rows: list[SalesSummary]
+) -> tuple[dict[tuple[str, int], Totals], dict[int, Optional[str]]]:
+    # Purchases are debits, so the revenue is their negated amount
+    rows = db.execute(
+        select(
+            LedgerEntry.product_id,
+            ProductOrm.seller_id,
+            ProductOrm.product_name,
+            func.sum(LedgerEntry.quantity),
+            func.sum(-LedgerEntry.amount),
+        )
+        .outerjoin(ProductOrm, ProductOrm.id == LedgerEntry.product_id)
+        .where(LedgerEntry.kind == LedgerKind.PURCHASE)
+        .group_by(LedgerEntry.product_id)
+    ).all()
+
+    # Who sold the deleted products, and what they were called
+    sold = {row.product_id: (row.seller_id, row.product_name) for row in summary_rows}
+
+    totals, names = {}, {}
+    for product_id, seller_id, product_name, units, revenue in rows:
+        if seller_id is None:
+            if product_id not in sold:
+                logger.warning(
+                    f"Purchases of deleted product {product_id} have no seller on record"
+                )
+                continue
+            seller_id, product_name = sold[product_id]
+        totals[(str(seller_id), product_id)] = Totals(units, revenue)
+        names[product_id] = product_name
+    return totals, names
+
+
+def rebuild(db: SessionLocal, apply: bool = False) -> list[Drift]:
+    """
+    Recomputes the summary from scratch and compares it with the stored one.
+
+    Args:
+        db (SessionLocal): The database session.
+        apply (bool, optional): Replace the stored summary with the recomputed one, and commit. Defaults to False.
+
+    Returns:
+        list[Drift]: The rows where the stored summary and the recomputed one differ.
+    """
+    summary_rows = db.execute(select(SalesSummary)).scalars().all()
+    recomputed, names = _recompute(db, summary_rows)
+    summary = {
+        (row.seller_id, row.product_id): Totals(row.units_sold, row.revenue)
+        for row in summary_rows
+    }
+
+    drift = [
+        Drift(
+            seller_id,
+            product_id,
+            summary.get((seller_id, product_id), Totals(0, 0)),
+            recomputed.get((seller_id, product_id), Totals(0, 0)),
+        )
+        for seller_id, product_id in sorted(summary.keys() | recomputed.keys())
+        if summary.get((seller_id, product_id))
+        != recomputed.get((seller_id, product_id))
+    ]
+
+    if apply:
+        db.execute(delete(SalesSummary))
+        if recomputed:
+            db.execute(
+                insert(SalesSummary),
+                [
+                    {
+                        "seller_id": seller_id,
+                        "product_id": product_id,
+                        "product_name": names[product_id],
+                        "units_sold": totals.units_sold,
+                        "revenue": totals.revenue,
+                    }
+                    for (seller_id, product_id), totals in recomputed.items()
+                ],
+            )
+        db.commit()
+
+    return drift
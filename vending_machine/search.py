@@ -0,0 +1,108 @@
+"""
+Product search.
+
+Names are matched through ``products_fts``, an FTS5 index kept in step with
+products by triggers (see vending_machine.data_objects.product), and ranked by
+bm25.  Every word of the query has to match, the last one as a prefix, so
+results narrow as a buyer types.  The cost and seller filters are served by
+the products indexes, and the in-stock filter by the stock shards' primary key.
+
+Full text search needs SQLite; the filters work on any database.
+"""
+
+import re
+from typing import Optional
+
+from sqlalchemy import exists, func, literal_column, select, table
+from sqlalchemy.sql import column
+
+from vending_machine import stock
+from vending_machine.data_objects.product import Product as ProductOrm
+from vending_machine.data_objects.stock_shard import StockShard
+from vending_machine.database import SessionLocal
+from vending_machine.models.conversion import products_from_orm
+from vending_machine.models.search import ProductSearchResult
+
+products_fts = table("products_fts", column("rowid"))
+_fts = literal_column("products_fts")
+
+
+def match_expression(query: str) -> Optional[str]:
+    """
+    Turns free text into an FTS5 query, so nothing a buyer types is read as syntax.
+
+    Returns:
+        Optional[str]: The FTS5 query, or None if the text has no words in it.
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+
+    *whole, last = words
+    return " ".join([f'"{word}"' for word in whole] + [f'"{last}"*'])
+
+
+def search_products(
+    db: SessionLocal,
+    query: Optional[str] = None,
+    min_cost: Optional[int] = None,
+    max_cost: Optional[int] = None,
+    seller_id: Optional[str] = None,
+    in_stock: bool = False,
+    limit: int = 20,
+    offset: int = 0,
+) -> ProductSearchResult:
+    """
+    Searches products by name and filters them.
+
+    Args:
+        db (SessionLocal): The database session.
+        query (Optional[str], optional): Text to match product names against. Defaults to None, which matches every product.
+        min_cost (Optional[int], optional): The lowest cost to include. Defaults to None.
+        max_cost (Optional[int], optional): The highest cost to include. Defaults to None.
+        seller_id (Optional[str], optional): Only include this seller's products. Defaults to None.
+        in_stock (bool, optional): Only include products with stock left. Defaults to False.
+        limit (int, optional): The page size. Defaults to 20.
+        offset (int, optional): The number of results to skip. Defaults to 0.
+
+    Returns:
+        ProductSearchResult: A page of products, best matches first, and the total number of matches.
+    """
+    statement = select(ProductOrm)
+    order_by = [ProductOrm.product_name, ProductOrm.id]
+
+    expression = match_expression(query) if query else None
+    if expression:
+        statement = statement.join(
+            products_fts, products_fts.c.rowid == ProductOrm.id
+        ).where(_fts.op("MATCH")(expression))
+        order_by = [func.bm25(_fts), ProductOrm.id]
+    elif query:
+        return ProductSearchResult(products=[], total=0, limit=limit, offset=offset)
+
+    if min_cost is not None:
+        statement = statement.where(ProductOrm.cost >= min_cost)
+    if max_cost is not None:
+        statement = statement.where(ProductOrm.cost <= max_cost)
+    if seller_id is not None:
+        statement = statement.where(ProductOrm.seller_id == seller_id)
+    if in_stock:
+        statement = statement.where(
+            exists().where(
+                StockShard.product_id == ProductOrm.id, StockShard.amount > 0
+            )
+        )
+
+    total = db.execute(
+        select(func.count()).select_from(statement.subquery())
+    ).scalar_one()
+    rows = db.execute(statement.order_by(*order_by).limit(limit).offset(offset))
+    products = products_from_orm(rows.scalars().all())
+
+    totals = stock.stock_totals(db, [int(product.id) for product in products])
+    for product in products:
+        product.amountAvailable = totals.get(int(product.id), 0)
+
+    return ProductSearchResult(
+        products=products, total=total, limit=limit, offset=offset
+    )
@@ -0,0 +1,229 @@
+"""
+Server entrypoint.
+
+With ``workers`` above one, the app is built once in a supervisor process,
+which binds the listening socket and forks the workers.  Forking after the
+import keeps the app, its routes and schemas in pages shared between workers;
+state that must not be shared (the DB connection pool, locks, in-flight
+requests) is reset in each worker by ``os.register_at_fork`` hooks next to
+that state.
+
+SIGTERM or SIGINT on the supervisor is forwarded to the workers, which stop
+accepting connections and drain in-flight requests for up to
+``graceful_shutdown_timeout`` seconds before being killed.
+
+A worker that dies is restarted.  One that dies within
+``worker_min_uptime`` seconds of starting, e.g. because of a bad config, is
+restarted after a delay that doubles with each such failure in a row, and
+after ``worker_max_fast_failures`` of them the supervisor gives up and stops.
+
+Run with ``python -m vending_machine.server``.
+"""
+
+import gc
+import os
+import signal
+import socket
+import time
+from typing import Optional
+
+import uvicorn
+from fastapi import FastAPI
+
+from vending_machine.config import settings
+from vending_machine.logging import get_logger
+from vending_machine.warmup import warm_up_process
+
+logger = get_logger(__name__)
+
+
+def get_config(app: FastAPI) -> uvicorn.Config:
+    return uvicorn.Config(
+        app,
+        host=settings.host or "0.0.0.0",
+        port=settings.port or 8000,
+        loop=settings.server_loop,
+        http=settings.server_http,
+        backlog=settings.server_backlog,
+        timeout_keep_alive=settings.server_keep_alive_timeout,
+        limit_concurrency=settings.server_limit_concurrency,
+        timeout_graceful_shutdown=settings.graceful_shutdown_timeout,
+        log_level="debug" if settings.debug else "info",
+    )
+
+
+def _run_worker(config: uvicorn.Config, sock: socket.socket) -> None:
+    # The supervisor's handlers must not run in the worker; uvicorn installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    status = 1
+    try:
+        uvicorn.Server(config).run(sockets=[sock])
+        status = 0
+    finally:
+        os._exit(status)
+
+
+class Supervisor:
+    """
+    Forks and watches the worker processes, restarting any that die until shutdown.
+    """
+
+    def __init__(
+        self,
+        config: uvicorn.Config,
+        workers: int,
+        min_uptime: float = settings.worker_min_uptime,
+        max_fast_failures: int = settings.worker_max_fast_failures,
+        max_restart_delay: float = 30.0,
+    ) -> None:
+        self.config = config
+        self.workers = workers
+        self.min_uptime = min_uptime
+        self.max_fast_failures = max_fast_failures
+        self.max_restart_delay = max_restart_delay
+        # Pid -> when it was started
+        self.children: dict[int, float] = {}
+        self.stopping = False
+        self.failed = False
+        # Workers in a row that died within min_uptime of starting
+        self.fast_failures = 0
+
+    def _spawn(self, sock: socket.socket) -> None:
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(self.config, sock)
+        self.children[pid] = time.monotonic()
+        logger.info(f"Started worker {pid}")
+
+    def restart_delay(self) -> float:
+        """
+        Returns the seconds to wait before replacing a worker, doubling with each fast failure.
+        """
+        if self.fast_failures == 0:
+            return 0.0
+        return min(0.5 * 2 ** (self.fast_failures - 1), self.max_restart_delay)
+
+    def _sleep(self, seconds: float) -> None:
+        # In slices, so a shutdown signal isn't kept waiting
+        deadline = time.monotonic() + seconds
+        while not self.stopping and time.monotonic() < deadline:
+            time.sleep(min(0.1, deadline - time.monotonic()))
+
+    def _stop(self, signum, frame) -> None:
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info(f"Received {signal.Signals(signum).name}, draining workers")
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _wait(self, block: bool) -> Optional[int]:
+        try:
+            pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+        except ChildProcessError:
+            self.children.clear()
+            return None
+        if pid == 0:
+            return None
+
+        started = self.children.pop(pid, None)
+        if not self.stopping:
+            logger.error(f"Worker {pid} exited with status {status}")
+            if started is not None and time.monotonic() - started < self.min_uptime:
+                self.fast_failures += 1
+            else:
+                self.fast_failures = 0
+        return pid
+
+    def run(self) -> None:
+        sock = self.config.bind_socket()
+        # Imports the loop and protocol implementations before forking, too
+        self.config.load()
+
+        # Move everything built so far out of the collector's reach, so that
+        # collections in the workers don't touch (and so copy) shared pages
+        gc.collect()
+        gc.freeze()
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for _ in range(self.workers):
+            self._spawn(sock)
+
+        while not self.stopping:
+            self._wait(block=True)
+            if self.fast_failures >= self.max_fast_failures:
+                logger.error(
+                    f"{self.fast_failures} workers in a row died on startup, giving up"
+                )
+                self.failed = True
+                self._stop(signal.SIGTERM, None)
+                break
+            self._sleep(self.restart_delay())
+            while not self.stopping and len(self.children) < self.workers:
+                self._spawn(sock)
+
+        deadline = time.monotonic() + self.config.timeout_graceful_shutdown + 5
+        while self.children and time.monotonic() < deadline:
+            if self._wait(block=False) is None:
+                time.sleep(0.1)
+
+        for pid in list(self.children):
+            logger.error(f"Worker {pid} did not drain in time, killing it")
+            os.kill(pid, signal.SIGKILL)
+        while self.children:
+            self._wait(block=True)
+
+        sock.close()
+        logger.info("All workers stopped")
+
+
+def run(app: Optional[FastAPI] = None) -> None:
+    """
+    Runs the server as configured in ``config.Settings``.
+
+    Args:
+        app (FastAPI, optional): A preloaded app. Defaults to building one with ``main.main()``.
+    """
+    if settings.debug:
+        # Reloading needs to re-import the app, so it can't be preloaded
+        uvicorn.run(
+            "vending_machine.main:main",
+            factory=True,
+            host=settings.host or "0.0.0.0",
+            port=settings.port or 8000,
+            log_level="debug",
+            reload=True,
+        )
+        return
+
+    if app is None:
+        from vending_machine.main import main
+
+        app = main()
+
+    if settings.warmup:
+        # Done once here, the workers inherit the results
+        warm_up_process(app)
+
+    config = get_config(app)
+
+    if settings.workers <= 1:
+        uvicorn.Server(config).run()
+        return
+
+    logger.info(f"Starting {settings.workers} workers")
+    supervisor = Supervisor(config, settings.workers)
+    supervisor.run()
+    if supervisor.failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,270 @@
+"""
+Priority-aware load shedding.
+
+Each request is put in a priority class by the first pattern in
+``load_shedding_routes`` that its ``METHOD /path`` matches (``fnmatch``
+style, a pattern without a method matching any), or ``normal`` otherwise.
+Every class has its own budget: the requests it runs at once, the requests
+that may queue for a turn beyond those, and how long one may wait queued.
+
+A request that finds its class at capacity queues, and is answered with a 503
+and a ``Retry-After`` as soon as it is clear it won't be let in: when the
+queue is full, when the average time its class takes to serve a request says
+the wait would run past the deadline, or when the deadline passes.  Classes
+don't borrow from each other, so a flood of catalogue listings can't take the
+turns of purchases and deposits.
+
+Identical reads are coalesced by ``vending_machine.single_flight``.  A class
+may let up to ``coalesce`` requests per run of such a read in without a turn
+while it is in flight, since they will most likely only wait for its result,
+and a request that took a turn and then joins another's run gives the turn
+back while it waits.  A burst of the same listing then costs a turn or two
+rather than a queue's worth of them, while a flood beyond that is still
+queued and shed as usual.
+
+Everything happens on the worker's event loop, so no locks are needed.
+``load_shedder.stats()`` reports each class's queue depth and shed counts.
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+from fnmatch import fnmatchcase
+from typing import Any, Optional
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from vending_machine.config import settings
+from vending_machine.logging import get_logger
+from vending_machine.single_flight import SingleFlight, on_join, single_flight
+
+logger = get_logger(__name__)
+
+DEFAULT_CLASS = "normal"
+
+# Weight of the latest request in a class's average service time
+SERVICE_TIME_WEIGHT = 0.1
+
+
+class Shed(Exception):
+    def __init__(self, reason: str, retry_after: float) -> None:
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class PriorityClass:
+    def __init__(
+        self,
+        name: str,
+        concurrency: int,
+        queue_size: int,
+        max_wait: float,
+        coalesce: int = 0,
+    ) -> None:
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.coalesce = coalesce
+        self.running = 0
+        self.admitted = 0
+        # Requests let in without a turn, to share work already in flight
+        self.coalesced = 0
+        # Reason -> requests shed for it
+        self.shed: dict[str, int] = {"queue_full": 0, "deadline": 0, "timeout": 0}
+        # Seconds, an exponentially weighted average
+        self.service_time: Optional[float] = None
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _expected_wait(self, position: int) -> float:
+        # The turns ahead, served `concurrency` at a time
+        if self.service_time is None:
+            return 0.0
+        return math.ceil(position / self.concurrency) * self.service_time
+
+    def _refuse(self, reason: str) -> Shed:
+        self.shed[reason] += 1
+        retry_after = max(self._expected_wait(self.queued + 1), 1.0)
+        return Shed(reason, retry_after)
+
+    async def acquire(self) -> None:
+        """
+        Waits for a turn to run a request.
+
+        Raises:
+            Shed: If the request won't get a turn in time.
+        """
+        if self.running < self.concurrency and not self._waiters:
+            self.running += 1
+            self.admitted += 1
+            return
+
+        if self.queued >= self.queue_size:
+            raise self._refuse("queue_full")
+        if self._expected_wait(self.queued + 1) > self.max_wait:
+            raise self._refuse("deadline")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The turn was handed over just as the wait ended; pass it on
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise self._refuse("timeout")
+
+        # release() already counted this request as running
+        self.admitted += 1
+
+    def release(self, service_time: Optional[float] = None) -> None:
+        if service_time is not None:
+            self.service_time = (
+                service_time
+                if self.service_time is None
+                else self.service_time
+                + SERVICE_TIME_WEIGHT * (service_time - self.service_time)
+            )
+
+        # The turn goes straight to the longest waiter, if there is one
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "queueSize": self.queue_size,
+            "maxWait": self.max_wait,
+            "coalesce": self.coalesce,
+            "running": self.running,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "coalesced": self.coalesced,
+            "shed": dict(self.shed),
+            "serviceTimeMs": (
+                None
+                if self.service_time is None
+                else round(self.service_time * 1000, 3)
+            ),
+        }
+
+
+class _Turn:
+    __slots__ = ("priority", "started", "held")
+
+    def __init__(self, priority: PriorityClass) -> None:
+        self.priority = priority
+        self.started = time.perf_counter()
+        self.held = True
+
+    def release(self) -> None:
+        if self.held:
+            self.held = False
+            self.priority.release(time.perf_counter() - self.started)
+
+
+class LoadShedder:
+    def __init__(
+        self, classes: dict[str, dict[str, float]], routes: dict[str, str]
+    ) -> None:
+        self.classes = {
+            name: PriorityClass(
+                name,
+                int(budget["concurrency"]),
+                int(budget["queue"]),
+                float(budget["wait"]),
+                int(budget.get("coalesce", 0)),
+            )
+            for name, budget in classes.items()
+        }
+        if DEFAULT_CLASS not in self.classes:
+            raise ValueError(f"A {DEFAULT_CLASS!r} class is required")
+
+        # Patterns without a method match any
+        self.routes = [
+            (pattern if " " in pattern else f"* {pattern}", name)
+            for pattern, name in routes.items()
+        ]
+        unknown = {name for _, name in self.routes} - set(self.classes)
+        if unknown:
+            raise ValueError(f"Unknown priority classes {sorted(unknown)}")
+
+    def classify(self, method: str, path: str) -> PriorityClass:
+        request = f"{method} {path}"
+        for pattern, name in self.routes:
+            if fnmatchcase(request, pattern):
+                return self.classes[name]
+        return self.classes[DEFAULT_CLASS]
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        return {name: priority.stats() for name, priority in self.classes.items()}
+
+
+load_shedder = LoadShedder(
+    settings.load_shedding_classes, settings.load_shedding_routes
+)
+
+
+class LoadSheddingMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        enabled: Optional[bool] = None,
+        shedder: Optional[LoadShedder] = None,
+        flights: Optional[SingleFlight] = None,
+    ) -> None:
+        self.app = app
+        self.enabled = settings.load_shedding if enabled is None else enabled
+        self.shedder = shedder or load_shedder
+        self.flights = flights or single_flight
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not self.enabled or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request = f"{scope['method']} {scope['path']}"
+        priority = self.shedder.classify(scope["method"], scope["path"])
+        if priority.coalesce and self.flights.board(request, priority.coalesce):
+            priority.coalesced += 1
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await priority.acquire()
+        except Shed as e:
+            logger.warning(
+                f"Shed {scope['method']} {scope['path']} from {priority.name}: {e.reason}"
+            )
+            response = JSONResponse(
+                {"detail": "Server busy, retry later"},
+                status_code=503,
+                headers={"Retry-After": str(math.ceil(e.retry_after))},
+            )
+            await response(scope, receive, send)
+            return
+
+        turn = _Turn(priority)
+        # Given back early should the request only wait for another's run
+        token = on_join.set((request, turn.release))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            on_join.reset(token)
+            turn.release()
@@ -0,0 +1,149 @@
+"""
+Single-flight coalescing of identical reads.
+
+When a product changes, every kiosk asks for the catalogue again at about the
+same moment.  ``single_flight.run`` lets identical requests that arrive while
+one of them is being served wait for that one's result instead of each running
+the same queries and serializing the same models: the first caller for a key
+starts the work, and every caller for the key until it finishes gets the same
+result, typically the response body already serialized to bytes.
+
+Keys are built by the caller from the route, its parameters and a version of
+the data read, the row's own or else the invalidation bus version of its
+topic, so a request that comes in after a write never joins work that started
+before it.  Only the building of a body is shared; a conditional request is
+answered from the version before any of it is needed.
+
+A key starts with the ``METHOD /path`` that its work answers, so admission
+control can ask whether a request would only wait for work already in flight
+(``board``), and be told when a request it let in joins such work instead of
+starting its own (``on_join``); see ``vending_machine.shedding``.
+
+The work runs in the thread pool, on a session of its own, so the event loop
+is free to take the requests that join it, and no caller's session is used
+after that caller is gone.  A caller that is cancelled, e.g. because its
+client disconnected, stops waiting without disturbing the others; the work is
+only abandoned once nobody is waiting for it.
+
+A caller whose session is bound to a connection rather than the engine, the
+sub-requests of an atomic ``/batch``, runs the work on its own session and
+shares it with nobody: it has to see the writes its transaction hasn't
+committed yet, and no one else may.
+"""
+
+import asyncio
+from contextvars import ContextVar
+from typing import Callable, Optional, TypeVar
+
+from sqlalchemy import Engine
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+T = TypeVar("T")
+
+# The METHOD /path of the request being served, and what to call should it
+# join another's run for that path rather than start one
+on_join: ContextVar[Optional[tuple[str, Callable[[], None]]]] = ContextVar(
+    "single_flight_on_join", default=None
+)
+
+
+class _Flight:
+    __slots__ = ("request", "task", "waiting", "boarded")
+
+    def __init__(self, request: str, task: asyncio.Task) -> None:
+        self.request = request
+        self.task = task
+        self.waiting = 0
+        # Requests let in to wait for this run, see SingleFlight.board
+        self.boarded = 0
+
+
+def _in_session(work: Callable[[Session], T], bind: Engine) -> T:
+    session = Session(bind=bind, autoflush=False)
+    try:
+        return work(session)
+    finally:
+        session.close()
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self._flights: dict[tuple, _Flight] = {}
+        # METHOD /path -> the latest run in flight for it
+        self._requests: dict[str, _Flight] = {}
+        # Calls that ran the work, and calls that were given another's result
+        self.started = 0
+        self.joined = 0
+        # Calls that ran the work in their own transaction, shared with nobody
+        self.bypassed = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def board(self, request: str, limit: int) -> bool:
+        """
+        Counts one more request for ``request`` (``METHOD /path``) as waiting
+        for the run in flight for it, up to ``limit`` per run.
+
+        Returns:
+            bool: False if there is no such run, or ``limit`` were already counted.
+        """
+        flight = self._requests.get(request)
+        if flight is None or flight.boarded >= limit:
+            return False
+        flight.boarded += 1
+        return True
+
+    async def run(self, key: tuple, work: Callable[[Session], T], db: Session) -> T:
+        """
+        Runs ``work`` for ``key``, or waits for the run already in flight for it.
+
+        Args:
+            key (tuple): What identifies the result: the request, then its
+                parameters and the version of the data read.
+            work (Callable[[Session], T]): Reads and returns the result, given a session.
+            db (Session): The caller's session, whose engine the work's session is opened on.
+
+        Returns:
+            T: The result, the same object for every caller that shared the run.
+        """
+        bind = db.get_bind()
+        if not isinstance(bind, Engine):
+            # Inside another transaction, whose uncommitted writes are its own
+            self.bypassed += 1
+            return work(db)
+
+        flight = self._flights.get(key)
+        if flight is None:
+            task = asyncio.ensure_future(run_in_threadpool(_in_session, work, bind))
+            flight = self._flights[key] = _Flight(key[0], task)
+            self._requests[flight.request] = flight
+            task.add_done_callback(lambda _: self._land(key, flight))
+            self.started += 1
+        else:
+            self.joined += 1
+            hook = on_join.get()
+            # Sub-requests of a batch see the batch's hook, which isn't theirs
+            if hook is not None and hook[0] == flight.request:
+                hook[1]()
+
+        flight.waiting += 1
+        try:
+            # Shielded, so one caller's cancellation isn't passed on to the others
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiting -= 1
+            if flight.waiting == 0 and not flight.task.done():
+                flight.task.cancel()
+                self._land(key, flight)
+
+    def _land(self, key: tuple, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if self._requests.get(flight.request) is flight:
+            del self._requests[flight.request]
+
+
+single_flight = SingleFlight()
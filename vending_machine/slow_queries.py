@@ -0,0 +1,250 @@
+"""
+Slow-query log.
+
+Every statement run by any engine is timed from engine events in
+``vending_machine.database`` and recorded against its normalized SQL: the
+literals replaced by ``?`` and ``IN`` lists collapsed, so the same query with
+other values is one entry.  A statement slower than ``slow_query_ms`` is
+logged with its normalized SQL, the shape of its parameters, its duration and
+the route that ran it, and counted in its entry's stats.
+
+The first time a normalized statement is seen on SQLite its
+``EXPLAIN QUERY PLAN`` is captured and kept with it, so a slow statement that
+scans a table can be told apart from one that is merely busy.  The stats are
+served on the debug-only ``GET /debug/slow-queries``.
+"""
+
+import re
+import threading
+from contextvars import ContextVar
+from typing import Any, Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from vending_machine.cache import BoundedCache
+from vending_machine.config import settings
+from vending_machine.logging import get_logger
+
+logger = get_logger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\?(?:, \?)+\)")
+
+# Statements the plan is captured for; EXPLAIN of the others says nothing useful
+_EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+
+# The request whose route a statement is recorded against
+_scope: ContextVar[Optional[Scope]] = ContextVar("query_scope", default=None)
+
+
+def normalize(statement: str) -> str:
+    """
+    Reduces a statement to its shape, so the same query run with other values matches.
+    """
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    statement = _STRING.sub("?", statement)
+    statement = _NUMBER.sub("?", statement)
+    return _IN_LIST.sub("(?, ...)", statement)
+
+
+def parameter_shape(parameters: Any, executemany: bool = False) -> str:
+    """
+    Describes bound parameters by their types, leaving their values out of the log.
+    """
+    if executemany:
+        if not parameters:
+            return "[]"
+        return f"{len(parameters)} x {parameter_shape(parameters[0])}"
+    if isinstance(parameters, dict):
+        return (
+            "{"
+            + ", ".join(f"{k}: {type(v).__name__}" for k, v in parameters.items())
+            + "}"
+        )
+    return "(" + ", ".join(type(v).__name__ for v in parameters or ()) + ")"
+
+
+def current_route() -> Optional[str]:
+    """
+    Returns the method and route path of the request being served, if any.
+    """
+    scope = _scope.get()
+    if scope is None:
+        return None
+    # Filled in on the same scope once the router has matched the request
+    route = scope.get("route")
+    return f"{scope['method']} {getattr(route, 'path', scope['path'])}"
+
+
+class QueryStats:
+    __slots__ = (
+        "statement",
+        "calls",
+        "total",
+        "max",
+        "slow",
+        "slow_total",
+        "routes",
+        "parameters",
+        "plan",
+    )
+
+    def __init__(self, statement: str) -> None:
+        self.statement = statement
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.slow_total = 0.0
+        # Route -> slow runs from it
+        self.routes: dict[str, int] = {}
+        # Of the last slow run
+        self.parameters: Optional[str] = None
+        self.plan: Optional[list[str]] = None
+
+    @property
+    def scans(self) -> bool:
+        # A table read in full, rather than searched through an index
+        return any(
+            line.lstrip().startswith("SCAN") and "USING" not in line
+            for line in self.plan or ()
+        )
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "statement": self.statement,
+            "calls": self.calls,
+            "totalMs": round(self.total * 1000, 3),
+            "maxMs": round(self.max * 1000, 3),
+            "slow": self.slow,
+            "slowTotalMs": round(self.slow_total * 1000, 3),
+            "routes": dict(self.routes),
+            "parameters": self.parameters,
+            "plan": self.plan,
+            "scans": self.scans,
+        }
+
+
+class QueryLog:
+    def __init__(self, threshold_ms: float, max_statements: int) -> None:
+        self.threshold = threshold_ms / 1000
+        # Normalized statement -> its stats, the least recently run dropped first
+        self._stats: BoundedCache = BoundedCache(max_statements)
+        # Raw statement -> normalized, since the same few strings run over and over
+        self._normalized: BoundedCache = BoundedCache(max_statements)
+        self._lock = threading.Lock()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stats.clear()
+            self._normalized.clear()
+
+    def stats(self, slow_only: bool = True) -> list[QueryStats]:
+        """
+        Returns the statements' stats, those that took the most time in all first.
+        """
+        with self._lock:
+            entries = list(self._stats.values())
+        if slow_only:
+            entries = [entry for entry in entries if entry.slow]
+        return sorted(entries, key=lambda entry: entry.total, reverse=True)
+
+    def record(
+        self,
+        driver_connection: Any,
+        dialect: str,
+        statement: str,
+        parameters: Any,
+        executemany: bool,
+        elapsed: float,
+    ) -> None:
+        """
+        Records a statement that ran for ``elapsed`` seconds.  Called from engine events.
+        """
+        normalized = self._normalized.get(statement)
+        if normalized is None:
+            normalized = normalize(statement)
+            with self._lock:
+                self._normalized.touch(statement, normalized)
+
+        with self._lock:
+            entry = self._stats.get(normalized)
+            first = entry is None
+            if first:
+                entry = QueryStats(normalized)
+            self._stats.touch(normalized, entry)
+            entry.calls += 1
+            entry.total += elapsed
+            entry.max = max(entry.max, elapsed)
+
+        if first and dialect == "sqlite":
+            entry.plan = self._explain(
+                driver_connection, statement, parameters, executemany
+            )
+
+        if elapsed < self.threshold:
+            return
+
+        route = current_route() or "-"
+        shape = parameter_shape(parameters, executemany)
+        with self._lock:
+            entry.slow += 1
+            entry.slow_total += elapsed
+            entry.routes[route] = entry.routes.get(route, 0) + 1
+            entry.parameters = shape
+        logger.warning(
+            f"Slow query, {elapsed * 1000:.1f}ms on {route}: {normalized} {shape}"
+            + (" (scans a table)" if entry.scans else "")
+        )
+
+    def _explain(
+        self,
+        driver_connection: Any,
+        statement: str,
+        parameters: Any,
+        executemany: bool,
+    ) -> Optional[list[str]]:
+        if not statement.lstrip().upper().startswith(_EXPLAINABLE):
+            return None
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+        try:
+            rows = driver_connection.execute(
+                f"EXPLAIN QUERY PLAN {statement}", parameters or ()
+            ).fetchall()
+        except Exception as e:
+            logger.debug(f"Could not explain {statement}: {e}")
+            return None
+
+        # (id, parent, unused, detail), indented under the step they belong to
+        depths = {0: -1}
+        plan = []
+        for step, parent, _, detail in rows:
+            depths[step] = depths.get(parent, -1) + 1
+            plan.append("  " * depths[step] + detail)
+        return plan
+
+
+query_log = QueryLog(settings.slow_query_ms, settings.slow_query_max_statements)
+
+
+class QueryRouteMiddleware:
+    """
+    Makes the request being served known to the statements it runs.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        token = _scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _scope.reset(token)
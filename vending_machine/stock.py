@@ -0,0 +1,121 @@
+"""
+Sharded stock counters.
+
+A product's stock is split across ``stock_shards`` rows of
+``product_stock_shards``, so concurrent buyers of the same product decrement
+different rows instead of queueing on one.  A buyer picks a shard at random and
+decrements it with a conditional UPDATE; if that shard can't cover the
+purchase, the product's shards are locked, the purchase is taken from their
+total and the remainder is spread evenly across them again.
+
+The shards are the source of truth for how much of a product is left; the
+products.amount_available column only holds what the seller last set.
+"""
+
+import random
+from typing import Iterable, Optional
+
+from sqlalchemy import delete, func, insert, select, update
+
+from vending_machine.config import settings
+from vending_machine.data_objects.stock_shard import StockShard
+from vending_machine.database import SessionLocal
+
+
+def _split(total: int, shards: int) -> list[int]:
+    share, remainder = divmod(total, shards)
+    return [share + (1 if shard < remainder else 0) for shard in range(shards)]
+
+
+def set_stock(db: SessionLocal, product_id: int, total: int) -> None:
+    """
+    Replaces the product's stock with ``total``, spread across the shards.  Doesn't commit.
+    """
+    set_stocks(db, {product_id: total})
+
+
+def set_stocks(db: SessionLocal, totals: dict[int, int]) -> None:
+    """
+    Replaces the stock of each product in ``totals``, in one batch.  Doesn't commit.
+    """
+    if not totals:
+        return
+
+    db.execute(delete(StockShard).where(StockShard.product_id.in_(list(totals))))
+    db.execute(
+        insert(StockShard),
+        [
+            {"product_id": product_id, "shard": shard, "amount": amount}
+            for product_id, total in totals.items()
+            for shard, amount in enumerate(_split(total, settings.stock_shards))
+        ],
+    )
+
+
+def delete_stock(db: SessionLocal, product_id: int) -> None:
+    db.execute(delete(StockShard).where(StockShard.product_id == product_id))
+
+
+def total_stock(db: SessionLocal, product_id: int) -> int:
+    return db.execute(
+        select(func.coalesce(func.sum(StockShard.amount), 0)).where(
+            StockShard.product_id == product_id
+        )
+    ).scalar_one()
+
+
+def stock_totals(
+    db: SessionLocal, product_ids: Optional[Iterable[int]] = None
+) -> dict[int, int]:
+    """
+    Returns the stock left per product, for the given products or all of them.
+    """
+    statement = select(StockShard.product_id, func.sum(StockShard.amount)).group_by(
+        StockShard.product_id
+    )
+    if product_ids is not None:
+        statement = statement.where(StockShard.product_id.in_(list(product_ids)))
+    return dict(db.execute(statement).all())
+
+
+def reserve(db: SessionLocal, product_id: int, quantity: int) -> bool:
+    """
+    Takes ``quantity`` units of the product's stock.  Doesn't commit.
+
+    Returns:
+        bool: Whether there was enough stock left.
+    """
+    shard = random.randrange(settings.stock_shards)
+    taken = db.execute(
+        update(StockShard)
+        .where(
+            StockShard.product_id == product_id,
+            StockShard.shard == shard,
+            StockShard.amount >= quantity,
+        )
+        .values(amount=StockShard.amount - quantity)
+    ).rowcount
+    if taken:
+        return True
+
+    return _rebalance_and_reserve(db, product_id, quantity)
+
+
+def _rebalance_and_reserve(db: SessionLocal, product_id: int, quantity: int) -> bool:
+    shards = db.execute(
+        select(StockShard.shard, StockShard.amount)
+        .where(StockShard.product_id == product_id)
+        .with_for_update()
+    ).all()
+
+    total = sum(amount for _, amount in shards)
+    if total < quantity:
+        return False
+
+    for (shard, _), amount in zip(shards, _split(total - quantity, len(shards))):
+        db.execute(
+            update(StockShard)
+            .where(StockShard.product_id == product_id, StockShard.shard == shard)
+            .values(amount=amount)
+        )
+    return True
@@ -0,0 +1,296 @@
+"""
+Per-request tracing.
+
+With ``tracing`` on, ``TracingMiddleware`` opens a root span for each request
+and the work done on its behalf is timed in spans nested under it: the
+current user lookup, JWT and bcrypt calls, every SQL statement (from engine
+events in ``vending_machine.database``), the conversion of rows to models and
+the rendering of the response.  The current span is kept in a context
+variable, so spans opened in the thread pool nest under the request's too.
+
+A ``traceparent`` header (W3C Trace Context) on the request puts its spans in
+the caller's trace, under the caller's span, and the response names the root
+span in ``traceresponse``.  Finished traces are kept in a bounded ring, newest
+last, and appended to ``trace_file`` as one JSON object per line when set.
+
+A trace holds at most ``trace_max_spans`` spans under its root, so a request
+running thousands of statements, such as a bulk import, doesn't keep them all.
+Spans past the limit are not opened, leaving the ones kept a whole tree, and
+their number is recorded on the root as ``droppedSpans``.
+
+Outside a traced request ``span`` only reads the context variable and hands
+back a shared no-op, so with tracing off instrumented code pays next to nothing.
+"""
+
+import functools
+import inspect
+import json
+import re
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import Any, Callable, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from vending_machine.config import settings
+from vending_machine.logging import get_logger
+
+logger = get_logger(__name__)
+
+TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+
+_NOOP = nullcontext()
+
+
+class Trace:
+    __slots__ = ("trace_id", "spans", "max_spans", "opened", "dropped")
+
+    def __init__(self, trace_id: str, max_spans: Optional[int] = None) -> None:
+        self.trace_id = trace_id
+        # Finished spans, in the order they finished
+        self.spans: list[Span] = []
+        # Spans opened under the root, and those turned away past the limit
+        self.max_spans = max_spans
+        self.opened = 0
+        self.dropped = 0
+
+    def admit(self) -> bool:
+        if self.max_spans is not None and self.opened >= self.max_spans:
+            self.dropped += 1
+            return False
+        self.opened += 1
+        return True
+
+    def as_dicts(self) -> list[dict[str, Any]]:
+        return [span.as_dict() for span in self.spans]
+
+
+class Span:
+    __slots__ = (
+        "trace",
+        "span_id",
+        "parent_id",
+        "name",
+        "attributes",
+        "start",
+        "duration",
+        "error",
+        "_started",
+        "_token",
+    )
+
+    def __init__(
+        self, trace: Trace, parent_id: Optional[str], name: str, attributes: dict
+    ) -> None:
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = 0.0
+        self.error: Optional[str] = None
+        self._started = time.perf_counter()
+        self._token = None
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        self.duration = time.perf_counter() - self._started
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        self.trace.spans.append(self)
+
+    def child(self, name: str, attributes: dict) -> "Span":
+        return Span(self.trace, self.span_id, name, attributes)
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        _current.reset(self._token)
+        self.end(exc)
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "parentId": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "durationMs": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+_current: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+
+def span(name: str, **attributes: Any):
+    """
+    Times a block as a span under the current one, a no-op outside a traced request.
+
+    Use as ``with span("jwt.decode"):``.
+    """
+    parent = _current.get()
+    if parent is None or not parent.trace.admit():
+        return _NOOP
+    return parent.child(name, attributes)
+
+
+def start_span(name: str, **attributes: Any) -> Optional[Span]:
+    """
+    Starts a span under the current one without making it current, for work
+    whose start and end are seen by different callbacks.  Finish it with ``end``.
+
+    Returns:
+        Optional[Span]: The span, None outside a traced request or past its span limit.
+    """
+    parent = _current.get()
+    if parent is None or not parent.trace.admit():
+        return None
+    return parent.child(name, attributes)
+
+
+def traced(name: str) -> Callable[[Callable], Callable]:
+    """
+    Decorates a function, sync or async, to run each call in a span.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class TracedJSONResponse(JSONResponse):
+    """
+    The default response class, rendering its body in a span.
+    """
+
+    def render(self, content: Any) -> bytes:
+        with span("render"):
+            return super().render(content)
+
+
+class Tracer:
+    """
+    Keeps the most recent finished traces, and exports them to a file when given one.
+    """
+
+    def __init__(
+        self, size: int, path: Optional[str] = None, max_spans: Optional[int] = None
+    ) -> None:
+        self.path = path
+        self.max_spans = max_spans
+        self._traces: deque[Trace] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def recent(self, limit: Optional[int] = None) -> list[Trace]:
+        traces = list(self._traces)
+        return traces[-limit:] if limit else traces
+
+    def clear(self) -> None:
+        self._traces.clear()
+
+    def finish(self, trace: Trace) -> None:
+        self._traces.append(trace)
+
+    def export(self, trace: Trace) -> None:
+        if not self.path:
+            return
+        lines = "".join(json.dumps(entry) + "\n" for entry in trace.as_dicts())
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(lines)
+
+
+tracer = Tracer(
+    settings.trace_buffer_size, settings.trace_file, settings.trace_max_spans
+)
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[tuple[str, str]]:
+    """
+    Reads the trace and parent span ids from a ``traceparent`` header.
+
+    Returns:
+        Optional[tuple[str, str]]: The ids, None if the header is missing or invalid.
+    """
+    match = TRACEPARENT.match(value.strip().lower()) if value else None
+    if match is None:
+        return None
+    version, trace_id, parent_id, _ = match.groups()
+    if version == "ff" or set(trace_id) == {"0"} or set(parent_id) == {"0"}:
+        return None
+    return trace_id, parent_id
+
+
+class TracingMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        enabled: Optional[bool] = None,
+        traces: Optional[Tracer] = None,
+    ) -> None:
+        self.app = app
+        self.enabled = settings.tracing if enabled is None else enabled
+        self.tracer = traces or tracer
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not self.enabled or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = parse_traceparent(Headers(scope=scope).get("traceparent"))
+        trace_id, parent_id = incoming or (secrets.token_hex(16), None)
+        trace = Trace(trace_id, self.tracer.max_spans)
+        root = Span(
+            trace,
+            parent_id,
+            f"{scope['method']} {scope['path']}",
+            {"method": scope["method"], "path": scope["path"]},
+        )
+
+        async def traced_send(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                root.attributes["status"] = message["status"]
+                MutableHeaders(scope=message)["traceresponse"] = (
+                    f"00-{trace_id}-{root.span_id}-01"
+                )
+            await send(message)
+
+        try:
+            with root:
+                await self.app(scope, receive, traced_send)
+        finally:
+            if trace.dropped:
+                root.attributes["droppedSpans"] = trace.dropped
+            self.tracer.finish(trace)
+            # Without a file there is nothing to hand to the thread pool
+            if self.tracer.path:
+                try:
+                    await run_in_threadpool(self.tracer.export, trace)
+                except OSError as e:
+                    logger.warning(f"Could not export trace {trace_id}: {e}")
@@ -0,0 +1,169 @@
+"""
+Startup warm-up.
+
+A lot of work is put off until the first request that needs it: FastAPI builds
+the OpenAPI schema on first access, SQLAlchemy configures the mappers on first
+use, passlib loads and self-tests the bcrypt backend on the first hash, the
+connection pool starts empty and every statement is compiled the first time it
+runs.  Left alone, the first requests after a deploy pay for all of it.
+
+``start_warm_up`` sets that work going in the background when a worker
+starts, so the worker is already accepting connections while it runs, and
+``ready`` is only set once it is done.  Until then ``/heartbeat`` answers 503,
+so a load balancer holds traffic back from the worker without it being taken
+for dead.  The process-wide steps are also run by the server before it forks
+the workers, who then inherit the results in shared pages.
+"""
+
+import asyncio
+import threading
+import time
+from typing import Callable
+
+from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
+from jose import jwt
+from sqlalchemy import Engine, select
+from sqlalchemy.orm import Session, configure_mappers
+
+from vending_machine import authentication, cart, ledger, sales, search, stock
+from vending_machine.config import settings
+from vending_machine.data_objects.product import Product as ProductOrm
+from vending_machine.data_objects.session import UserSession as UserSessionOrm
+from vending_machine.database import engine
+from vending_machine.logging import get_logger
+from vending_machine.models.conversion import from_orm_rows
+from vending_machine.models.product import Product
+from vending_machine.models.user import UserWithoutPassword
+
+logger = get_logger(__name__)
+
+# Set once this worker is warm
+ready = threading.Event()
+
+
+def _load_bcrypt() -> None:
+    authentication.pwd_context.handler("bcrypt").get_backend()
+
+
+def _load_jwt() -> None:
+    token = jwt.encode({"sub": "warm-up"}, "warm-up", algorithm=settings.jwt_algorithm)
+    jwt.decode(token, "warm-up", algorithms=[settings.jwt_algorithm])
+
+
+def _fill_conversion_caches() -> None:
+    for model in (Product, UserWithoutPassword):
+        from_orm_rows(model, [], trusted=False)
+
+
+def _prime_pool(bind: Engine) -> None:
+    # As many connections as the pool keeps, open at once so none is reused
+    size = bind.pool.size() if hasattr(bind.pool, "size") else 1
+    connections = [bind.connect() for _ in range(size)]
+    try:
+        for connection in connections:
+            connection.exec_driver_sql("SELECT 1")
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def _compile_statements(bind: Engine) -> None:
+    # The statements behind the hot routes, run once so their compiled forms are cached
+    db = Session(bind=bind, autoflush=False)
+    try:
+        authentication._get_user(db, "")
+        db.get(UserSessionOrm, "", options=[cart.CART])
+        db.get(ProductOrm, 0)
+        db.query(ProductOrm).all()
+        db.execute(select(ProductOrm.version).where(ProductOrm.id == 0)).first()
+        stock.stock_totals(db)
+        stock.stock_totals(db, [0])
+        stock.total_stock(db, 0)
+        ledger.balance(db, "")
+        ledger.latest(db, "")
+        sales.seller_sales(db, "")
+        search.search_products(db, "warm up")
+    finally:
+        db.rollback()
+        db.close()
+
+
+def _run(steps: dict[str, Callable[[], None]]) -> dict[str, float]:
+    timings = {}
+    for name, step in steps.items():
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            # A step that fails only leaves its work to the first request
+            logger.warning(f"Warm-up step {name} failed: {e}")
+        timings[name] = time.perf_counter() - start
+    return timings
+
+
+def warm_up_process(app: FastAPI) -> dict[str, float]:
+    """
+    Runs the warm-up steps whose results forked workers can inherit.
+
+    Returns:
+        dict[str, float]: The seconds each step took.
+    """
+    return _run(
+        {
+            "openapi": app.openapi,
+            "mappers": configure_mappers,
+            "conversion": _fill_conversion_caches,
+            "bcrypt": _load_bcrypt,
+            "jwt": _load_jwt,
+        }
+    )
+
+
+def warm_up_worker(bind: Engine) -> dict[str, float]:
+    """
+    Runs the warm-up steps each worker needs its own of: its connections and statement cache.
+
+    Returns:
+        dict[str, float]: The seconds each step took.
+    """
+    return _run(
+        {
+            "pool": lambda: _prime_pool(bind),
+            "statements": lambda: _compile_statements(bind),
+        }
+    )
+
+
+async def warm_up(app: FastAPI) -> None:
+    """
+    Warms the worker up off the event loop, then marks it ready.  Run on startup.
+    """
+    timings = await run_in_threadpool(warm_up_process, app)
+    timings.update(await run_in_threadpool(warm_up_worker, engine))
+
+    ready.set()
+    logger.info(
+        "Warmed up in "
+        + ", ".join(
+            f"{name} {seconds * 1000:.0f}ms" for name, seconds in timings.items()
+        )
+    )
+
+
+async def start_warm_up(app: FastAPI) -> None:
+    """
+    Starts ``warm_up`` without waiting for it, so startup completes and the
+    worker takes connections meanwhile.  Run on startup.
+    """
+    app.state.warm_up = asyncio.get_running_loop().create_task(warm_up(app))
+
+
+async def stop_warm_up(app: FastAPI) -> None:
+    """
+    Stops waiting for a warm-up still running at shutdown.  Run on shutdown.
+    """
+    task = getattr(app.state, "warm_up", None)
+    if task is not None and not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)